@@ -0,0 +1,181 @@
+"""
+Wallbox Charging Control - integrazione Home Assistant
+Esegue wallbox_charging_control.py in modo residente e guidato dagli eventi invece che da un'automazione a intervalli fissi.
+Con più script (uno per impianto, ognuno con il suo CONFIG) ogni impianto ha il proprio runtime e scheduler.
+Il servizio wallbox_control.tick chiede un tick al runtime residente: lo usano il tramite python_script
+(wallbox_control_tick.py) e lo script stesso quando viene ancora richiamato da un'automazione.
+"""
+import asyncio
+from datetime import timedelta
+import logging
+import time
+
+import voluptuous as vol
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import Event, HomeAssistant, ServiceCall, callback
+from homeassistant.exceptions import ServiceNotFound
+from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.event import (
+    async_track_state_change_event,
+    async_track_time_interval,
+)
+from homeassistant.helpers.typing import ConfigType
+
+from .engine import (
+    CommandDispatcher,
+    TickScheduler,
+    WallboxEngine,
+    event_router,
+    guard_entities,
+    load_script,
+    trigger_entities,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAIN = "wallbox_control"
+
+CONF_SCRIPT = "script"
+CONF_DEBOUNCE = "debounce"
+CONF_MAX_LATENCY = "max_latency"
+CONF_HEARTBEAT = "heartbeat"
+
+SERVICE_TICK = "tick"
+TICK_SCHEMA = vol.Schema({vol.Optional(CONF_SCRIPT): cv.string})
+
+CONFIG_SCHEMA = vol.Schema(
+    {
+        DOMAIN: vol.Schema(
+            {
+                vol.Optional(CONF_SCRIPT, default="python_scripts/wallbox_charging_control.py"): vol.All(
+                    cv.ensure_list, [cv.string]
+                ),
+                vol.Optional(CONF_DEBOUNCE, default=1.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional(CONF_MAX_LATENCY, default=3.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional(CONF_HEARTBEAT, default=45): cv.positive_int,
+            }
+        )
+    },
+    extra=vol.ALLOW_EXTRA,
+)
+
+
+async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
+    """Carica ogni script una volta e collega il suo tick ai cambi stato delle entità del suo CONFIG."""
+    conf = config[DOMAIN]
+    sites = {}
+    for index, script in enumerate(conf[CONF_SCRIPT]):
+        try:
+            sites[script] = await async_setup_site(hass, conf, script, index)
+        except ValueError as exc:
+            # CONFIG non valida: l'impianto non parte, gli altri sì
+            _LOGGER.error("Wallbox control non avviato per %s: %s", script, exc)
+    if not sites:
+        return False
+    hass.data[DOMAIN] = {"sites": sites}
+
+    @callback
+    def tick_service(call: ServiceCall) -> None:
+        # Tick a richiesta (tramite python_script o automazioni): passa dallo scheduler come un cambio stato
+        script = call.data.get(CONF_SCRIPT)
+        for name, site in sites.items():
+            if script is None or script == name:
+                site["scheduler"].notify(None)
+
+    hass.services.async_register(DOMAIN, SERVICE_TICK, tick_service, schema=TICK_SCHEMA)
+    return True
+
+
+async def async_setup_site(hass: HomeAssistant, conf: dict, script: str, index: int) -> dict:
+    """Runtime residente di un impianto (uno script con il suo CONFIG, una o più wallbox)."""
+    path = hass.config.path(script)
+    suffix = f".{index}" if index else ""
+    script_logger = logging.getLogger(f"{__name__}.script{suffix}")
+    # Comandi alla wallbox con conferma (blocking) dai thread del dispatcher; servizi inesistenti o dati non
+    # validi non vengono ripetuti
+    def call_service(domain, service, data, timeout):
+        # La chiamata gira sul loop di HA: oltre il timeout viene cancellata invece di restare appesa
+        call = hass.services.async_call(domain, service, data, blocking=True)
+        return asyncio.run_coroutine_threadsafe(asyncio.wait_for(call, timeout or None), hass.loop).result()
+
+    dispatcher = CommandDispatcher(call_service, permanent=(ServiceNotFound, vol.Invalid))
+    try:
+        namespace = await hass.async_add_executor_job(load_script, path, hass, script_logger, dispatcher)
+    except ValueError:
+        dispatcher.shutdown()
+        raise
+    engine = WallboxEngine(namespace)
+
+    @callback
+    def stop(event: Event) -> None:
+        dispatcher.shutdown()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop)
+
+    def run_tick(entities, done):
+        async def runner():
+            try:
+                # Lo script usa le API sincrone di hass: il tick gira nell'executor
+                await hass.async_add_executor_job(engine.tick)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Errore durante il tick wallbox (eventi: %s)", entities)
+            finally:
+                done()
+
+        hass.async_create_task(runner())
+
+    scheduler = TickScheduler(
+        run_tick,
+        hass.loop.call_later,
+        time.monotonic,
+        conf[CONF_DEBOUNCE],
+        conf[CONF_MAX_LATENCY],
+    )
+
+    guarded = set(guard_entities(engine.config))
+
+    async def run_guard(entity_id, event_time):
+        try:
+            result = await hass.async_add_executor_job(engine.guard, event_time)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Errore nel fast-path sovracorrente (%s)", entity_id)
+            return
+        if result is not None:
+            _LOGGER.warning(
+                "Protezione sovracorrente su %s: %s (reazione %.1f ms, peggiore %.1f ms)",
+                entity_id,
+                result[2],
+                engine.guard_stats["last_reaction"] * 1000,
+                engine.guard_stats["max_reaction"] * 1000,
+            )
+
+    # SCENARIO 3 senza debounce: un solo evento basta per ridurre o mettere in pausa
+    route = event_router(
+        scheduler,
+        guarded,
+        lambda entity_id, event_time: hass.async_create_task(run_guard(entity_id, event_time)),
+        time.monotonic,
+    )
+
+    @callback
+    def state_changed(event: Event) -> None:
+        route(event.data["entity_id"])
+
+    @callback
+    def heartbeat(now) -> None:
+        # Tick periodico per le condizioni che dipendono solo dal tempo (finestra oraria, sole, blocco post-tag)
+        scheduler.notify(None)
+
+    entities = trigger_entities(engine.config)
+    async_track_state_change_event(hass, entities, state_changed)
+    async_track_time_interval(hass, heartbeat, timedelta(seconds=conf[CONF_HEARTBEAT]))
+    _LOGGER.info(
+        "Wallbox control residente (%s): %d entità osservate, %d wallbox",
+        script,
+        len(entities),
+        len(engine.config.get("chargers", [])) or 1,
+    )
+
+    scheduler.notify(None)
+    return {"engine": engine, "scheduler": scheduler}
@@ -0,0 +1,322 @@
+"""
+Wallbox Dynamic Controller - runtime residente
+Carica una sola volta le funzioni di wallbox_charging_control.py e le esegue sugli eventi di cambio stato.
+Nessuna dipendenza da Home Assistant: hass, timer e orologio vengono forniti dall'integrazione
+(o da un bus di eventi finto per le prove offline).
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import datetime
+import math
+import threading
+import time
+
+# Entità scritte dallo script o che cambiano solo per il passare del tempo: non generano un nuovo tick
+NON_TRIGGER_KEYS = (
+    "debug_mode",
+    "current_timestamp",
+    "wallbox_set_mode",
+    "wallbox_set_current",
+    "batt_protection_cycles",
+    "time",
+    "last_wallbox_current",
+    "date_time_iso",
+    "status_sensor",
+    "diagnostics_sensor",
+    "energy_solar_sensor",
+    "energy_battery_sensor",
+    "energy_grid_sensor",
+)
+
+# Entità osservate dal fast-path di protezione sovracorrente (SCENARIO 3)
+GUARD_KEYS = ("home_current", "wallbox_power", "voltage")
+
+
+def compile_source(source, env):
+    """Compila codice generato dallo script (tabella decisionale) e restituisce il namespace risultante."""
+    namespace = dict(env)
+    exec(compile(source, "<wallbox-decision>", "exec"), namespace)  # noqa: S102
+    return namespace
+
+
+def load_script(path, hass, logger, dispatcher=None):
+    """
+    Compila lo script una volta e restituisce il namespace con CONFIG e le funzioni decisionali.
+    CONFIG viene validato qui, una sola volta: con errori (entità mancanti, parametri fuori dominio) ValueError.
+    dispatcher (CommandDispatcher) invia i comandi del tick con conferma e in parallelo; senza, invio sequenziale.
+    """
+    with open(path, encoding="utf8") as fil:
+        source = fil.read()
+    code = compile(source, path, "exec")
+    # Stessi nomi che l'ambiente python_script mette a disposizione dello script
+    namespace = {
+        "hass": hass,
+        "logger": logger,
+        # clock: orologio monotono per i tempi per fase (python_script non espone time.monotonic)
+        # compile: compilazione della tabella decisionale al caricamento (python_script non espone compile)
+        # dispatch: invio dei comandi con conferma, timeout e ripetizioni (python_script non ha thread)
+        "data": {"load_only": True, "clock": time.perf_counter, "compile": compile_source, "dispatch": dispatcher},
+        "output": {},
+        "time": time,
+        "datetime": datetime,
+        "math": math,
+    }
+    exec(code, namespace)  # noqa: S102
+    errors = namespace["config_errors"](namespace["CONFIG"])
+    if errors:
+        raise ValueError(f"{path}: CONFIG non valida: " + "; ".join(errors))
+    return namespace
+
+
+def config_entities(config):
+    """Coppie (chiave, entity_id) di CONFIG: entità comuni e, con più wallbox, quelle di ogni wallbox."""
+    pairs = list(config["entities"].items())
+    for charger in config.get("chargers", []):
+        pairs.extend(charger.get("entities", {}).items())
+    return pairs
+
+
+def trigger_entities(config):
+    """Entità di CONFIG da cui dipende la logica decisionale (senza duplicati)."""
+    entities = []
+    for key, entity_id in config_entities(config):
+        if key not in NON_TRIGGER_KEYS and entity_id not in entities:
+            entities.append(entity_id)
+    return entities
+
+
+def guard_entities(config):
+    entities = []
+    for key, entity_id in config_entities(config):
+        if key in GUARD_KEYS and entity_id not in entities:
+            entities.append(entity_id)
+    return entities
+
+
+class CommandDispatcher:
+    """
+    Invia le catene di comandi di un tick: catene diverse in parallelo, i comandi di una catena in ordine
+    (la corrente prima di mode=normal). Ogni chiamata attende la conferma al massimo timeout secondi; errori e
+    timeout vengono ripetuti fino a retries volte con attesa backoff, 2*backoff, ... Gli errori di tipo
+    permanent (servizio inesistente, dati non validi) non vengono ripetuti. Se un comando fallisce i successivi
+    della stessa catena non partono: la wallbox resta nell'ultimo stato confermato invece che in uno misto.
+    preempt() ferma le catene già avviate prima del loro prossimo comando o tentativo (esito "preempted").
+    Ogni chiamata gira in un thread proprio: una chiamata che non risponde mai non toglie il posto alle successive
+    (al massimo max_calls chiamate senza risposta, oltre le nuove falliscono subito e vengono ripetute).
+    """
+
+    def __init__(self, call, clock=time.monotonic, sleep=time.sleep, workers=4, permanent=(), max_calls=16):
+        # call(domain, service, data, timeout): chiamata bloccante fino alla conferma del servizio; se può, si
+        # interrompe da sola dopo timeout secondi (nell'integrazione: asyncio.wait_for sul loop di HA)
+        self.call = call
+        self.clock = clock
+        self.sleep = sleep
+        self.permanent = tuple(permanent)
+        self.max_calls = max_calls
+        self.chains = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wallbox-chain")
+        self.lock = threading.Lock()
+        self.active = 0
+        self.generation = 0
+
+    def __call__(self, chains, timeout, retries, backoff):
+        """Avvia le catene ([[domain, service, data], ...] ciascuna) e restituisce wait() -> esiti per catena."""
+        generation = self.generation
+        futures = [self.chains.submit(self.run_chain, chain, timeout, retries, backoff, generation) for chain in chains]
+
+        def wait():
+            return [future.result() for future in futures]
+
+        return wait
+
+    def preempt(self):
+        """Le catene avviate finora non inviano altri comandi né altri tentativi (sostituite da catene più recenti)."""
+        self.generation += 1
+
+    def run_chain(self, chain, timeout, retries, backoff, generation):
+        results = []
+        for domain, service, data in chain:
+            if results and results[-1][0] != "ok":
+                results.append(["skipped", 0.0, 0, None])
+                continue
+            results.append(self.run_command(domain, service, data, timeout, retries, backoff, generation))
+        return results
+
+    def run_command(self, domain, service, data, timeout, retries, backoff, generation):
+        """[stato, secondi, tentativi, errore] con stato "ok", "timeout", "error" o "preempted"."""
+        started = self.clock()
+        attempt = 0
+        while True:
+            if generation != self.generation:
+                return ["preempted", self.clock() - started, attempt, None]
+            attempt += 1
+            future = self.start_call(domain, service, data, timeout)
+            try:
+                future.result(timeout=timeout or None)
+                return ["ok", self.clock() - started, attempt, None]
+            except (FutureTimeout, TimeoutError):
+                # La chiamata può ancora concludersi: ripeterla è sicuro, i comandi impostano un valore assoluto
+                status, error = "timeout", f"nessuna conferma entro {timeout}s"
+            except self.permanent as exc:
+                return ["error", self.clock() - started, attempt, str(exc)]
+            except Exception as exc:  # pylint: disable=broad-except
+                status, error = "error", str(exc) or type(exc).__name__
+            if attempt > retries:
+                return [status, self.clock() - started, attempt, error]
+            self.sleep(backoff * 2 ** (attempt - 1))
+
+    def start_call(self, domain, service, data, timeout):
+        future = Future()
+        with self.lock:
+            if self.active >= self.max_calls:
+                future.set_exception(RuntimeError(f"{self.active} chiamate ancora senza risposta"))
+                return future
+            self.active += 1
+
+        def target():
+            try:
+                future.set_result(self.call(domain, service, data, timeout))
+            except BaseException as exc:  # pylint: disable=broad-except
+                future.set_exception(exc)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+        threading.Thread(target=target, name="wallbox-call", daemon=True).start()
+        return future
+
+    def shutdown(self):
+        self.chains.shutdown(wait=False)
+
+
+class TickScheduler:
+    """
+    Raggruppa gli eventi di cambio stato in un solo tick.
+    Ogni evento riarma il timer di debounce, ma il tick parte comunque entro max_latency dal primo
+    evento in attesa. Un solo tick alla volta: gli eventi arrivati durante l'esecuzione ne generano uno nuovo.
+    """
+
+    def __init__(self, run_tick, call_later, clock, debounce=1.0, max_latency=3.0):
+        # run_tick(entities, done): esegue il tick e chiama done() al termine (anche in modo asincrono)
+        # call_later(delay, callback): programma il callback e restituisce un oggetto con cancel()
+        self.run_tick = run_tick
+        self.call_later = call_later
+        self.clock = clock
+        self.debounce = debounce
+        self.max_latency = max(debounce, max_latency)
+        self.pending = set()
+        self.first_event = None
+        self.timer = None
+        self.running = False
+        self.stats = {"events": 0, "ticks": 0, "last_latency": 0.0, "max_latency": 0.0}
+
+    def notify(self, entity_id=None):
+        """Registra un cambio stato (None = heartbeat) e programma il tick."""
+        now = self.clock()
+        self.stats["events"] += 1
+        self.pending.add(entity_id)
+        if self.first_event is None:
+            self.first_event = now
+        if not self.running:
+            self.schedule(now)
+
+    def schedule(self, now):
+        if self.timer is not None:
+            self.timer.cancel()
+        deadline = self.first_event + self.max_latency
+        delay = max(0.0, min(self.debounce, deadline - now))
+        self.timer = self.call_later(delay, self.fire)
+
+    def fire(self):
+        self.timer = None
+        if self.running or self.first_event is None:
+            return
+        latency = self.clock() - self.first_event
+        entities = self.pending
+        self.pending = set()
+        self.first_event = None
+        self.running = True
+        self.stats["ticks"] += 1
+        self.stats["last_latency"] = latency
+        self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+        self.run_tick(entities, self.done)
+
+    def done(self):
+        self.running = False
+        if self.first_event is not None:
+            self.schedule(self.clock())
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+def event_router(scheduler, guarded, guard, clock):
+    """
+    Instradamento di un cambio stato: le entità della protezione vanno subito al fast-path sovracorrente
+    (guard(entity_id, event_time), senza debounce), tutte allo scheduler del tick.
+    """
+
+    def route(entity_id):
+        if entity_id in guarded:
+            guard(entity_id, clock())
+        scheduler.notify(entity_id)
+
+    return route
+
+
+class WallboxEngine:
+    """
+    Decisione residente: CONFIG e funzioni vengono caricate una volta, main() viene chiamato ad ogni tick.
+    Tick completo e fast-path sovracorrente condividono un lock, così le decisioni non si intrecciano; l'attesa
+    degli esiti dei comandi (fino a (timeout + backoff) x tentativi) avviene senza lock, e il fast-path che in
+    quel momento interviene ferma i comandi del tick non ancora partiti (es. mode=normal dopo la corrente).
+    """
+
+    def __init__(self, namespace, clock=time.monotonic):
+        self.namespace = namespace
+        self.config = namespace["CONFIG"]
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.dispatcher = namespace["data"].get("dispatch")
+        if self.dispatcher is not None:
+            namespace["data"]["dispatch"] = self.dispatch
+        self.guard_stats = {"checks": 0, "trips": 0, "last_reaction": 0.0, "max_reaction": 0.0}
+
+    def dispatch(self, chains, timeout, retries, backoff):
+        """Invio dei comandi dallo script (lock preso); wait() rilascia il lock finché gli esiti non arrivano."""
+        if getattr(self.local, "preempt", False):
+            # Primo invio del fast-path: le catene ancora in corso portano una decisione ormai superata
+            self.local.preempt = False
+            self.dispatcher.preempt()
+        wait = self.dispatcher(chains, timeout, retries, backoff)
+
+        def wait_unlocked():
+            self.lock.release()
+            try:
+                return wait()
+            finally:
+                self.lock.acquire()
+
+        return wait_unlocked
+
+    def tick(self):
+        with self.lock:
+            self.namespace["main"]()
+
+    def guard(self, event_time):
+        """Esegue il fast-path sovracorrente; event_time (stesso orologio di clock) serve a misurare il tempo di reazione."""
+        with self.lock:
+            self.local.preempt = True
+            try:
+                result = self.namespace["overcurrent_tick"]()
+            finally:
+                self.local.preempt = False
+        stats = self.guard_stats
+        stats["checks"] += 1
+        if result is not None:
+            reaction = self.clock() - event_time
+            stats["trips"] += 1
+            stats["last_reaction"] = reaction
+            stats["max_reaction"] = max(stats["max_reaction"], reaction)
+        return result
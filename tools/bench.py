@@ -0,0 +1,269 @@
+"""
+Wallbox Dynamic Controller - benchmark del tick di controllo
+Esegue main() dello script sul hass finto (tools/fakehass.py) per ogni percorso decisionale e misura
+latenza del tick, letture di stato, scritture, chiamate di servizio e memoria allocata.
+Ogni iterazione riparte dallo stesso stato (hass e store ricaricato come in un'esecuzione python_script),
+così letture e comandi sono deterministici; i risultati vengono confrontati con tools/bench_baseline.json.
+
+Uso:
+  python tools/bench.py                       confronto con la baseline, exit 1 se un percorso peggiora
+  python tools/bench.py --update              registra la baseline (dopo una modifica voluta)
+  python tools/bench.py --read-latency-ms 2 --call-latency-ms 20
+                                              latenza iniettata su ogni lettura / servizio del hass finto
+  python tools/bench.py --debug               stessi percorsi con input_boolean.wboxdebug acceso
+Letture, scritture e servizi devono restare <= baseline; latenza mediana e memoria hanno una tolleranza
+(--tolerance). Con latenza iniettata o debug diversi da quelli della baseline vengono confrontati solo i conteggi.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakehass import FakeHass, load  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# Orologio fisso dei sensori (current_timestamp, date_time_iso): mezzogiorno di una giornata di sole
+NOW_TS = 1781517600.0
+NOW_ISO = "2026-06-15T12:00:00"
+
+# Giornata di sole: 4kW di FTV, casa a 500W, wallbox in carica a 10A, nessuna regola di pausa attiva
+BASE_STATES = {
+    "debug_mode": "off",
+    "voltage": 230,
+    "wallbox_state": "charging",
+    "current_timestamp": NOW_TS,
+    "wallbox_set_mode": "normal",
+    "wallbox_set_current": 10,
+    "last_tag_time": ("2026-06-15 11:00:00", {"timestamp": NOW_TS - 3600}),
+    "pv_primary_1": 2500,
+    "pv_primary_2": 0,
+    "pv_secondary": 1500,
+    "pv_losses": 0,
+    "batt_power": 0,
+    "batt_max_discharge": 3000,
+    "batt_soc": 80,
+    "batt_soc_min": 20,
+    "batt_soc_priority": 60,
+    "batt_protection_cycles": 0,
+    "min_charge_amps": 6,
+    "max_charge_amps": 16,
+    "force_charge": "off",
+    "home_power": 2800,
+    "home_current": 12.2,
+    "home_max_current": 32,
+    "wallbox_power": 2300,
+    "ev_soc": 50,
+    "ev_target_soc": 90,
+    "ev_soc_emergenza": 0,
+    "time": "12:00:00",
+    "pause_start_time": "00:00:00",
+    "pause_end_time": "00:00:00",
+    "sun": ("above_horizon", {"elevation": 45.0, "rising": False}),
+    "sun_elevation_threshold": 10,
+    "battery_priority_ratio": 50,
+    "last_wallbox_current": 10,
+    "date_time_iso": NOW_ISO,
+    "grid": "on",
+}
+
+# Percorsi misurati: (nome, stati modificati rispetto a BASE_STATES, scenari attesi, inizio della ragione di pausa)
+PATHS = (
+    ("idle", {"wallbox_state": "idle"}, (), "Connettore non collegato"),
+    ("post_tag_lock", {"last_tag_time": ("2026-06-15 11:59:00", {"timestamp": NOW_TS - 60})}, (), "Blocco post-tag"),
+    ("emergency", {"ev_soc": 10, "ev_soc_emergenza": 20}, ("0", "8a", "17"), None),
+    ("scenario_9", {"batt_power": 2800, "batt_soc": 40}, ("9", "13", "17"), None),
+    ("scenario_11", {"batt_soc": 40}, ("11", "13", "17"), None),
+    ("scenario_12a", {"batt_soc": 97}, ("12a", "13", "17"), None),
+    ("scenario_12b", {}, ("12b", "13", "17"), None),
+    ("scenario_12c", {"pv_primary_1": 1000, "pv_secondary": 300}, ("12c", "15"), "Potenza insufficiente"),
+    ("scenario_17", {"wallbox_set_mode": "paused", "wallbox_set_current": 6, "wallbox_power": 0, "home_power": 500,
+                     "home_current": 2.2}, ("12b", "13", "17"), None),
+)
+
+# Metriche deterministiche: qualsiasi aumento è una regressione
+COUNT_METRICS = ("reads", "writes", "calls")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def path_states(config, overrides, debug=False):
+    e = config["entities"]
+    states = {}
+    extra = {"debug_mode": "on"} if debug else {}
+    for key, value in list(BASE_STATES.items()) + list(overrides.items()) + list(extra.items()):
+        states[e[key]] = value if isinstance(value, tuple) else (value, None)
+    return states
+
+
+class Bench:
+    """Script caricato una volta sul hass finto; ogni tick riparte dagli stati del percorso."""
+
+    def __init__(self, read_latency=0.0, call_latency=0.0, debug=False):
+        # Logger attivo ma senza output: con --debug si misura anche la costruzione dei messaggi
+        logger = logging.getLogger("wallbox.bench")
+        logger.setLevel(logging.INFO if debug else logging.ERROR)
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.debug = debug
+        self.hass = FakeHass(read_latency, call_latency)
+        self.ns = load(self.hass, logger=logger)
+        self.config = self.ns["CONFIG"]
+        self.main = self.ns["main"]
+
+    def reset(self, states):
+        hass = self.hass
+        hass.states.data = {}
+        for entity_id, (state, attributes) in states.items():
+            hass.states.put(entity_id, state, attributes)
+        hass.reset_counters()
+        # Store riletto dall'entità a ogni tick e salvato a fine tick, come nell'esecuzione python_script
+        store = self.ns["STORE"]
+        store["loaded"] = False
+        store["saved_ts"] = 0
+        store["data"] = {}
+
+    def check(self, name, expect, reason):
+        """Verifica che lo stato del percorso porti davvero agli scenari attesi."""
+        counters = self.ns["STORE"]["data"].get("counters", {})
+        missing = [label for label in expect if not counters.get(label)]
+        status = self.hass.states.data.get(self.config["entities"]["status_sensor"])
+        got = status.attributes.get("Ragione Pausa", "") if status is not None else ""
+        if missing or (reason and not got.startswith(reason)):
+            raise SystemExit(f"{name}: percorso inatteso (scenari {sorted(counters)}, ragione '{got}')")
+
+    def run_path(self, name, overrides, expect, reason, iterations, repeats=5):
+        states = path_states(self.config, overrides, self.debug)
+        perf = time.perf_counter
+        samples = []
+        medians = []
+        # Più ripetizioni senza garbage collector; per il confronto conta la mediana migliore, meno sensibile al rumore
+        for _ in range(repeats):
+            batch = []
+            gc.collect()
+            gc.disable()
+            try:
+                for _ in range(max(1, iterations // repeats)):
+                    self.reset(states)
+                    start = perf()
+                    self.main()
+                    batch.append(perf() - start)
+            finally:
+                gc.enable()
+            batch.sort()
+            medians.append(percentile(batch, 50))
+            samples.extend(batch)
+        self.check(name, expect, reason)
+        hass = self.hass
+        counts = {"reads": hass.states.reads, "writes": hass.states.writes, "calls": len(hass.services.calls)}
+
+        # Memoria: un tick a parte sotto tracemalloc (il tracciamento rallenta, non va nelle latenze)
+        self.reset(states)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        self.main()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        samples.sort()
+        result = {
+            "median_us": round(min(medians) * 1e6, 1),
+            "p95_us": round(percentile(samples, 95) * 1e6, 1),
+            "max_us": round(samples[-1] * 1e6, 1),
+            "alloc_kib": round((peak - before) / 1024.0, 1),
+        }
+        result.update(counts)
+        return result
+
+
+def compare(name, result, base, tolerance, timing):
+    """Elenco delle metriche peggiorate rispetto alla baseline."""
+    worse = []
+    for metric in COUNT_METRICS:
+        if result[metric] > base.get(metric, result[metric]):
+            worse.append(f"{metric} {base[metric]} -> {result[metric]}")
+    if timing and result["median_us"] > base["median_us"] * (1 + tolerance) + 10:
+        worse.append(f"mediana {base['median_us']:.1f} -> {result['median_us']:.1f} us")
+    if result["alloc_kib"] > base["alloc_kib"] * (1 + tolerance) + 1:
+        worse.append(f"memoria {base['alloc_kib']:.1f} -> {result['alloc_kib']:.1f} KiB")
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del tick di controllo sul hass finto")
+    parser.add_argument("--iterations", type=int, default=200, help="tick misurati per percorso")
+    parser.add_argument("--paths", help="percorsi da misurare separati da virgola (default: tutti)")
+    parser.add_argument("--read-latency-ms", type=float, default=0.0, help="latenza per lettura di stato")
+    parser.add_argument("--call-latency-ms", type=float, default=0.0, help="latenza per chiamata di servizio")
+    parser.add_argument("--debug", action="store_true", help="misura con il debug dello script acceso")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update", action="store_true", help="registra i risultati come nuova baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="tolleranza relativa su latenza e memoria")
+    parser.add_argument("--retries", type=int, default=2, help="rimisure prima di confermare un peggioramento di latenza")
+    args = parser.parse_args()
+
+    selected = args.paths.split(",") if args.paths else None
+    paths = [p for p in PATHS if selected is None or p[0] in selected]
+    settings = {"read_latency_ms": args.read_latency_ms, "call_latency_ms": args.call_latency_ms}
+    if args.debug:
+        settings["debug"] = True
+    bench = Bench(args.read_latency_ms / 1000.0, args.call_latency_ms / 1000.0, args.debug)
+
+    baseline = None
+    if not args.update and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf8") as fil:
+            baseline = json.load(fil)
+    timing = baseline is not None and baseline.get("settings") == settings
+    if baseline is not None and not timing:
+        print("latenza iniettata o debug diversi dalla baseline: confronto solo letture, scritture, servizi e memoria")
+
+    print(f"{'percorso':<15} {'mediana us':>10} {'p95 us':>9} {'letture':>8} {'scritture':>9} {'servizi':>8} {'alloc KiB':>9}  esito")
+    results = {}
+    regressions = 0
+    for name, overrides, expect, reason in paths:
+        result = bench.run_path(name, overrides, expect, reason, args.iterations)
+        results[name] = result
+        outcome = ""
+        if baseline is not None:
+            base = baseline["paths"].get(name)
+            if base is None:
+                outcome = "nuovo"
+            else:
+                worse = compare(name, result, base, args.tolerance, timing)
+                # Un peggioramento solo di tempo può essere rumore della macchina: va confermato rimisurando
+                for _ in range(args.retries):
+                    if not worse or [w for w in worse if not w.startswith("mediana")]:
+                        break
+                    again = bench.run_path(name, overrides, expect, reason, args.iterations)
+                    result["median_us"] = min(result["median_us"], again["median_us"])
+                    worse = compare(name, result, base, args.tolerance, timing)
+                regressions += 1 if worse else 0
+                outcome = "PEGGIORATO: " + ", ".join(worse) if worse else "ok"
+        print(f"{name:<15} {result['median_us']:10.1f} {result['p95_us']:9.1f} {result['reads']:8d} "
+              f"{result['writes']:9d} {result['calls']:8d} {result['alloc_kib']:9.1f}  {outcome}")
+
+    if args.update:
+        with open(args.baseline, "w", encoding="utf8") as fil:
+            json.dump({"settings": settings, "paths": results}, fil, indent=2, sort_keys=True)
+            fil.write("\n")
+        print(f"baseline salvata in {args.baseline}")
+        return 0
+    if baseline is None:
+        print("nessuna baseline: eseguire con --update per registrarla")
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Wallbox Dynamic Controller - verifica della tabella decisionale compilata
+Confronta decide_pause / decide_amps (tabella compilata, sezione 6b dello script) con la cascata di riferimento
+determine_pause_reason / calculate_target_amps su stati e parametri casuali. Ogni campo numerico viene estratto
+metà delle volte uniforme e metà su una soglia della cascata (uguale, appena sotto o appena sopra), così tutti i
+confini tra scenari vengono attraversati. Per ogni stato devono coincidere ragioni di pausa, ampere, scenari
+attraversati, messaggi della traccia, notifiche, cicli di protezione e surplus da inseguire (regolatore PI);
+la valutazione deve essere pura (record invariato e stesso esito se ripetuta) e decide_batch deve dare gli esiti
+della cascata.
+
+Uso:
+  python tools/decision_check.py [--cases 20000] [--seed 1]
+  python tools/decision_check.py --bench [--cases 20000]     tempi per stato: cascata, tabella, batch
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakehass import FakeHass, load  # noqa: E402
+
+TIMES = ("00:00", "06:00", "07:30", "12:00", "18:00", "21:59", "22:00", "23:59")
+
+
+def near(rnd, value):
+    return rnd.choice((value, value - 0.1, value + 0.1))
+
+
+def pick(rnd, uniform, edges):
+    # Metà dei campioni su una soglia (uguale, appena sotto o appena sopra), metà uniformi
+    if rnd.random() < 0.5:
+        return near(rnd, rnd.choice(edges))
+    return uniform
+
+
+def random_case(ns, rnd, base):
+    """Record di stato completo come get_system_state (più previsione e piano) e parametri della cascata."""
+    params = dict(base)
+    params.update({
+        "min_power_ratio_for_min_amps": rnd.choice((0.7, rnd.uniform(0.3, 1.0))),
+        "batt_discharge_margin": rnd.choice((0.8, rnd.uniform(0.5, 1.0))),
+        "pv_safety_margin_ratio": rnd.choice((0.1, rnd.uniform(0.0, 0.4))),
+        "force_charge_soc_threshold": rnd.choice((95.0, 90.0)),
+        "forecast_charge": rnd.random() < 0.5,
+        "forecast_start_ratio": rnd.choice((0.5, 0.3)),
+    })
+    voltage = rnd.choice((0.0, 230.0, 230.0, 241.5))
+    min_amp = rnd.choice((6, 6, 8))
+    min_power = min_amp * voltage
+    threshold = min_power * params["min_power_ratio_for_min_amps"]
+    soc_min = rnd.choice((10, 20, 30))
+    soc_priority = rnd.choice((50, 60, 80))
+    batt_max = rnd.choice((2000, 3000))
+    ev_emerg = rnd.choice((0, 10.0, 20.0))
+    ev_target = rnd.choice((80.0, 100.0))
+    home_max = rnd.choice((25.0, 32.0))
+    elevation_limit = rnd.choice((5.0, 10.0))
+    pv_excess = pick(rnd, rnd.uniform(-500, 7000), (min_power, threshold, min_power * params["forecast_start_ratio"], 100))
+    ev_soc = rnd.choice((None, rnd.uniform(0, 100), near(rnd, ev_emerg), near(rnd, ev_target), 99.0))
+    state = {
+        "forzacharge": rnd.random() < 0.1,
+        "ev_soc": ev_soc,
+        "ev_target": ev_target,
+        "ev_soc_emergenza": ev_emerg,
+        "home_current": pick(rnd, rnd.uniform(0, 40), (home_max,)),
+        "home_max_current": home_max,
+        "ora_inizio_pausa": rnd.choice(TIMES),
+        "ora_fine_pausa": rnd.choice(TIMES),
+        "ora_attuale": rnd.choice(TIMES),
+        "soc_attuale": pick(rnd, rnd.uniform(0, 100), (soc_min, soc_priority, params["force_charge_soc_threshold"])),
+        "soc_min": soc_min,
+        "soc_priority": soc_priority,
+        "batt_protection_cycles": rnd.choice((0, 0, 0, 1, 3)),
+        "sun_elevation": pick(rnd, rnd.uniform(-10, 60), (elevation_limit,)),
+        "elevation_limit": elevation_limit,
+        "is_rising": rnd.random() < 0.5,
+        "min_amp": min_amp,
+        "max_amp": rnd.choice((0, 10, 16, 32)),
+        "voltage": voltage,
+        "min_wallbox_power": min_power,
+        "batt_power": pick(rnd, rnd.uniform(-3000, 4000), (batt_max * params["batt_discharge_margin"],)),
+        "batt_max_discharge": batt_max,
+        "pv_excess": pv_excess,
+        "wallbox_power": rnd.uniform(0, 3700),
+        "inverter_secondary_active": rnd.random() < 0.5,
+        "pv_potential_secondary": pick(rnd, rnd.uniform(0, 3000), (min_power,)),
+        "batt_priority_ratio": rnd.uniform(0, 100),
+        "emergency": ns["ev_emergency"](ev_soc, ev_emerg),
+    }
+    if rnd.random() < 0.7:
+        surplus = [pick(rnd, rnd.uniform(-500, 7000), (pv_excess, min_power, threshold)) for _ in range(5)]
+        state["forecast"] = {"ready": rnd.random() < 0.9, "surplus": surplus}
+    if rnd.random() < 0.3:
+        state["plan"] = {"power": pick(rnd, rnd.uniform(0, 7000), (pv_excess, min_power)),
+                         "departure": 1781517600.0 + rnd.uniform(0, 86400), "energy_wh": rnd.uniform(0, 40000)}
+    return ns["state_new"](state), params
+
+
+def reset(ns, debug):
+    ns["STORE"]["data"] = ns["store_new"]()
+    ns["TICK"]["debug"] = debug
+    ns["TICK"]["trace"] = {"hits": [], "events": []} if debug else None
+    ns["TICK"]["notify"] = {}
+    ns["TICK"]["track"] = None
+
+
+def outcome(ns, rule_reason, amps, calc_reason):
+    trace = ns["TICK"]["trace"]
+    return (rule_reason, amps, calc_reason, tuple(trace["hits"]), tuple(trace["events"]),
+            dict(ns["TICK"]["notify"]), ns["STORE"]["data"]["cycles"], ns["TICK"]["track"])
+
+
+def run_cascade(ns, state, cfg):
+    reset(ns, True)
+    rule_reason = ns["determine_pause_reason"](state, cfg)
+    amps, calc_reason = (0, None) if rule_reason else ns["calculate_target_amps"](state, cfg)
+    return outcome(ns, rule_reason, amps, calc_reason)
+
+
+def run_table(ns, state, cfg):
+    """Percorso del tick con la tabella compilata; restituisce anche eventuali violazioni di purezza."""
+    reset(ns, True)
+    compiled = ns["DECISION"]
+    record = compiled["decision_record"](state, cfg)
+    before = list(record)
+    first = ns["decide"](record, True)
+    impure = record != before or ns["decide"](record, True) != first
+    rule_reason, actions = compiled["decide_pause"](record, True)
+    ns["apply_decision_actions"](actions)
+    amps, calc_reason = 0, None
+    if not rule_reason:
+        amps, calc_reason, actions = compiled["decide_amps"](record, True)
+        ns["apply_decision_actions"](actions)
+    impure = impure or record != before
+    return outcome(ns, rule_reason, amps, calc_reason), impure
+
+
+def check(ns, cases, seed):
+    rnd = random.Random(seed)
+    cfg = ns["CONFIG"]
+    base = dict(cfg["params"])
+    mismatches = impure = 0
+    hits = {}
+    for n in range(cases):
+        state, params = random_case(ns, rnd, base)
+        cfg["params"] = params
+        expected = run_cascade(ns, state, cfg)
+        got, dirty = run_table(ns, state, cfg)
+        impure += dirty
+        for label in expected[3]:
+            hits[label] = hits.get(label, 0) + 1
+        if got != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"caso {n}: stato {state}\n  cascata {expected}\n  tabella {got}")
+    cfg["params"] = base
+    return mismatches, impure, hits
+
+
+def check_batch(ns, cases, seed):
+    """decide_batch su una lista di record con i parametri di default contro la cascata."""
+    rnd = random.Random(seed)
+    cfg = ns["CONFIG"]
+    states = [random_case(ns, rnd, cfg["params"])[0] for _ in range(cases)]
+    results = ns["decide_batch"]([ns["DECISION"]["decision_record"](s, cfg) for s in states])
+    mismatches = 0
+    for state, (rule_reason, amps, calc_reason, actions) in zip(states, results):
+        expected = run_cascade(ns, state, cfg)
+        got = (rule_reason, amps, calc_reason, tuple(a[1] for a in actions if a[0] == "hit"))
+        mismatches += got != expected[:4]
+    return mismatches
+
+
+def best_of(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_rows(ns, states, cfg):
+    determine, calculate = ns["determine_pause_reason"], ns["calculate_target_amps"]
+    compiled = ns["DECISION"]
+    decision_record, decide_pause, decide_amps = compiled["decision_record"], compiled["decide_pause"], compiled["decide_amps"]
+    apply_actions = ns["apply_decision_actions"]
+
+    def cascade():
+        for state in states:
+            if not determine(state, cfg):
+                calculate(state, cfg)
+
+    def table():
+        for state in states:
+            record = decision_record(state, cfg)
+            reason, actions = decide_pause(record)
+            apply_actions(actions)
+            if not reason:
+                amps, reason, actions = decide_amps(record)
+                apply_actions(actions)
+
+    def evaluate():
+        for record in records:
+            reason, actions = decide_pause(record)
+            if not reason:
+                decide_amps(record)
+
+    records = [decision_record(s, cfg) for s in states]
+    return best_of(cascade), best_of(table), best_of(evaluate), best_of(lambda: ns["decide_batch"](records))
+
+
+def bench(ns, cases, seed):
+    """
+    Tempo per stato con debug spento, come nel tick: cascata sullo stato; tabella con costruzione del record e
+    azioni (percorso di run_tick); sola valutazione compilata sul record, singola e con decide_batch.
+    Gli stati vengono divisi tra chiusi dalle regole di pausa (SCENARI 2-6) e arrivati al calcolo degli ampere.
+    """
+    rnd = random.Random(seed)
+    cfg = ns["CONFIG"]
+    states = [random_case(ns, rnd, cfg["params"])[0] for _ in range(cases)]
+    reset(ns, False)
+    paused = [s for s in states if ns["determine_pause_reason"](s, cfg)]
+    charging = [s for s in states if not ns["determine_pause_reason"](s, cfg)]
+    print(f"{'µs/stato':30s} {'cascata':>8s} {'tabella':>8s} {'valut.':>8s} {'batch':>8s}")
+    for name, group in (("tutti", states), ("pausa dalle regole", paused), ("calcolo ampere", charging)):
+        times = [elapsed / len(group) * 1e6 for elapsed in bench_rows(ns, group, cfg)]
+        ratios = " ".join(f"{times[0] / t:.2f}x" for t in times[1:])
+        print(f"{name + f' ({len(group)})':30s} " + " ".join(f"{t:8.2f}" for t in times) + f"   {ratios}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bench", action="store_true", help="misura i tempi invece di confrontare gli esiti")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    ns = load(FakeHass())
+    if args.bench:
+        bench(ns, args.cases, args.seed)
+        return
+    mismatches, impure, hits = check(ns, args.cases, args.seed)
+    batch = check_batch(ns, max(1, args.cases // 10), args.seed + 1)
+    print(f"scenari attraversati: {' '.join(f'{k}:{v}' for k, v in sorted(hits.items()))}")
+    print(f"tabella contro cascata: {mismatches} differenze su {args.cases} stati casuali")
+    print(f"valutazioni non pure: {impure}  batch: {batch} differenze")
+    sys.exit(1 if mismatches or impure or batch else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Wallbox Dynamic Controller - verifica dell'invio dei comandi (engine.CommandDispatcher)
+Esegue lo script sul hass finto con il dispatcher del runtime residente e servizi con latenza e guasti iniettati:
+- ordine: mode=normal parte solo dopo la conferma della corrente;
+- ripetizione: un errore transitorio sulla corrente viene ripetuto e la carica riparte;
+- errore permanente e timeout: la corrente non confermata ferma la catena, mode=normal non viene inviato e
+  lo store conta i comandi falliti;
+- stato stabile: con la wallbox che carica senza cambi e l'entità che, come in HA, non aggiorna last_updated
+  quando riceve lo stesso valore, dopo la ripresa parte solo una riaffermazione per comando ogni
+  command_reassert_seconds;
+- chiamate senza risposta: dopo più chiamate che non rispondono mai (più dei thread di catena) i comandi
+  successivi partono e vengono confermati subito;
+- fast-path durante l'attesa: mentre il tick attende la conferma lenta della corrente, WallboxEngine.guard
+  interviene senza aspettarlo, il mode=normal del tick non viene più inviato e coda, tempi per fase e traccia
+  del tick restano quelli del tick;
+- latenza: con due wallbox (due catene da due comandi) il tick con il dispatcher attende circa metà
+  dell'invio sequenziale di python_script.
+
+Uso:
+  python tools/dispatch_check.py [--call-latency-ms 20] [--iterations 10]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import NOW_TS, path_states  # noqa: E402
+from fakehass import FakeHass, load  # noqa: E402
+from engine import CommandDispatcher, WallboxEngine  # noqa: E402
+
+SLOW_CALL = 0.5     # secondi di una chiamata lenta ("slow")
+
+# Wallbox in pausa con sole pieno: la ripresa invia corrente e poi mode=normal (percorso scenario_17 di bench.py)
+RESUME = {"wallbox_set_mode": "paused", "wallbox_set_current": 6, "wallbox_power": 0, "home_power": 500,
+          "home_current": 2.2, "pv_primary_1": 5000, "pv_secondary": 3000}
+# Seconda wallbox: solo le sue entità di comando e potenza, il resto in comune
+SECOND = {"wallbox_set_mode": "select.second_set_mode", "wallbox_set_current": "number.second_set_max_current",
+          "wallbox_power": "sensor.second_output_power"}
+
+
+class FaultyServices:
+    """Servizi del hass finto con latenza, guasti per servizio e registro di inizio/fine di ogni chiamata."""
+
+    def __init__(self, services, latency=0.0):
+        self.services = services
+        self.latency = latency
+        self.faults = {}        # "domain.service" -> esiti: "error", "fatal", "hang", "never", "slow"
+        self.release = threading.Event()    # sblocca le chiamate "never" a fine prova
+        self.log = []
+        self.lock = threading.Lock()
+
+    def has_service(self, domain, service):
+        return False
+
+    def call(self, domain, service, data=None, blocking=False):
+        name = f"{domain}.{service}"
+        with self.lock:
+            faults = self.faults.get(name)
+            fault = faults.pop(0) if faults else None
+            self.log.append(("start", name, time.perf_counter()))
+        if fault == "hang":
+            # Nessuna risposta: la richiesta si perde e il dispositivo non cambia
+            time.sleep(1.0)
+            return True
+        if fault == "never":
+            # Nessuna risposta finché la prova non finisce (HA bloccato su quella chiamata)
+            self.release.wait()
+            return True
+        if self.latency:
+            time.sleep(self.latency)
+        if fault == "slow":
+            # Confermata, ma entro il timeout (command_timeout_seconds) solo di poco
+            time.sleep(SLOW_CALL)
+        if fault == "error":
+            raise RuntimeError(f"{name}: errore transitorio simulato")
+        if fault == "fatal":
+            raise KeyError(f"{name}: servizio inesistente")
+        self.services.call(domain, service, data)
+        with self.lock:
+            self.log.append(("end", name, time.perf_counter()))
+        return True
+
+
+class Harness:
+    def __init__(self, latency=0.0, dispatch=True, chargers=1):
+        logger = logging.getLogger("wallbox.dispatch_check")
+        logger.setLevel(logging.CRITICAL)
+        logger.propagate = False
+        self.now = NOW_TS
+        self.hass = FakeHass(clock=lambda: self.now)
+        self.services = FaultyServices(self.hass.services, latency)
+        self.hass.services = self.services
+        self.dispatcher = CommandDispatcher(lambda domain, service, data, timeout: self.services.call(domain, service, data),
+                                            sleep=lambda s: time.sleep(s / 100.0),
+                                            permanent=(KeyError,)) if dispatch else None
+        self.ns = load(self.hass, logger=logger, dispatcher=self.dispatcher)
+        # Orologio dello script e timestamp delle entità sullo stesso istante simulato
+        self.ns["TICK"]["now"] = self.now
+        cfg = self.ns["CONFIG"]
+        cfg["params"]["command_timeout_seconds"] = 0.2
+        if chargers > 1:
+            cfg["chargers"] = [{"name": "first"}, {"name": "second", "entities": SECOND}]
+        self.states = path_states(cfg, RESUME)
+        if chargers > 1:
+            self.states[SECOND["wallbox_set_mode"]] = ("paused", None)
+            self.states[SECOND["wallbox_set_current"]] = (6, None)
+            self.states[SECOND["wallbox_power"]] = (0, None)
+
+    def put(self, keep=None):
+        """Stati del caso; con keep restano gli stati esistenti e i sensori vengono riscritti (solo last_reported)."""
+        hass = self.hass
+        if keep is None:
+            hass.states.data = {}
+        for entity_id, (state, attributes) in self.states.items():
+            if not keep or entity_id not in keep:
+                hass.states.put(entity_id, state, attributes)
+
+    def tick(self):
+        self.put()
+        ns = self.ns
+        ns["CHARGERS"]["list"] = None
+        ns["CHARGER_STORES"].clear()
+        ns["STORE"].update({"loaded": False, "saved_ts": 0, "data": {}})
+        self.services.log = []
+        started = time.perf_counter()
+        ns["main"]()
+        return time.perf_counter() - started
+
+    def commands(self):
+        return self.ns["STORE"]["data"]["commands"]
+
+    def entity(self, key):
+        state = self.hass.states.data.get(self.ns["CONFIG"]["entities"][key])
+        return state.state if state is not None else None
+
+    def close(self):
+        self.services.release.set()
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+
+
+def check_order(h):
+    h.tick()
+    log = [(kind, name) for kind, name, _ in h.services.log]
+    current_end = log.index(("end", "number.set_value"))
+    mode_start = log.index(("start", "select.select_option"))
+    return [] if current_end < mode_start else [f"mode=normal partito prima della conferma della corrente: {log}"]
+
+
+def check_retry(h):
+    h.services.faults = {"number.set_value": ["error"]}
+    h.tick()
+    errors = []
+    if h.commands().get("retried") != 1 or h.commands().get("failed"):
+        errors.append(f"ripetizione: contatori {h.commands()}")
+    if h.entity("wallbox_set_mode") != "normal" or h.entity("wallbox_set_current") != "16":
+        errors.append(f"ripetizione: wallbox in {h.entity('wallbox_set_mode')} {h.entity('wallbox_set_current')}A")
+    return errors
+
+
+def check_stop(h, fault, label):
+    h.services.faults = {"number.set_value": [fault] * 5}
+    h.tick()
+    errors = []
+    if h.entity("wallbox_set_mode") != "paused":
+        errors.append(f"{label}: mode=normal inviato senza conferma della corrente")
+    if h.commands().get("failed") != 2:
+        errors.append(f"{label}: contatori {h.commands()}")
+    return errors
+
+
+def check_steady(h, duration=3000, step=10):
+    """Tick ogni step secondi sugli stessi stati: istanti (s) degli invii di corrente e modalità."""
+    cfg = h.ns["CONFIG"]
+    reassert = cfg["params"]["command_reassert_seconds"]
+    # Le entità di comando cambiano solo con i servizi; gli altri sensori vengono riportati a ogni tick
+    commands = [cfg["entities"]["wallbox_set_mode"], cfg["entities"]["wallbox_set_current"]]
+    h.put()
+    sends = {"number.set_value": [], "select.select_option": []}
+    for t in range(0, duration, step):
+        h.now = NOW_TS + t
+        h.ns["TICK"]["now"] = h.now
+        h.put(keep=commands)
+        h.services.log = []
+        h.ns["main"]()
+        for kind, name, _ in h.services.log:
+            if kind == "start" and name in sends:
+                sends[name].append(t)
+    expected = list(range(0, duration, reassert))
+    return [f"stato stabile: {name} inviato a {times} s invece di {expected} s"
+            for name, times in sends.items() if times != expected]
+
+
+def check_hung(h, ticks=4):
+    """Più chiamate bloccate che thread di catena, poi un tick senza guasti: i suoi comandi devono arrivare."""
+    attempts = ticks * (h.ns["CONFIG"]["params"]["command_retries"] + 1)
+    h.services.faults = {"number.set_value": ["never"] * attempts}
+    for _ in range(ticks):
+        h.tick()
+    errors = []
+    if h.services.faults["number.set_value"]:
+        errors.append(f"senza risposta: {len(h.services.faults['number.set_value'])} tentativi mai partiti")
+    h.tick()
+    if h.entity("wallbox_set_mode") != "normal" or h.entity("wallbox_set_current") != "16" or h.commands().get("failed"):
+        errors.append(f"senza risposta: dopo {attempts} chiamate bloccate wallbox in {h.entity('wallbox_set_mode')} "
+                      f"{h.entity('wallbox_set_current')}A, contatori {h.commands()}")
+    return errors
+
+
+# Campi di TICK del tick in attesa che il fast-path non deve toccare ("commands" è lo stesso dict dello store)
+TICK_FIELDS = ("debug", "device", "queue", "timing", "trace", "charger", "deferred", "track")
+
+
+def check_guard(h):
+    """Sovracorrente mentre il tick attende una conferma lenta: reazione, comandi inviati e contesto del tick."""
+    h.ns["CONFIG"]["params"]["command_timeout_seconds"] = SLOW_CALL * 2
+    engine = WallboxEngine(h.ns, clock=time.perf_counter)
+    # Debug acceso: il tick ha la sua traccia, che i messaggi del fast-path non devono allungare
+    h.states = path_states(h.ns["CONFIG"], RESUME, debug=True)
+    h.put()
+    h.services.faults = {"number.set_value": ["slow"]}
+    tick = threading.Thread(target=engine.tick)
+    tick.start()
+    time.sleep(SLOW_CALL / 10)
+    entities = h.ns["CONFIG"]["entities"]
+    h.hass.states.put(entities["home_current"], 60)
+    h.hass.states.put(entities["wallbox_power"], 3700)
+    waiting = {k: repr(h.ns["TICK"][k]) for k in TICK_FIELDS}
+    started = time.perf_counter()
+    result = engine.guard(started)
+    reaction = time.perf_counter() - started
+    changed = [k for k in TICK_FIELDS if repr(h.ns["TICK"][k]) != waiting[k]]
+    tick.join()
+    errors = []
+    if changed:
+        errors.append(f"fast-path: contesto del tick in attesa modificato ({', '.join(changed)})")
+    if result is None or not result[1]:
+        errors.append(f"fast-path: nessuna pausa ({result})")
+    if reaction > SLOW_CALL / 2:
+        errors.append(f"fast-path: {reaction * 1000:.0f} ms, in coda dietro la chiamata del tick")
+    if h.entity("wallbox_set_mode") != "paused":
+        errors.append("fast-path: mode=normal del tick inviato dopo la pausa")
+    return errors
+
+
+def latency(latency_s, iterations):
+    """Tempo del tick con due wallbox in ripresa: invio sequenziale contro dispatcher."""
+    times = {}
+    for label, dispatch in (("sequenziale (python_script)", False), ("dispatcher (residente)", True)):
+        h = Harness(latency_s, dispatch, chargers=2)
+        samples = sorted(h.tick() for _ in range(iterations))
+        calls = len([entry for entry in h.services.log if entry[0] == "start"])
+        h.close()
+        times[label] = (samples[len(samples) // 2], calls)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--call-latency-ms", type=float, default=20.0, help="latenza di ogni chiamata di servizio")
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    errors = []
+    for label, check in (("ordine", check_order), ("ripetizione", check_retry),
+                         ("errore permanente", lambda h: check_stop(h, "fatal", "errore permanente")),
+                         ("timeout", lambda h: check_stop(h, "hang", "timeout")),
+                         ("stato stabile", check_steady),
+                         ("senza risposta", check_hung),
+                         ("fast-path in attesa", check_guard)):
+        h = Harness()
+        found = check(h)
+        h.close()
+        print(f"{label:20s} {'ok' if not found else 'ERRORE'}")
+        errors.extend(found)
+    for error in errors:
+        print(f"  {error}")
+
+    print(f"\ntick con due wallbox in ripresa, {args.call_latency_ms:.0f} ms per chiamata:")
+    for label, (median, calls) in latency(args.call_latency_ms / 1000.0, args.iterations).items():
+        print(f"  {label:28s} {median * 1000:7.1f} ms  ({calls} chiamate)")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
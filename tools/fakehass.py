@@ -0,0 +1,116 @@
+"""
+Wallbox Dynamic Controller - hass finto in memoria
+Stati e servizi minimi usati da wallbox_charging_control.py, per provare lo script fuori da Home Assistant.
+I servizi select/number/input_number/persistent_notification aggiornano lo stato come farebbe HA: scrivere lo stesso
+stato con gli stessi attributi aggiorna solo last_reported, non last_updated/last_changed. Con clock (epoch) i
+timestamp seguono un orologio simulato invece di quello reale.
+Con read_latency / call_latency (secondi) ogni lettura di stato o chiamata di servizio attende come un hass reale sotto carico.
+"""
+import datetime
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(ROOT, "wallbox_charging_control.py")
+sys.path.insert(0, os.path.join(ROOT, "custom_components", "wallbox_control"))
+
+from engine import load_script  # noqa: E402
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeState:
+    def __init__(self, entity_id, state, attributes=None, ts=None):
+        self.entity_id = entity_id
+        self.state = str(state)
+        self.attributes = dict(attributes or {})
+        self.last_updated = ts or utcnow()
+        self.last_changed = self.last_updated
+        self.last_reported = self.last_updated
+
+
+class FakeStates:
+    def __init__(self, latency=0.0, clock=None):
+        self.data = {}
+        self.reads = 0
+        self.writes = 0
+        self.latency = latency
+        self.clock = clock
+
+    def get(self, entity_id):
+        self.reads += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.data.get(entity_id)
+
+    def set(self, entity_id, state, attributes=None, force_update=False):
+        self.writes += 1
+        self.write(entity_id, state, attributes, force_update)
+
+    def put(self, entity_id, state, attributes=None):
+        """Imposta uno stato senza contarlo come scrittura dello script."""
+        self.write(entity_id, state, attributes)
+
+    def write(self, entity_id, state, attributes=None, force_update=False):
+        ts = datetime.datetime.fromtimestamp(self.clock(), datetime.timezone.utc) if self.clock else utcnow()
+        new = FakeState(entity_id, state, attributes, ts)
+        old = self.data.get(entity_id)
+        if old is not None and old.state == new.state:
+            new.last_changed = old.last_changed
+            if old.attributes == new.attributes and not force_update:
+                new.last_updated = old.last_updated
+        self.data[entity_id] = new
+
+
+class FakeServices:
+    def __init__(self, states, latency=0.0):
+        self.states = states
+        self.calls = []
+        self.latency = latency
+
+    def has_service(self, domain, service):
+        return False
+
+    def call(self, domain, service, data=None, blocking=False):
+        data = dict(data or {})
+        self.calls.append((domain, service, data))
+        if self.latency:
+            time.sleep(self.latency)
+        if service == "set_value":
+            self.states.put(data["entity_id"], data["value"])
+        elif service == "select_option":
+            self.states.put(data["entity_id"], data["option"])
+        elif domain == "persistent_notification" and service == "create":
+            self.states.put(f"persistent_notification.{data['notification_id']}", "notifying", data)
+        elif domain == "persistent_notification" and service == "dismiss":
+            self.states.data.pop(f"persistent_notification.{data['notification_id']}", None)
+        return True
+
+
+class FakeBus:
+    def __init__(self):
+        self.events = []
+
+    def fire(self, event_type, event_data=None):
+        self.events.append((event_type, event_data))
+
+
+class FakeHass:
+    def __init__(self, read_latency=0.0, call_latency=0.0, clock=None):
+        self.states = FakeStates(read_latency, clock)
+        self.services = FakeServices(self.states, call_latency)
+        self.bus = FakeBus()
+
+    def reset_counters(self):
+        self.states.reads = 0
+        self.states.writes = 0
+        self.services.calls = []
+
+
+def load(hass, path=SCRIPT_PATH, logger=None, dispatcher=None):
+    """Namespace dello script caricato con il hass finto (main() non viene eseguito)."""
+    return load_script(path, hass, logger or logging.getLogger("wallbox"), dispatcher)
@@ -0,0 +1,277 @@
+"""
+Wallbox Dynamic Controller - regolatore PI contro anello aperto su un modello di auto e impianto
+Simula secondo per secondo produzione FTV, consumi domestici, batteria di casa e un'auto che assorbe meno della
+corrente comandata e segue i cambi con una rampa; ogni --tick secondi run_tick() dello script legge i sensori del
+modello e comanda la wallbox, una volta con regulator_mode "open_loop" e una con "pi" (batteria di casa al 75%,
+quindi la potenza viene da SCENARIO 12b).
+Lo scambio è la potenza che l'auto non assorbe: FTV - casa - wallbox (> 0 surplus lasciato a batteria/rete,
+< 0 auto alimentata da batteria/rete). Per ogni profilo: kWh alla EV, kWh di surplus non usato e di prelievo,
+scambio medio, p5/p95 dello scambio, tempo in prelievo e comandi inviati.
+
+Profili:
+- sereno: sole pieno, consumi di base, l'auto assorbe il 93% della corrente comandata;
+- nuvole: passaggi di nuvole e elettrodomestici che si accendono e spengono;
+- limitata: per 40 minuti l'auto si limita da sola a 10A (il regolatore non deve caricare l'integrale) e poi
+  torna a seguire il comando.
+
+Uso:
+  python tools/regulator_sim.py [--tick 45] [--hours 4] [--seed 3] [--set parametro=valore ...]
+  python tools/regulator_sim.py --check     esce con 1 se il PI non fa meglio dell'anello aperto (vedi check())
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakehass import FakeHass, load  # noqa: E402
+from replay import parse_overrides  # noqa: E402
+
+START = 1781517600.0 + 10 * 3600      # 10:00 ora locale circa, sole alto
+PV_PEAK = 4000.0
+BATT_MAX = 3000.0
+PROFILES = ("sereno", "nuvole", "limitata")
+
+
+class Plant:
+    """
+    Impianto secondo per secondo. L'auto accetta min(comandata, limite dell'auto), ci arriva con una rampa di
+    ev_ramp A/s dopo un ritardo di ev_delay s e assorbe draw volte la corrente accettata alla tensione reale.
+    La batteria di casa assorbe lo scambio entro ±BATT_MAX, il resto va in rete.
+    """
+
+    def __init__(self, profile, seed, hours):
+        rnd = random.Random(f"{profile}:{seed}")
+        self.profile = profile
+        self.hours = hours
+        self.draw = 0.93
+        self.ev_ramp = 1.0
+        self.ev_delay = 2
+        self.pv = 0.0
+        self.ev_amps = 0.0
+        self.commands = []           # (secondo da cui vale, ampere comandati o 0 in pausa)
+        self.mode = "paused"
+        self.current = 6.0
+        # Nuvole: (inizio, durata, attenuazione); elettrodomestici: (inizio, durata, potenza)
+        span = int(hours * 3600)
+        self.clouds = []
+        self.loads = []
+        if profile == "nuvole":
+            t = 0
+            while t < span:
+                t += int(rnd.expovariate(1 / 500.0))
+                self.clouds.append((t, rnd.randint(60, 600), rnd.uniform(0.3, 0.7)))
+            t = 0
+            while t < span:
+                t += int(rnd.expovariate(1 / 900.0))
+                self.loads.append((t, rnd.randint(120, 1200), rnd.choice((800.0, 1500.0, 2000.0))))
+        self.car_limit = [(0, 16.0)]
+        if profile == "limitata":
+            self.car_limit = [(0, 16.0), (span // 3, 10.0), (span // 3 + 2400, 16.0)]
+        self.noise = rnd
+
+    def pv_target(self, t):
+        clear = PV_PEAK * (0.7 + 0.3 * math.cos(2 * math.pi * (t / (self.hours * 3600.0) - 0.5)))
+        for start, length, cut in self.clouds:
+            if start <= t < start + length:
+                return clear * (1 - cut)
+        return clear
+
+    def domestic(self, t):
+        power = 350.0 + (120.0 if (t // 600) % 3 else 0.0)     # base e frigorifero
+        for start, length, watts in self.loads:
+            if start <= t < start + length:
+                power += watts
+        return power
+
+    def voltage(self, t):
+        return 231.0 + 3.0 * math.sin(t / 1800.0) + self.noise.uniform(-0.5, 0.5)
+
+    def limit(self, t):
+        value = 16.0
+        for start, amps in self.car_limit:
+            if t >= start:
+                value = amps
+        return value
+
+    def step(self, t):
+        # Primo ordine sul sole (le nuvole passano in una decina di secondi)
+        self.pv = self.pv + (self.pv_target(t) - self.pv) * 0.1 if t else self.pv_target(t)
+        accepted = 0.0
+        for start, amps in self.commands:
+            if t >= start:
+                accepted = amps
+        accepted = min(accepted, self.limit(t))
+        delta = accepted - self.ev_amps
+        self.ev_amps += max(-self.ev_ramp, min(self.ev_ramp, delta))
+        voltage = self.voltage(t)
+        ev = self.ev_amps * self.draw * voltage
+        home = self.domestic(t)
+        exchange = self.pv - home - ev
+        batt = -max(-BATT_MAX, min(BATT_MAX, exchange))     # > 0 = scarica
+        return {"voltage": voltage, "pv": self.pv, "home": home, "ev": ev, "batt": batt, "exchange": exchange}
+
+    def command(self, t, mode=None, current=None):
+        if mode is not None:
+            self.mode = mode
+        if current is not None:
+            self.current = current
+        self.commands.append((t + self.ev_delay, self.current if self.mode == "normal" else 0.0))
+
+
+class PlantServices:
+    """Servizi del hass finto: i comandi alla wallbox vanno al modello con il ritardo dell'auto."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.calls = 0
+
+    def has_service(self, domain, service):
+        return False
+
+    def call(self, domain, service, data=None, blocking=False):
+        sim = self.sim
+        entity_id = (data or {}).get("entity_id")
+        if entity_id == sim.entities["wallbox_set_mode"]:
+            self.calls += 1
+            sim.plant.command(sim.t, mode=data["option"])
+            sim.device["wallbox_mode"] = data["option"]
+            sim.device["wallbox_mode_ts"] = sim.now
+        elif entity_id == sim.entities["wallbox_set_current"]:
+            self.calls += 1
+            sim.plant.command(sim.t, current=float(data["value"]))
+            sim.device["wallbox_current_set"] = float(data["value"])
+            sim.device["wallbox_current_ts"] = sim.now
+        return True
+
+
+class Simulation:
+    def __init__(self, profile, mode, seed, hours, params):
+        logger = logging.getLogger("wallbox.regulator_sim")
+        logger.setLevel(logging.ERROR)
+        logger.propagate = False
+        self.hass = FakeHass()
+        self.hass.services = PlantServices(self)
+        self.ns = load(self.hass, logger=logger)
+        cfg = self.ns["CONFIG"]
+        cfg["params"].update(params)
+        cfg["params"]["regulator_mode"] = mode
+        self.entities = cfg["entities"]
+        self.plant = Plant(profile, seed, hours)
+        self.hours = hours
+        self.t = 0
+        self.now = START
+        self.device = {"wallbox_mode": "paused", "wallbox_mode_ts": START - 3600, "wallbox_current_set": 6.0,
+                       "wallbox_current_ts": START - 3600}
+        snap = {f[0]: f[4] for f in self.ns["SNAPSHOT_FIELDS"]}
+        snap.update({"wallbox_state": "charging", "batt_max_discharge": BATT_MAX, "soc_attuale": 75.0, "soc_min": 20.0,
+                     "soc_priority": 60.0, "min_charge_amps": 6.0, "max_charge_amps": 16.0, "home_max_current": 40.0,
+                     "ev_soc": 50.0, "ev_target": 100.0, "sun_elevation": 45.0, "sun_rising": True,
+                     "elevation_limit": 10.0, "batt_priority_ratio": 50.0})
+        self.snap = snap
+
+    def tick(self, sample):
+        snap = self.snap
+        local = time.localtime(self.now)
+        snap.update(self.device)
+        snap["timestamp"] = self.now
+        snap["time"] = time.strftime("%H:%M:%S", local)
+        snap["date_time_iso"] = time.strftime("%Y-%m-%dT%H:%M:%S", local)
+        snap["voltage"] = round(sample["voltage"], 1)
+        # Tre stringhe con il secondo inverter acceso (niente stimolo dell'inverter secondario)
+        snap["pv1"] = round(sample["pv"] * 0.4, 1)
+        snap["pv2"] = round(sample["pv"] * 0.3, 1)
+        snap["pv_secondary"] = round(sample["pv"] * 0.3, 1)
+        snap["home_power"] = round(sample["home"] + sample["ev"], 1)
+        snap["home_current"] = round(snap["home_power"] / sample["voltage"], 2)
+        snap["wallbox_power"] = round(sample["ev"], 1)
+        snap["batt_power"] = round(sample["batt"], 1)
+        ns = self.ns
+        ns["TICK"]["now"] = self.now
+        ns["run_tick"](snap, ns["PERF_CLOCK"]())
+
+    def run(self, tick):
+        span = int(self.hours * 3600)
+        exchange = []
+        totals = {"ev_wh": 0.0, "unused_wh": 0.0, "import_wh": 0.0}
+        sample = self.plant.step(0)
+        for t in range(span):
+            self.t = t
+            self.now = START + t
+            if t % tick == 0:
+                self.tick(sample)
+            sample = self.plant.step(t)
+            totals["ev_wh"] += sample["ev"] / 3600.0
+            # Solo a carica avviata: lo scambio prima del primo comando non dipende dal regolatore
+            if self.plant.ev_amps > 0:
+                exchange.append(sample["exchange"])
+                if sample["exchange"] > 0:
+                    totals["unused_wh"] += sample["exchange"] / 3600.0
+                else:
+                    totals["import_wh"] -= sample["exchange"] / 3600.0
+        exchange.sort()
+        n = len(exchange) or 1
+        reg = self.ns["STORE"]["data"].get("regulator", {})
+        return {
+            "ev_kwh": totals["ev_wh"] / 1000.0,
+            "unused_kwh": totals["unused_wh"] / 1000.0,
+            "import_kwh": totals["import_wh"] / 1000.0,
+            "mean_w": sum(exchange) / n,
+            "p5_w": exchange[int(0.05 * (n - 1))] if exchange else 0.0,
+            "p95_w": exchange[int(0.95 * (n - 1))] if exchange else 0.0,
+            "import_share": len([x for x in exchange if x < 0]) / float(n),
+            "commands": self.hass.services.calls,
+            "integral_w": reg.get("i", 0.0),
+        }
+
+
+def check(profile, base, pi):
+    """Esiti attesi del PI rispetto all'anello aperto sullo stesso profilo (lista vuota = ok)."""
+    errors = []
+    # Meno surplus inutilizzato, senza prelevare in più più della metà di quanto recupera
+    if pi["unused_kwh"] >= base["unused_kwh"]:
+        errors.append(f"{profile}: surplus non usato {pi['unused_kwh']:.2f} kWh contro {base['unused_kwh']:.2f} ad anello aperto")
+    if pi["import_kwh"] - base["import_kwh"] > 0.5 * (base["unused_kwh"] - pi["unused_kwh"]):
+        errors.append(f"{profile}: prelievo {pi['import_kwh']:.2f} kWh contro {base['import_kwh']:.2f} ad anello aperto")
+    # Con sole stabile lo scambio sta in una banda più stretta e più vicina a zero
+    if profile == "sereno" and (pi["p95_w"] - pi["p5_w"] >= base["p95_w"] - base["p5_w"] or abs(pi["mean_w"]) >= abs(base["mean_w"])):
+        errors.append(f"{profile}: banda p5-p95 {pi['p5_w']:.0f}..{pi['p95_w']:.0f}W, media {pi['mean_w']:.0f}W")
+    # Anti-windup: quando l'auto torna a seguire il comando non c'è un picco di prelievo
+    if profile == "limitata" and pi["p5_w"] < base["p5_w"] - 50:
+        errors.append(f"{profile}: p5 {pi['p5_w']:.0f}W contro {base['p5_w']:.0f}W ad anello aperto (windup)")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tick", type=int, default=45, help="secondi tra due tick (time_pattern dell'automazione)")
+    parser.add_argument("--hours", type=float, default=4.0)
+    parser.add_argument("--seed", type=int, default=3)
+    parser.add_argument("--set", action="append", default=[], metavar="PARAMETRO=VALORE")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+    params = parse_overrides(args.set)
+
+    errors = []
+    print(f"{'profilo':10s} {'modo':10s} {'EV kWh':>7s} {'non usati':>9s} {'prelievo':>8s} {'medio W':>8s} "
+          f"{'p5 W':>7s} {'p95 W':>7s} {'prelievo %':>10s} {'comandi':>7s}")
+    for profile in PROFILES:
+        results = {}
+        for mode in ("open_loop", "pi"):
+            r = Simulation(profile, mode, args.seed, args.hours, params).run(args.tick)
+            results[mode] = r
+            print(f"{profile:10s} {mode:10s} {r['ev_kwh']:7.2f} {r['unused_kwh']:9.2f} {r['import_kwh']:8.2f} "
+                  f"{r['mean_w']:8.0f} {r['p5_w']:7.0f} {r['p95_w']:7.0f} {r['import_share'] * 100:9.1f}% {r['commands']:7d}")
+        errors.extend(check(profile, results["open_loop"], results["pi"]))
+    for error in errors:
+        print(f"  {error}")
+    if args.check:
+        sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,864 @@
+"""
+Wallbox Dynamic Controller - simulatore offline su storico registrato
+Riproduce uno storico delle entità di CONFIG["entities"] attraverso le funzioni decisionali dello script,
+senza modifiche, con un hass finto e un modello semplificato di wallbox, batteria e rete.
+
+Uso:
+  python tools/replay.py storico.csv [--tick 45] [--set parametro=valore ...]
+  python tools/replay.py home-assistant_v2.db [--start 2026-01-01] [--end 2027-01-01]
+  python tools/replay.py --demo [--demo-days 365 --demo-step 10] [--fast [--max-skip 240]]
+
+Sorgenti (lette in streaming, un evento alla volta):
+- CSV "largo": colonna "timestamp" (epoch o ISO 8601) e una colonna per entity_id; gli attributi si indicano
+  come "entity_id:attributo" (es. "sun.sun:elevation").
+- CSV esportato dalla cronologia di HA: colonne entity_id, state, last_changed (ordinato per tempo
+  oppure a blocchi per entità, come lo scarica il frontend).
+- Database SQLite del recorder (schema con states_meta, HA 2023.4 e successivi).
+
+Il controllore viene eseguito ogni --tick secondi di tempo simulato con sample-and-hold degli ultimi valori;
+le energie vengono integrate ad ogni evento. Metriche: kWh alla EV, import dalla rete (simulato e registrato),
+scarica batteria dovuta alla wallbox, energia alla EV per fonte secondo la contabilità dello script, cicli
+pausa/ripresa, rinvii anti-flap e comandi.
+
+Prestazioni (un processo, --demo a 10 s: FTV con nuvole che cambia a ogni campione, il caso peggiore per --fast):
+un anno (18,9 milioni di eventi, 700.800 tick a 45 s) richiede circa 140 s, per più di metà nel tick del controllore.
+Gli eventi delle entità lette dal solo stato riusano i valori già convertiti, quelle che non servono al modello
+impianto vengono convertite solo prima del tick e il sensore di stato (come tempi per fase e diagnostica) non viene
+calcolato. Con --fast un tick viene saltato, tenendo i comandi del tick precedente, se gli ingressi non si sono mossi
+oltre le bande morte del sensore di stato rispetto all'ultimo tick eseguito; dopo un cambio di modalità, con una
+transizione rimandata e comunque ogni --max-skip secondi il tick gira. Sullo stesso anno salta il 47% dei tick e
+richiede circa 110 s, con kWh alla EV, import dalla rete e scarica batteria entro lo 0,05% e cicli pausa/ripresa entro
+lo 0,3%; i kWh per fonte contati dallo script integrano solo i tick eseguiti e con --fast non sono attendibili. Con
+storici reali (HA registra un valore solo quando cambia) i tick saltati sono di più. Il limite resta il costo per evento
+in Python (circa 2 µs con lettura e modello impianto): qualche secondo per un anno non è raggiungibile in un processo.
+--workers divide lo storico per giorni tra i processi, quindi il tempo scende circa in proporzione ai core.
+"""
+import argparse
+import csv
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakehass import FakeHass, load  # noqa: E402
+
+# Valori iniziali per chiave di CONFIG["entities"] (helper e sensori assenti dallo storico)
+DEFAULTS = {
+    "debug_mode": "off",
+    "voltage": 230,
+    "wallbox_state": "charging",
+    "wallbox_set_mode": "paused",
+    "wallbox_set_current": 6,
+    "pv_primary_1": 0,
+    "pv_primary_2": 0,
+    "pv_secondary": 0,
+    "pv_losses": 0,
+    "batt_power": 0,
+    "batt_max_discharge": 3000,
+    "batt_soc": 80,
+    "batt_soc_min": 20,
+    "batt_soc_priority": 60,
+    "batt_protection_cycles": 0,
+    "min_charge_amps": 6,
+    "max_charge_amps": 16,
+    "force_charge": "off",
+    "home_power": 400,
+    "home_current": 2,
+    "home_max_current": 32,
+    "wallbox_power": 0,
+    "ev_soc": 50,
+    "ev_target_soc": 100,
+    "ev_soc_emergenza": 0,
+    "pause_start_time": "00:00:00",
+    "pause_end_time": "00:00:00",
+    "sun_elevation_threshold": 10,
+    "battery_priority_ratio": 50,
+    "last_wallbox_current": 0,
+    "grid": "on",
+}
+
+# Campi dello snapshot prodotti dal modello (valori simulati) o dall'orologio simulato
+PLANT_FIELDS = ("home_power", "home_current", "wallbox_power", "batt_power")
+DEVICE_FIELDS = ("wallbox_mode", "wallbox_mode_ts", "wallbox_current_set", "wallbox_current_ts")
+# Campi non presi dallo storico: orologio simulato e store del controllore (la simulazione parte da zero)
+SKIP_FIELDS = ("timestamp", "time", "date_time_iso", "store") + DEVICE_FIELDS
+# Tempi per fase e sensore diagnostico non entrano nelle decisioni: spenti per non pesare su ogni tick simulato
+# (--set li riattiva)
+REPLAY_PARAMS = {"timing_window": 0, "diagnostics_publish_seconds": 1e12}
+# Valori registrati usati dal modello impianto
+RECORDED_FIELDS = PLANT_FIELDS + ("voltage", "wallbox_state", "pv1", "pv2", "pv_secondary", "pv_losses",
+                                  "soc_attuale", "soc_min", "batt_max_discharge")
+
+# Tipi di campo convertiti dal solo stato dell'entità (senza attributi né timestamp)
+STATE_KINDS = ("float", "bool", "str", "float_opt")
+# Valori convertiti ricordati per entità (svuotati oltre questa soglia: storici con letture sempre diverse)
+MEMO_SIZE = 4096
+
+# --fast: un tick viene saltato (restano i comandi del tick precedente) se gli ingressi non si sono mossi oltre le
+# bande morte del sensore di stato rispetto all'ultimo tick eseguito; gli altri campi devono essere identici
+FAST_DEADBANDS = {
+    "pv1": "status_deadband_watts",
+    "pv2": "status_deadband_watts",
+    "pv_secondary": "status_deadband_watts",
+    "pv_losses": "status_deadband_watts",
+    "batt_power": "status_deadband_watts",
+    "home_power": "status_deadband_watts",
+    "wallbox_power": "status_deadband_watts",
+    "home_current": "status_deadband_amps",
+    "soc_attuale": "status_deadband_percent",
+    "ev_soc": "status_deadband_percent",
+}
+FAST_ELEVATION_DEGREES = 1.0
+# Campi dello snapshot che non entrano nel confronto: orologio simulato e store
+FAST_IGNORED = ("timestamp", "time", "date_time_iso", "store")
+# Distanza massima tra due tick eseguiti (s): sotto regulator_reset_seconds, min_charge_seconds e heartbeat
+FAST_MAX_SKIP = 240
+
+# Sopra questa distanza tra due eventi lo storico ha un buco: niente integrazione energetica
+MAX_GAP_SECONDS = 3600
+# Con più worker ogni blocco parte un giorno prima per arrivare al suo inizio con filtri e anti-flap a regime
+WARMUP_SECONDS = 86400
+
+
+# === SORGENTI (eventi in ordine di tempo: ts, entity_id, stato o None, attributi o None) ===
+
+def parse_ts(value):
+    try:
+        return float(value)
+    except ValueError:
+        ts = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if ts.tzinfo is None:
+            ts = ts.astimezone()
+        return ts.timestamp()
+
+
+def read_wide_csv(path):
+    """CSV largo: una riga per campione, emette solo le colonne cambiate rispetto alla riga precedente."""
+    with open(path, newline="", encoding="utf8") as fil:
+        reader = csv.reader(fil)
+        header = next(reader)
+        ts_col = header.index("timestamp")
+        columns = []
+        for i, name in enumerate(header):
+            if i != ts_col:
+                entity_id, _, attribute = name.partition(":")
+                columns.append((i, entity_id, attribute or None))
+        last = [None] * len(header)
+        for row in reader:
+            ts = parse_ts(row[ts_col])
+            for i, entity_id, attribute in columns:
+                value = row[i]
+                if value == "" or value == last[i]:
+                    continue
+                last[i] = value
+                if attribute:
+                    yield ts, entity_id, None, {attribute: value}
+                else:
+                    yield ts, entity_id, value, None
+
+
+def read_history_csv(path):
+    """CSV della cronologia di HA (entity_id, state, last_changed)."""
+    blocks = []
+    ordered = True
+    last_ts = None
+    with open(path, newline="", encoding="utf8") as fil:
+        fil.readline()
+        current = None
+        while True:
+            offset = fil.tell()
+            line = fil.readline()
+            if not line:
+                break
+            entity_id, _, rest = line.partition(",")
+            if entity_id != current:
+                blocks.append((entity_id, offset))
+                current = entity_id
+            ts = parse_ts(rest.rstrip("\r\n").rpartition(",")[2])
+            if last_ts is not None and ts < last_ts:
+                ordered = False
+            last_ts = ts
+    if ordered:
+        return history_block(path, 0, None)
+    if len(set(b[0] for b in blocks)) != len(blocks):
+        raise ValueError(f"{path}: righe né ordinate per tempo né raggruppate per entità")
+    # Export a blocchi per entità: un cursore per blocco e merge per timestamp
+    return heapq.merge(*[history_block(path, offset, entity_id) for entity_id, offset in blocks], key=lambda ev: ev[0])
+
+
+def history_block(path, offset, entity_id):
+    with open(path, newline="", encoding="utf8") as fil:
+        if offset:
+            fil.seek(offset)
+        else:
+            fil.readline()
+        for row in csv.reader(fil):
+            if entity_id is not None and row[0] != entity_id:
+                break
+            yield parse_ts(row[2]), row[0], row[1], None
+
+
+def read_recorder(path, entity_ids, attr_entity_ids, start=None, end=None):
+    """
+    Database del recorder: un solo cursore ordinato per last_updated_ts, attributi solo dove servono.
+    Con start viene emesso prima l'ultimo stato di ogni entità precedente a start (helper che cambiano di rado).
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    marks = ",".join("?" * len(entity_ids))
+    attr_marks = ",".join("?" * len(attr_entity_ids)) or "NULL"
+    select = (
+        "SELECT s.last_updated_ts, m.entity_id, s.state, a.shared_attrs FROM states s "
+        "JOIN states_meta m ON s.metadata_id = m.metadata_id "
+        f"LEFT JOIN state_attributes a ON s.attributes_id = a.attributes_id AND m.entity_id IN ({attr_marks}) "
+    )
+    try:
+        if start:
+            query = select + (
+                "WHERE s.state_id IN (SELECT MAX(s2.state_id) FROM states s2 JOIN states_meta m2 "
+                f"ON s2.metadata_id = m2.metadata_id WHERE m2.entity_id IN ({marks}) AND s2.last_updated_ts < ? "
+                "GROUP BY s2.metadata_id)"
+            )
+            for ts, entity_id, state, attrs in conn.execute(query, list(attr_entity_ids) + list(entity_ids) + [start]):
+                yield ts, entity_id, state, json.loads(attrs) if attrs else None
+        query = select + f"WHERE m.entity_id IN ({marks}) AND s.last_updated_ts >= ? AND s.last_updated_ts < ? ORDER BY s.last_updated_ts"
+        args = list(attr_entity_ids) + list(entity_ids) + [start or 0, end or 1e12]
+        for ts, entity_id, state, attrs in conn.execute(query, args):
+            yield ts, entity_id, state, json.loads(attrs) if attrs else None
+    finally:
+        conn.close()
+
+
+def recorder_span(path, entity_ids):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        marks = ",".join("?" * len(entity_ids))
+        first, last = conn.execute(
+            "SELECT MIN(s.last_updated_ts), MAX(s.last_updated_ts) FROM states s "
+            f"JOIN states_meta m ON s.metadata_id = m.metadata_id WHERE m.entity_id IN ({marks})", list(entity_ids)).fetchone()
+    finally:
+        conn.close()
+    if first is None:
+        raise ValueError(f"{path}: nessuno stato registrato per le entità di CONFIG")
+    return first, last + 1
+
+
+def demo_events(start_day=0, days=1, step=45, seed=7):
+    """Storico sintetico: PV a campana con passaggi di nuvole, consumi domestici con picchi (un seme per giorno)."""
+    origin = datetime.datetime(2026, 6, 15).astimezone().timestamp()
+    per_day = int(86400 / step)
+    for day in range(start_day, start_day + days):
+        rnd = random.Random(seed * 100003 + day)
+        # Mezzogiorno solare alle 13:30, tramonto alle 21:00 (di oggi e di domani), come gli attributi di sun.sun
+        midnight = origin + day * 86400
+        sun_times = [datetime.datetime.fromtimestamp(midnight + offset * 3600).astimezone().isoformat()
+                     for offset in (13.5, 37.5, 21, 45)]
+        for i in range(per_day):
+            ts = origin + day * 86400 + i * step
+            hour = i * step / 3600.0
+            day_angle = math.pi * (hour - 6) / 15
+            pv = max(0.0, 6500 * math.sin(day_angle)) if 6 <= hour <= 21 else 0.0
+            if pv and rnd.random() < 0.3:
+                pv *= rnd.uniform(0.2, 0.5)
+            home = 350 + (1800 if rnd.random() < 0.05 else 0)
+            yield ts, "sensor.deyeha_pv1_power", str(round(pv * 0.5)), None
+            yield ts, "sensor.deyeha_pv2_power", str(round(pv * 0.3)), None
+            yield ts, "sensor.inverter_lcd_pv_power", str(round(pv * 0.2)), None
+            yield ts, "sensor.green_power", str(home), None
+            yield ts, "sensor.green_current", str(round(home / 230.0, 2)), None
+            yield ts, "sun.sun", None, {"elevation": round(60 * math.sin(day_angle), 1), "rising": hour < 13.5,
+                                        "next_noon": sun_times[hour >= 13.5], "next_setting": sun_times[2 + (hour >= 21)]}
+
+
+def until(events, end):
+    if end is None:
+        return events
+    return until_end(events, end)
+
+
+def until_end(events, end):
+    for ev in events:
+        if ev[0] >= end:
+            return
+        yield ev
+
+
+class Source:
+    """
+    Sorgente dello storico ricostruibile in un processo worker (solo tipo e argomenti vengono serializzati).
+    events(start, end) restituisce gli eventi fino a end; quelli prima di start servono solo a ricostruire
+    lo stato iniziale e le sorgenti che lo permettono li riducono all'ultimo valore per entità.
+    """
+
+    def __init__(self, kind, path=None, entities=(), attr_entities=(), days=1, step=45):
+        self.kind = kind
+        self.path = path
+        self.entities = tuple(entities)
+        self.attr_entities = tuple(attr_entities)
+        self.days = days
+        self.step = step
+
+    def span(self):
+        if self.kind == "demo":
+            origin = next(demo_events(0, 1, self.step))[0]
+            return origin, origin + self.days * 86400
+        if self.kind == "recorder":
+            return recorder_span(self.path, self.entities)
+        with open(self.path, "rb") as fil:
+            fil.readline()
+            first = fil.readline().decode("utf8")
+            fil.seek(max(0, os.path.getsize(self.path) - 4096))
+            last = fil.read().decode("utf8", "ignore").strip().splitlines()[-1]
+        if self.kind == "history":
+            return parse_ts(first.strip().rpartition(",")[2]), parse_ts(last.rpartition(",")[2]) + 1
+        return parse_ts(first.partition(",")[0]), parse_ts(last.partition(",")[0]) + 1
+
+    def events(self, start=None, end=None):
+        if self.kind == "demo":
+            origin = self.span()[0]
+            first_day = max(0, int(((start or origin) - origin) // 86400))
+            last_day = self.days if end is None else min(self.days, int(math.ceil((end - origin) / 86400)))
+            return until(demo_events(first_day, last_day - first_day, self.step), end)
+        if self.kind == "recorder":
+            return read_recorder(self.path, self.entities, self.attr_entities, start, end)
+        if self.kind == "history":
+            return until(read_history_csv(self.path), end)
+        return until(read_wide_csv(self.path), end)
+
+
+def open_source(path, entity_fields):
+    """entity_fields: {entity_id: campi dello snapshot} per scegliere entità e attributi da leggere."""
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        attrs = [eid for eid, fields in entity_fields.items() if any(f[3] for f in fields)]
+        return Source("recorder", path, sorted(entity_fields), sorted(attrs))
+    with open(path, newline="", encoding="utf8") as fil:
+        header = fil.readline().strip().split(",")
+    if header[:2] == ["entity_id", "state"]:
+        return Source("history", path)
+    if header[0] != "timestamp":
+        raise ValueError(f"{path}: la prima colonna del CSV deve essere 'timestamp'")
+    return Source("wide", path)
+
+
+# === MODELLO IMPIANTO ===
+
+class Holder:
+    """Oggetto stato riutilizzato per passare i valori registrati ai parser dello script."""
+    state = ""
+    attributes = {}
+    last_updated = None
+
+
+class Plant:
+    """
+    Modello semplificato di wallbox, batteria e rete a partire dai valori registrati.
+    La wallbox assorbe subito la corrente comandata se non è in pausa e il connettore è collegato.
+    La potenza in più rispetto alla wallbox registrata riduce prima l'export, poi viene coperta dalla batteria
+    (entro la scarica massima e sopra il SOC minimo) e infine dalla rete; la potenza in meno riduce prima
+    l'import dalla rete, poi va in batteria (o in export a batteria piena).
+    Il SOC della batteria non viene simulato: si usa quello registrato.
+    Convenzioni: batt_power > 0 = scarica, rete = consumi casa - PV - batteria (> 0 = import).
+    """
+
+    def __init__(self):
+        self.wallbox = 0.0
+        self.batt = 0.0
+        self.grid = 0.0
+        self.grid_rec = 0.0
+        self.batt_wallbox = 0.0
+
+    @staticmethod
+    def split(delta, batt, grid, batt_max, batt_available, batt_full):
+        if delta >= 0:
+            from_export = min(delta, max(0.0, -grid))
+            rest = delta - from_export
+            from_batt = min(rest, max(0.0, batt_max - batt)) if batt_available else 0.0
+            return batt + from_batt, grid + from_export + rest - from_batt
+        rest = -delta
+        from_grid = min(rest, max(0.0, grid))
+        rest = rest - from_grid
+        to_batt = 0.0 if batt_full else rest
+        return batt - to_batt, grid - from_grid - (rest - to_batt)
+
+    def update(self, rec, snap):
+        voltage = rec["voltage"] if rec["voltage"] > 0 else 230.0
+        amps = 0.0
+        if snap["wallbox_mode"] != "paused" and rec["wallbox_state"] != "idle":
+            amps = snap["wallbox_current_set"] or 0.0
+        wallbox = amps * voltage
+        pv = max(0.0, rec["pv1"] + rec["pv2"] + rec["pv_secondary"] - rec["pv_losses"])
+        home_rec = rec["home_power"]
+        batt_rec = rec["batt_power"]
+        grid_rec = home_rec - pv - batt_rec
+        args = (rec["batt_max_discharge"], rec["soc_attuale"] > rec["soc_min"], rec["soc_attuale"] >= 99.0)
+        batt, grid = self.split(wallbox - rec["wallbox_power"], batt_rec, grid_rec, *args)
+        # Controfattuale senza wallbox: la scarica in più rispetto a questo caso è dovuta alla wallbox
+        batt_none = self.split(-rec["wallbox_power"], batt_rec, grid_rec, *args)[0] if rec["wallbox_power"] else batt_rec
+        self.wallbox = wallbox
+        self.batt = batt
+        self.grid = grid
+        self.grid_rec = grid_rec
+        self.batt_wallbox = max(0.0, batt) - max(0.0, batt_none)
+        snap["wallbox_power"] = wallbox
+        snap["batt_power"] = batt
+        snap["home_power"] = home_rec - rec["wallbox_power"] + wallbox
+        snap["home_current"] = rec["home_current"] + (wallbox - rec["wallbox_power"]) / voltage
+
+
+class SimServices:
+    """
+    Servizi del hass finto: i comandi alla wallbox aggiornano direttamente lo snapshot simulato. Come in HA il
+    timestamp dell'entità cambia solo se cambia il valore (la stessa opzione inviata di nuovo non lo aggiorna).
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.calls = 0
+
+    def has_service(self, domain, service):
+        return False
+
+    def call(self, domain, service, data=None, blocking=False):
+        self.calls += 1
+        sim = self.sim
+        entity_id = (data or {}).get("entity_id")
+        if entity_id == sim.entities["wallbox_set_mode"]:
+            if sim.snap["wallbox_mode"] != data["option"]:
+                sim.snap["wallbox_mode"] = data["option"]
+                sim.snap["wallbox_mode_ts"] = sim.now
+        elif entity_id == sim.entities["wallbox_set_current"]:
+            if sim.snap["wallbox_current_set"] != float(data["value"]):
+                sim.snap["wallbox_current_set"] = float(data["value"])
+                sim.snap["wallbox_current_ts"] = sim.now
+        elif entity_id == sim.entities["batt_protection_cycles"]:
+            sim.snap["batt_protection_cycles"] = float(data["value"])
+        elif domain == "persistent_notification":
+            sim.notifications += 1
+        return True
+
+
+# === SIMULATORE ===
+
+def skip_status_sensor(final_amps, pause_mode, pause_reason, state_data, cfg):
+    pass
+
+
+def make_parser(ns, entity_id, field):
+    """Parser dello script (stesse conversioni e default di read_snapshot) per un campo dello snapshot."""
+    _, _, kind, attribute, default = field
+    if kind == "float":
+        parse_float = ns["parse_float"]
+        return lambda s: parse_float(s, entity_id, default)
+    if kind == "bool":
+        parse_bool = ns["parse_bool"]
+        return lambda s: parse_bool(s, default)
+    if kind == "str":
+        parse_str = ns["parse_str"]
+        return lambda s: parse_str(s, entity_id, default)
+    if kind == "float_attr":
+        parse_float_attr = ns["parse_float_attr"]
+        return lambda s: parse_float_attr(s, entity_id, attribute, default)
+    if kind == "float_opt":
+        return ns["parse_float_opt"]
+    parse_attr = ns["parse_attr"]
+    return lambda s: parse_attr(s, attribute, default)
+
+
+class Simulation:
+    """Esegue run_tick() dello script su snapshot costruiti dagli eventi dello storico (sample-and-hold)."""
+
+    def __init__(self, params=None, tick=45, max_skip=0):
+        self.hass = FakeHass()
+        self.hass.services = SimServices(self)
+        self.ns = load(self.hass)
+        self.ns["CONFIG"]["params"].update(REPLAY_PARAMS)
+        self.ns["CONFIG"]["params"].update(params or {})
+        # Anche il sensore di stato è solo presentazione: nessuna decisione legge ciò che pubblica
+        self.ns["update_status_sensor"] = skip_status_sensor
+        self.entities = self.ns["CONFIG"]["entities"]
+        self.tick = tick
+        self.max_skip = max_skip
+        self.now = None
+        self.next_tick = None
+        self.last_ts = None
+        self.notifications = 0
+        self.plant = Plant()
+        self.holder = Holder()
+        self.fields_by_entity = {}
+        self.parsers = {}
+        for field in self.ns["SNAPSHOT_FIELDS"]:
+            if field[0] not in SKIP_FIELDS:
+                entity_id = self.entities[field[1]]
+                self.fields_by_entity.setdefault(entity_id, []).append(field)
+                self.parsers.setdefault(entity_id, []).append(
+                    (field[0], make_parser(self.ns, entity_id, field), field[0] in RECORDED_FIELDS, field[0] not in PLANT_FIELDS))
+        self.plant_entities = set(eid for eid, parsers in self.parsers.items() if any(p[2] for p in parsers))
+        # Entità lette solo dallo stato: parser puri, valori già convertiti riusati per lo stesso testo
+        self.memo = {eid: {} for eid, fields in self.fields_by_entity.items()
+                     if all(f[2] in STATE_KINDS for f in fields)}
+        # Entità che non servono al modello impianto: convertite solo prima del tick
+        self.pending = set()
+        self.states = {}
+        self.attrs = {}
+        self.snap = {f[0]: f[4] for f in self.ns["SNAPSHOT_FIELDS"]}
+        self.snap["wallbox_mode"] = DEFAULTS["wallbox_set_mode"]
+        self.snap["wallbox_current_set"] = float(DEFAULTS["wallbox_set_current"])
+        self.rec = {}
+        for key, value in DEFAULTS.items():
+            self.event(self.entities[key], str(value), None)
+        self.event(self.entities["sun"], "above_horizon", {"elevation": 30.0, "rising": True})
+        params = self.ns["CONFIG"]["params"]
+        bands = {field: params[name] for field, name in FAST_DEADBANDS.items()}
+        bands["sun_elevation"] = FAST_ELEVATION_DEGREES
+        self.compared = [(f[0], bands.get(f[0])) for f in self.ns["SNAPSHOT_FIELDS"] if f[0] not in FAST_IGNORED]
+        self.inputs = None
+        self.inputs_ts = None
+        self.measuring = True
+        self.baseline = {}
+        self.totals = {"ev_wh": 0.0, "grid_import_wh": 0.0, "grid_import_rec_wh": 0.0, "batt_discharge_wallbox_wh": 0.0,
+                       "resumes": 0, "pauses": 0, "ticks": 0, "skipped": 0, "events": 0}
+
+    def hold(self, entity_id, state, attrs):
+        """Memorizza il valore grezzo; restituisce False se l'entità non interessa o il valore non è cambiato."""
+        if entity_id not in self.parsers:
+            return False
+        if attrs:
+            self.attrs.setdefault(entity_id, {}).update(attrs)
+        elif state == self.states.get(entity_id):
+            return False
+        if state is not None:
+            self.states[entity_id] = state
+        return True
+
+    def parse(self, entity_id):
+        state = self.states.get(entity_id, "unknown")
+        memo = self.memo.get(entity_id)
+        writes = None if memo is None else memo.get(state)
+        if writes is None:
+            holder = self.holder
+            holder.state = state
+            holder.attributes = self.attrs.get(entity_id, {})
+            # Scritture già pronte: (dizionario di destinazione, campo, valore)
+            writes = []
+            for field, parse, recorded, to_snap in self.parsers[entity_id]:
+                value = parse(holder)
+                if recorded:
+                    writes.append((self.rec, field, value))
+                if to_snap:
+                    writes.append((self.snap, field, value))
+            if memo is not None:
+                if len(memo) >= MEMO_SIZE:
+                    memo.clear()
+                memo[state] = writes
+        for target, field, value in writes:
+            target[field] = value
+
+    def event(self, entity_id, state, attrs):
+        if self.hold(entity_id, state, attrs):
+            self.parse(entity_id)
+
+    def integrate(self, ts):
+        if self.measuring and self.last_ts is not None:
+            dt = ts - self.last_ts
+            if 0 < dt <= MAX_GAP_SECONDS:
+                h = dt / 3600.0
+                plant = self.plant
+                t = self.totals
+                t["ev_wh"] += plant.wallbox * h
+                t["grid_import_wh"] += max(0.0, plant.grid) * h
+                t["grid_import_rec_wh"] += max(0.0, plant.grid_rec) * h
+                t["batt_discharge_wallbox_wh"] += plant.batt_wallbox * h
+        self.last_ts = ts
+
+    def run_tick(self, ts):
+        if self.pending:
+            for entity_id in self.pending:
+                self.parse(entity_id)
+            self.pending.clear()
+        self.integrate(ts)
+        self.now = ts
+        snap = self.snap
+        self.plant.update(self.rec, snap)
+        if self.max_skip and self.unchanged(ts):
+            if self.measuring:
+                self.totals["ticks"] += 1
+                self.totals["skipped"] += 1
+            return
+        local = time.localtime(ts)
+        snap["timestamp"] = ts
+        snap["time"] = time.strftime("%H:%M", local)
+        snap["date_time_iso"] = time.strftime("%Y-%m-%dT%H:%M:%S", local)
+        ns = self.ns
+        ns["TICK"]["now"] = ts
+        before = ns["STORE"]["data"].get("mode")
+        ns["run_tick"](snap, ns["PERF_CLOCK"]())
+        after = ns["STORE"]["data"].get("mode")
+        if self.measuring:
+            if before == "paused" and after == "normal":
+                self.totals["resumes"] += 1
+            elif before == "normal" and after == "paused":
+                self.totals["pauses"] += 1
+            self.totals["ticks"] += 1
+        self.plant.update(self.rec, snap)
+        if self.max_skip:
+            # Dopo un cambio di modalità o con una transizione rimandata (anti-flap a tempo) il tick successivo gira comunque
+            settled = before == after and ns["TICK"]["deferred"] is None
+            self.inputs = [snap[field] for field, _ in self.compared] if settled else None
+            self.inputs_ts = ts
+
+    def unchanged(self, ts):
+        """--fast: True se il tick può riusare la decisione dell'ultimo tick eseguito."""
+        if self.inputs is None or ts + self.tick - self.inputs_ts > self.max_skip:
+            return False
+        snap = self.snap
+        for (field, band), ref in zip(self.compared, self.inputs):
+            value = snap[field]
+            if value != ref and (band is None or value is None or ref is None or abs(value - ref) > band):
+                return False
+        return True
+
+    def start_measuring(self, at):
+        # I contatori cumulativi dello store accumulati durante il riscaldamento non entrano nel report
+        if self.last_ts is not None:
+            self.last_ts = max(self.last_ts, at)
+        store = self.ns["STORE"]["data"]
+        self.baseline = self.counters(store)
+        self.notifications = 0
+        self.measuring = True
+
+    @staticmethod
+    def counters(store):
+        values = {"deferred": store.get("deferred_total", 0),
+                  "commands_issued": store.get("commands", {}).get("issued", 0),
+                  "commands_suppressed": store.get("commands", {}).get("suppressed", 0)}
+        # Energia alla EV per fonte come la conta lo script (sezione 8c), da confrontare con ev_wh del modello
+        energy = store.get("energy", {}).get("wh", [0.0, 0.0, 0.0])
+        for i, source in enumerate(("solar", "battery", "grid")):
+            values[f"ev_{source}_wh"] = energy[i]
+        for label, count in store.get("counters", {}).items():
+            values["scenario " + label] = count
+        return values
+
+    def run(self, events, tick_from=None, measure_from=None, end=None):
+        """
+        Riproduce gli eventi (ordinati per tempo). Prima di tick_from gli eventi aggiornano solo i valori grezzi
+        (nessun tick, nessun parsing); tra tick_from e measure_from il controllore gira senza contare le metriche.
+        """
+        self.measuring = measure_from is None
+        events = iter(events)
+        plant_dirty = False
+        if tick_from is not None:
+            held = set()
+            for ev in events:
+                if ev[0] >= tick_from:
+                    events = itertools.chain([ev], events)
+                    break
+                if self.hold(ev[1], ev[2], ev[3]):
+                    held.add(ev[1])
+            for held_id in held:
+                self.parse(held_id)
+            plant_dirty = bool(held)
+        # Ciclo per evento: hold() e integrate() espansi qui, è il percorso caldo del replay
+        parsers = self.parsers
+        states = self.states
+        attrs_by_entity = self.attrs
+        plant_entities = self.plant_entities
+        pending = self.pending
+        last_ts = self.last_ts
+        counted = 0
+        for ts, entity_id, state, attrs in events:
+            if ts != last_ts:
+                if self.next_tick is None:
+                    self.next_tick = ts if tick_from is None else tick_from
+                # Tutti gli eventi del timestamp precedente sono applicati: aggiorno il modello, poi i tick in sospeso
+                if plant_dirty:
+                    self.plant.update(self.rec, self.snap)
+                    plant_dirty = False
+                if ts - (self.next_tick if last_ts is None else last_ts) > MAX_GAP_SECONDS:
+                    # Buco nello storico (HA spento, export parziale): niente tick finché non tornano i dati
+                    self.next_tick += (ts - self.next_tick) // self.tick * self.tick
+                if self.next_tick < ts:
+                    self.run_ticks(ts, measure_from)
+                if not self.measuring and ts >= measure_from:
+                    self.start_measuring(measure_from)
+                self.integrate(ts)
+                last_ts = ts
+            if self.measuring:
+                counted += 1
+            if entity_id not in parsers:
+                continue
+            if attrs:
+                attrs_by_entity.setdefault(entity_id, {}).update(attrs)
+            elif state == states.get(entity_id):
+                continue
+            if state is not None:
+                states[entity_id] = state
+            if entity_id in plant_entities:
+                self.parse(entity_id)
+                plant_dirty = True
+            else:
+                pending.add(entity_id)
+        self.totals["events"] += counted
+        if end is not None and self.last_ts is not None and 0 < end - self.last_ts <= MAX_GAP_SECONDS:
+            self.run_ticks(end, measure_from)
+            self.integrate(end)
+        return self.report()
+
+    def run_ticks(self, ts, measure_from):
+        # Tick in sospeso fino a ts escluso: i tick allo stesso istante di un evento vedono già quell'evento
+        while self.next_tick < ts:
+            if not self.measuring and self.next_tick >= measure_from:
+                self.start_measuring(measure_from)
+            self.run_tick(self.next_tick)
+            self.next_tick += self.tick
+
+    def report(self):
+        t = self.totals
+        counters = self.counters(self.ns["STORE"]["data"])
+        for key, value in self.baseline.items():
+            counters[key] = counters.get(key, 0) - value
+        result = {
+            "events": t["events"],
+            "ticks": t["ticks"],
+            "ticks_skipped": t["skipped"],
+            "ev_wh": t["ev_wh"],
+            "grid_import_wh": t["grid_import_wh"],
+            "grid_import_recorded_wh": t["grid_import_rec_wh"],
+            "batt_discharge_wallbox_wh": t["batt_discharge_wallbox_wh"],
+            "pauses": t["pauses"],
+            "resumes": t["resumes"],
+            "notifications": self.notifications,
+        }
+        result.update(counters)
+        return result
+
+
+def simulate_chunk(source, params, tick, max_skip, start, end, warmup, last):
+    """Worker: simula [start, end) partendo warmup secondi prima per riempire filtri, anti-flap e stabilizzazione."""
+    logging.basicConfig(level=logging.ERROR)
+    sim = Simulation(params, tick, max_skip)
+    tick_from = start - warmup
+    # L'intervallo finale fino a end appartiene a questo blocco, tranne per l'ultimo (come nella simulazione sequenziale)
+    return sim.run(source.events(tick_from, end), tick_from, start, None if last else end)
+
+
+def chunk_bounds(first, last, chunks):
+    """Divide [first, last) in blocchi di giorni interi (a mezzanotte locale)."""
+    day0 = datetime.datetime.fromtimestamp(first).astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+    days = int(math.ceil((last - day0.timestamp()) / 86400.0))
+    chunks = max(1, min(chunks, days))
+    bounds = [first]
+    for i in range(1, chunks):
+        bounds.append((day0 + datetime.timedelta(days=days * i // chunks)).timestamp())
+    bounds.append(last)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def merge_reports(reports):
+    total = {}
+    for report in reports:
+        for key, value in report.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def simulate(source, params=None, tick=45, workers=1, warmup=WARMUP_SECONDS, max_skip=0):
+    """Simulazione completa; con più worker lo storico viene diviso per giorni ed eseguito in un process pool."""
+    if workers <= 1:
+        sim = Simulation(params, tick, max_skip)
+        return sim.run(source.events())
+    first, last = source.span()
+    bounds = chunk_bounds(first, last, workers)
+    # Il primo blocco parte dall'inizio dello storico, come la simulazione sequenziale
+    jobs = [(source, params, tick, max_skip, start, end, warmup if i else 0, i == len(bounds) - 1) for i, (start, end) in enumerate(bounds)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return merge_reports(pool.map(simulate_chunk, *zip(*jobs)))
+
+
+def summary(report):
+    lines = [
+        ("events", report["events"]),
+        ("ticks", report["ticks"]),
+        ("ticks_skipped", report["ticks_skipped"]),
+        ("ev_kwh", round(report["ev_wh"] / 1000.0, 3)),
+        ("grid_import_kwh", round(report["grid_import_wh"] / 1000.0, 3)),
+        ("grid_import_recorded_kwh", round(report["grid_import_recorded_wh"] / 1000.0, 3)),
+        ("batt_discharge_wallbox_kwh", round(report["batt_discharge_wallbox_wh"] / 1000.0, 3)),
+        ("ev_solar_kwh", round(report["ev_solar_wh"] / 1000.0, 3)),
+        ("ev_battery_kwh", round(report["ev_battery_wh"] / 1000.0, 3)),
+        ("ev_grid_kwh", round(report["ev_grid_wh"] / 1000.0, 3)),
+        ("pause_resume_cycles", min(report["pauses"], report["resumes"])),
+        ("pauses", report["pauses"]),
+        ("resumes", report["resumes"]),
+        ("deferred", report["deferred"]),
+        ("commands_issued", report["commands_issued"]),
+        ("commands_suppressed", report["commands_suppressed"]),
+        ("notifications", report["notifications"]),
+    ]
+    scenarios = {k[9:]: v for k, v in report.items() if k.startswith("scenario ") and v}
+    lines.append(("scenarios", scenarios))
+    return lines
+
+
+def parse_overrides(items):
+    params = {}
+    for item in items or []:
+        key, value = item.split("=", 1)
+        try:
+            params[key] = float(value) if "." in value else int(value)
+        except ValueError:
+            params[key] = {"True": True, "False": False}.get(value, value)
+    return params
+
+
+def parse_day(value):
+    return parse_ts(value) if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", nargs="?", help="CSV o database SQLite del recorder")
+    parser.add_argument("--tick", type=float, default=45, help="intervallo tra i tick del controllore (s)")
+    parser.add_argument("--workers", type=int, default=1, help="processi paralleli (0 = tutti i core)")
+    parser.add_argument("--fast", action="store_true", help="salta i tick con ingressi fermi (risultati approssimati)")
+    parser.add_argument("--max-skip", type=float, default=FAST_MAX_SKIP, help="con --fast, distanza massima tra due tick eseguiti (s)")
+    parser.add_argument("--start", help="inizio (ISO 8601)")
+    parser.add_argument("--end", help="fine (ISO 8601)")
+    parser.add_argument("--demo", action="store_true", help="usa uno storico sintetico")
+    parser.add_argument("--demo-days", type=int, default=1)
+    parser.add_argument("--demo-step", type=float, default=45)
+    parser.add_argument("--set", action="append", metavar="PARAM=VALORE", help="sovrascrive CONFIG['params']")
+    args = parser.parse_args()
+    if not args.source and not args.demo:
+        parser.error("indicare un CSV, un database del recorder oppure --demo")
+    logging.basicConfig(level=logging.ERROR)
+    if args.demo:
+        source = Source("demo", days=args.demo_days, step=args.demo_step)
+    else:
+        source = open_source(args.source, Simulation().fields_by_entity)
+    workers = args.workers or os.cpu_count() or 1
+    params = parse_overrides(args.set)
+    max_skip = args.max_skip if args.fast else 0
+    started = time.perf_counter()
+    if args.start or args.end:
+        start, end = parse_day(args.start), parse_day(args.end)
+        report = Simulation(params, args.tick, max_skip).run(source.events(start, end), start, start)
+    else:
+        report = simulate(source, params, args.tick, workers, max_skip=max_skip)
+    elapsed = time.perf_counter() - started
+    for key, value in summary(report):
+        print(f"{key}: {value}")
+    print(f"elapsed_s: {elapsed:.2f} ({report['events'] / elapsed:.0f} eventi/s, {report['ticks'] / elapsed:.0f} tick/s)")
+
+
+if __name__ == "__main__":
+    main()
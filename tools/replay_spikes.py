@@ -0,0 +1,99 @@
+"""
+Wallbox Dynamic Controller - replay picchi di corrente sul fast-path sovracorrente
+Riproduce un profilo di corrente domestica (senza wallbox) e misura come reagisce overcurrent_tick():
+ampere comandati, campioni in cui la wallbox resta sopra home_max_current e tempo di reazione peggiore.
+
+Uso: python tools/replay_spikes.py [profilo.csv]
+Il CSV ha le colonne "t" (secondi) e "domestic_current" (A). Senza file viene usato un profilo dimostrativo.
+"""
+import csv
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakehass import FakeHass, load  # noqa: E402
+from engine import WallboxEngine  # noqa: E402
+
+VOLTAGE = 230.0
+HOME_MAX_CURRENT = 25.0
+START_AMPS = 16
+
+
+def demo_profile():
+    # Base 6A, forno (+12A), bollitore (+9A) sovrapposto al forno, rientro graduale
+    profile = []
+    for t in range(0, 120):
+        domestic = 6.0
+        if 20 <= t < 70:
+            domestic += 12.0
+        if 40 <= t < 46:
+            domestic += 9.0
+        if 90 <= t < 92:
+            domestic += 20.0
+        profile.append((float(t), domestic))
+    return profile
+
+
+def read_profile(path):
+    with open(path, newline="", encoding="utf8") as fil:
+        return [(float(row["t"]), float(row["domestic_current"])) for row in csv.DictReader(fil)]
+
+
+def base_states(hass, config):
+    e = config["entities"]
+    put = hass.states.put
+    put(e["voltage"], VOLTAGE)
+    put(e["home_max_current"], HOME_MAX_CURRENT)
+    put(e["min_charge_amps"], 6)
+    put(e["wallbox_set_mode"], "normal")
+    put(e["wallbox_set_current"], START_AMPS)
+    put(e["last_wallbox_current"], START_AMPS)
+
+
+def wallbox_amps(hass, config):
+    # Impianto semplificato: la wallbox assorbe subito la corrente comandata se non è in pausa
+    e = config["entities"]
+    if hass.states.data[e["wallbox_set_mode"]].state == "paused":
+        return 0.0
+    return float(hass.states.data[e["wallbox_set_current"]].state)
+
+
+def replay(profile):
+    hass = FakeHass()
+    engine = WallboxEngine(load(hass), clock=time.perf_counter)
+    config = engine.config
+    e = config["entities"]
+    base_states(hass, config)
+    rows = []
+    over_after = 0
+    for t, domestic in profile:
+        amps = wallbox_amps(hass, config)
+        hass.states.put(e["home_current"], round(domestic + amps, 2))
+        hass.states.put(e["wallbox_power"], round(amps * VOLTAGE, 1))
+        result = engine.guard(time.perf_counter())
+        # Conta solo i casi in cui la wallbox contribuisce ancora al superamento del limite
+        remaining = wallbox_amps(hass, config)
+        if remaining > 0 and domestic + remaining > HOME_MAX_CURRENT:
+            over_after += 1
+        if result is not None:
+            rows.append((t, domestic, amps, result[0], engine.guard_stats["last_reaction"]))
+    return rows, over_after, engine.guard_stats
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    profile = read_profile(sys.argv[1]) if len(sys.argv) > 1 else demo_profile()
+    rows, over_after, stats = replay(profile)
+    print(f"{'t':>7} {'casa A':>7} {'wbox A':>7} {'-> A':>5} {'reazione ms':>12}")
+    for t, domestic, before, after, reaction in rows:
+        print(f"{t:7.1f} {domestic:7.1f} {before:7.1f} {after:5d} {reaction * 1000:12.3f}")
+    print(f"campioni: {len(profile)}  interventi: {stats['trips']}  wallbox sopra limite dopo intervento: {over_after}")
+    print(f"reazione peggiore: {stats['max_reaction'] * 1000:.3f} ms")
+    return 1 if over_after else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
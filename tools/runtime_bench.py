@@ -0,0 +1,146 @@
+"""
+Wallbox Dynamic Controller - esecuzione a freddo (python_script) contro tick residente
+Misura sul hass finto quanto costa una decisione nei due modi di esecuzione, sugli stati del percorso scenario_12b
+di tools/bench.py:
+- python_script: a ogni trigger HA legge il file, lo compila ed esegue tutto il corpo del modulo (CONFIG, funzioni,
+  schema dello stato) prima di main(), con lo store riletto dall'entità controller_state;
+- tramite: wallbox_control_tick.py letto, compilato ed eseguito, fino alla chiamata del servizio wallbox_control.tick;
+- tick residente: WallboxEngine.tick() sul namespace caricato e validato una volta (engine.load_script).
+Se RestrictedPython è installato viene misurata anche la sua compilazione, quella usata davvero da python_script.
+
+Uso:
+  python tools/runtime_bench.py [--cold 200] [--warm 2000]
+"""
+import argparse
+import datetime
+import gc
+import logging
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import path_states, percentile  # noqa: E402
+from fakehass import ROOT, SCRIPT_PATH, FakeHass, load  # noqa: E402
+from engine import WallboxEngine  # noqa: E402
+
+SHIM_PATH = os.path.join(ROOT, "wallbox_control_tick.py")
+
+try:
+    from RestrictedPython import compile_restricted_exec
+except ImportError:  # opzionale: solo per la riga della compilazione di python_script
+    compile_restricted_exec = None
+
+
+class TickServices:
+    """Servizi del hass finto con wallbox_control.tick registrato (integrazione attiva)."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def has_service(self, domain, service):
+        return (domain, service) == ("wallbox_control", "tick")
+
+    def call(self, domain, service, data=None, blocking=False):
+        self.calls += 1
+        return True
+
+
+def timed(fn, iterations):
+    """Durate ordinate (s) di iterations chiamate, con il garbage collector fermo."""
+    samples = []
+    perf = time.perf_counter
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            start = perf()
+            fn()
+            samples.append(perf() - start)
+    finally:
+        gc.enable()
+    samples.sort()
+    return samples
+
+
+def fresh_hass(states):
+    hass = FakeHass()
+    for entity_id, (state, attributes) in states.items():
+        hass.states.put(entity_id, state, attributes)
+    return hass
+
+
+def script_namespace(hass, logger):
+    # Stessi nomi che python_script mette a disposizione
+    return {"hass": hass, "logger": logger, "data": {}, "output": {}, "time": time, "datetime": datetime, "math": math}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cold", type=int, default=200, help="esecuzioni a freddo (python_script)")
+    parser.add_argument("--warm", type=int, default=2000, help="tick residenti")
+    args = parser.parse_args()
+    logger = logging.getLogger("wallbox.runtime_bench")
+    logger.setLevel(logging.ERROR)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    hass = FakeHass()
+    config = load(hass, logger=logger)["CONFIG"]
+    states = path_states(config, {})
+
+    def read(path):
+        with open(path, encoding="utf8") as fil:
+            return fil.read()
+
+    cold_hass = fresh_hass(states)
+    # Le due parti di ogni esecuzione a freddo, misurate nella stessa chiamata
+    parts = {"compile": [], "run": []}
+
+    def cold():
+        perf = time.perf_counter
+        start = perf()
+        code = compile(read(SCRIPT_PATH), SCRIPT_PATH, "exec")
+        compiled = perf()
+        exec(code, script_namespace(cold_hass, logger))  # noqa: S102
+        parts["compile"].append(compiled - start)
+        parts["run"].append(perf() - compiled)
+
+    shim_hass = fresh_hass({})
+    shim_hass.services = TickServices()
+
+    def shim():
+        source = read(SHIM_PATH)
+        exec(compile(source, SHIM_PATH, "exec"), script_namespace(shim_hass, logger))  # noqa: S102
+
+    warm_hass = fresh_hass(states)
+    started = time.perf_counter()
+    engine = WallboxEngine(load(warm_hass, logger=logger))
+    load_s = time.perf_counter() - started
+
+    total = timed(cold, args.cold)
+    rows = [
+        ("python_script: esecuzione completa", total),
+        ("  di cui lettura + compile", sorted(parts["compile"])),
+        ("  di cui corpo del modulo + main()", sorted(parts["run"])),
+        ("tramite: compile + servizio tick", timed(shim, args.cold)),
+        ("tick residente (engine.tick)", timed(engine.tick, args.warm)),
+    ]
+    if compile_restricted_exec is not None:
+        rows.insert(3, ("python_script: compile RestrictedPython",
+                        timed(lambda: compile_restricted_exec(read(SCRIPT_PATH), filename=SCRIPT_PATH), max(1, args.cold // 4))))
+    if shim_hass.services.calls != args.cold:
+        raise SystemExit(f"tramite: {shim_hass.services.calls} chiamate al servizio invece di {args.cold}")
+
+    warm = percentile(rows[-1][1], 50)
+    print(f"caricamento e validazione del runtime residente (una volta): {load_s * 1000:.1f} ms")
+    print(f"{'esecuzione':42s} {'mediana ms':>10s} {'p95 ms':>8s} {'rispetto al tick':>16s}")
+    for name, samples in rows:
+        median = percentile(samples, 50)
+        print(f"{name:42s} {median * 1000:10.3f} {percentile(samples, 95) * 1000:8.3f} {median / warm:15.1f}x")
+
+
+if __name__ == "__main__":
+    main()
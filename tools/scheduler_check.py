@@ -0,0 +1,240 @@
+"""
+Wallbox Dynamic Controller - verifica dello scheduler degli eventi (engine.TickScheduler)
+Pilota TickScheduler con un orologio e un call_later finti (nessuna attesa reale) e controlla, con debounce e
+max_latency dell'integrazione:
+- evento singolo e heartbeat: un tick dopo debounce;
+- raffica: eventi ravvicinati raccolti in un solo tick, con tutte le entità;
+- flusso continuo: eventi più fitti del debounce, il tick parte comunque entro max_latency dal primo;
+- tick lento: mai due tick insieme, gli eventi arrivati durante l'esecuzione riarmano il tick dopo done();
+ogni evento finisce in uno e un solo tick. Poi, sul bus finto, lo script vero con WallboxEngine e
+engine.event_router: le scritture dello script (sensori, comandi) non generano nuovi tick, un solo evento
+della corrente di casa oltre il limite mette in pausa subito, senza attendere il debounce.
+
+Uso:
+  python tools/scheduler_check.py [--debounce 1.0] [--max-latency 3.0]
+"""
+import argparse
+import heapq
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import NOW_TS, path_states  # noqa: E402
+from fakehass import FakeHass, FakeStates, load  # noqa: E402
+from engine import TickScheduler, WallboxEngine, event_router, guard_entities, trigger_entities  # noqa: E402
+
+# Wallbox in pausa con sole pieno (percorso scenario_17 di bench.py)
+RESUME = {"wallbox_set_mode": "paused", "wallbox_set_current": 6, "wallbox_power": 0, "home_power": 500,
+          "home_current": 2.2, "pv_primary_1": 5000, "pv_secondary": 3000}
+
+
+class FakeLoop:
+    """Orologio e call_later finti: advance() esegue in ordine i callback scaduti."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+        self.seq = 0
+
+    def clock(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        self.seq += 1
+        timer = Timer([self.now + delay, self.seq, callback])
+        heapq.heappush(self.timers, timer.entry)
+        return timer
+
+    def advance(self, to):
+        while self.timers and self.timers[0][0] <= to:
+            due, _, callback = heapq.heappop(self.timers)
+            self.now = due
+            if callback is not None:
+                callback()
+        self.now = max(self.now, to)
+
+
+class Timer:
+    def __init__(self, entry):
+        self.entry = entry
+
+    def cancel(self):
+        self.entry[2] = None
+
+
+class Recorder:
+    """run_tick finto: registra (inizio, entità) e chiama done() dopo duration secondi del loop finto."""
+
+    def __init__(self, loop, duration=0.0):
+        self.loop = loop
+        self.duration = duration
+        self.ticks = []
+        self.running = 0
+        self.overlaps = 0
+
+    def __call__(self, entities, done):
+        if self.running:
+            self.overlaps += 1
+        self.running += 1
+        self.ticks.append((self.loop.now, set(entities)))
+
+        def finish():
+            self.running -= 1
+            done()
+
+        if self.duration:
+            self.loop.call_later(self.duration, finish)
+        else:
+            finish()
+
+
+def run_case(events, debounce, max_latency, duration=0.0, until=None):
+    """Invia gli eventi [(istante, entità)] e restituisce scheduler e registro dei tick."""
+    loop = FakeLoop()
+    recorder = Recorder(loop, duration)
+    scheduler = TickScheduler(recorder, loop.call_later, loop.clock, debounce, max_latency)
+    for at, entity_id in events:
+        loop.advance(at)
+        scheduler.notify(entity_id)
+    loop.advance(until if until is not None else events[-1][0] + max_latency + duration * 2 + 1)
+    return scheduler, recorder
+
+
+def stream(period, seconds):
+    """Un evento ogni period secondi, ognuno con la sua entità (per verificare che nessuno vada perso)."""
+    count = int(seconds / period)
+    return [(round(i * period, 6), f"sensor.e{i}") for i in range(count)]
+
+
+def check_scheduler(debounce, max_latency):
+    slow = max_latency + 2.0
+    # (nome, eventi, durata del tick, tick attesi, latenza massima attesa)
+    cases = (
+        ("evento singolo", [(0.0, "sensor.e0")], 0.0, 1, debounce),
+        ("heartbeat", [(0.0, None)], 0.0, 1, debounce),
+        ("raffica", [(i * 0.01, f"sensor.e{i}") for i in range(50)], 0.0, 1, min(0.49 + debounce, max_latency)),
+        ("flusso continuo", stream(debounce * 0.4, 30.0), 0.0, None, max_latency),
+        ("tick lento", stream(debounce * 0.4, 30.0), slow, None, max(max_latency, slow)),
+    )
+    errors = []
+    for name, events, duration, expected_ticks, expected_latency in cases:
+        scheduler, recorder = run_case(events, debounce, max_latency, duration)
+        found = []
+        delivered = [entity_id for _, entities in recorder.ticks for entity_id in entities]
+        sent = [entity_id for _, entity_id in events]
+        if sorted(delivered, key=str) != sorted(sent, key=str):
+            found.append(f"{len(sent)} eventi, {len(delivered)} consegnati (persi o duplicati)")
+        if recorder.overlaps:
+            found.append(f"{recorder.overlaps} tick partiti mentre un altro era in esecuzione")
+        if expected_ticks is not None and len(recorder.ticks) != expected_ticks:
+            found.append(f"{len(recorder.ticks)} tick invece di {expected_ticks}")
+        if expected_ticks is None:
+            # Flusso più fitto del debounce: un tick per finestra di max_latency (più l'esecuzione), non uno per evento
+            span = events[-1][0] - events[0][0]
+            most = int(span / max(max_latency, duration)) + 2
+            if len(recorder.ticks) > most:
+                found.append(f"{len(recorder.ticks)} tick per {len(events)} eventi (al massimo {most})")
+        worst = scheduler.stats["max_latency"]
+        if worst > expected_latency + 1e-9:
+            found.append(f"latenza massima {worst:.2f}s oltre {expected_latency:.2f}s")
+        if scheduler.pending or scheduler.timer is not None or scheduler.running:
+            found.append("scheduler non a riposo a fine prova")
+        print(f"{name:18s} {len(events):4d} eventi {len(recorder.ticks):3d} tick  latenza max {worst:5.2f}s  "
+              f"{'ok' if not found else 'ERRORE'}")
+        errors.extend(f"{name}: {error}" for error in found)
+    return errors
+
+
+class BusStates(FakeStates):
+    """Stati del hass finto che pubblicano un cambio stato sul bus finto per le entità osservate."""
+
+    def __init__(self, clock):
+        super().__init__(clock=clock)
+        self.listener = None
+        self.watched = set()
+
+    def write(self, entity_id, state, attributes=None, force_update=False):
+        old = self.data.get(entity_id)
+        super().write(entity_id, state, attributes, force_update)
+        new = self.data[entity_id]
+        # Come async_track_state_change_event: solo cambi di stato o attributi delle entità osservate
+        changed = old is None or old.last_updated != new.last_updated
+        if self.listener is not None and changed and entity_id in self.watched:
+            self.listener(entity_id)
+
+
+def check_bus(debounce, max_latency):
+    """Script vero sul bus finto: niente tick generati dalle proprie scritture, fast-path senza debounce."""
+    logger = logging.getLogger("wallbox.scheduler_check")
+    logger.setLevel(logging.CRITICAL)
+    logger.propagate = False
+    loop = FakeLoop()
+    hass = FakeHass(clock=lambda: NOW_TS + loop.now)
+    hass.states = BusStates(hass.states.clock)
+    hass.services.states = hass.states
+    ns = load(hass, logger=logger)
+    cfg = ns["CONFIG"]
+    engine = WallboxEngine(ns, clock=loop.clock)
+    ticks = []
+
+    def run_tick(entities, done):
+        ticks.append(loop.now)
+        ns["TICK"]["now"] = NOW_TS + loop.now
+        engine.tick()
+        done()
+
+    def guard(entity_id, event_time):
+        ns["TICK"]["now"] = NOW_TS + loop.now
+        engine.guard(event_time)
+
+    scheduler = TickScheduler(run_tick, loop.call_later, loop.clock, debounce, max_latency)
+    for entity_id, (state, attributes) in path_states(cfg, RESUME).items():
+        hass.states.put(entity_id, state, attributes)
+    hass.states.watched = set(trigger_entities(cfg))
+    hass.states.listener = event_router(scheduler, set(guard_entities(cfg)), guard, loop.clock)
+
+    errors = []
+    entities = cfg["entities"]
+    # Il FTV cambia ogni 2s per 20s: tick guidati dagli eventi, poi nessun tick finché nulla cambia
+    for i in range(10):
+        loop.advance(i * 2.0)
+        hass.states.put(entities["pv_primary_1"], 5000 + i * 10)
+    loop.advance(60.0)
+    quiet = [t for t in ticks if t > 18.0 + max_latency]
+    if quiet:
+        errors.append(f"bus: {len(quiet)} tick senza eventi esterni (le scritture dello script li riattivano)")
+    if hass.states.data[entities["wallbox_set_mode"]].state != "normal":
+        errors.append("bus: la wallbox non è ripartita con il sole pieno")
+    after_pv = len(ticks)
+    # Un solo evento della corrente di casa oltre il limite: pausa subito, prima del tick (debounce)
+    hass.states.put(entities["wallbox_power"], 3700)
+    hass.states.put(entities["home_current"], 60)
+    mode = hass.states.data[entities["wallbox_set_mode"]].state
+    if mode != "paused" or len(ticks) != after_pv:
+        errors.append(f"bus: dopo l'evento di sovracorrente wallbox in {mode} con {len(ticks) - after_pv} tick")
+    if engine.guard_stats["trips"] != 1:
+        errors.append(f"bus: fast-path intervenuto {engine.guard_stats['trips']} volte invece di 1")
+    loop.advance(loop.now + max_latency + 1)
+    print(f"{'bus finto':18s} {scheduler.stats['events']:4d} eventi {len(ticks):3d} tick  "
+          f"fast-path {engine.guard_stats['trips']}/{engine.guard_stats['checks']}  {'ok' if not errors else 'ERRORE'}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--debounce", type=float, default=1.0)
+    parser.add_argument("--max-latency", type=float, default=3.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    errors = check_scheduler(args.debounce, args.max_latency)
+    errors.extend(check_bus(args.debounce, args.max_latency))
+    for error in errors:
+        print(f"  {error}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
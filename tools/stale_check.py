@@ -0,0 +1,138 @@
+"""
+Wallbox Dynamic Controller - verifica della freschezza delle letture (FRESHNESS_FIELDS)
+Sul hass finto, con l'orologio fermo su NOW_TS di tools/bench.py, rende vecchie di --age secondi le entità di una
+classe di segnale e controlla che la decisione diventi prudente:
+- FTV bloccato: niente carica dal solare, la wallbox in pausa non riparte;
+- corrente di casa ferma: carica alla corrente minima;
+- SOC EV fermo sotto la soglia di emergenza: niente carica di emergenza;
+- ora ferma dentro la finestra di pausa: decide l'orologio del sistema;
+- letture a 0 e helper impostati a mano non scadono;
+e che sensore di stato e diagnostica riportino i campi non aggiornati. Misura poi il costo del controllo in
+read_snapshot (stessa passata sugli oggetti stato già letti) contro le età massime a 0 (controllo spento).
+
+Uso:
+  python tools/stale_check.py [--age 4000] [--iterations 2000]
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import NOW_TS, path_states, percentile  # noqa: E402
+from fakehass import FakeHass, load  # noqa: E402
+
+# Wallbox in pausa con sole pieno: con letture fresche riparte a 16A (percorso scenario_17 di bench.py)
+RESUME = {"wallbox_set_mode": "paused", "wallbox_set_current": 6, "wallbox_power": 0, "home_power": 500,
+          "home_current": 2.2, "pv_primary_1": 5000, "pv_secondary": 3000}
+# Notte, auto sotto la soglia di emergenza: con SOC EV fresco carica al minimo
+EMERGENCY = {"pv_primary_1": 0, "pv_secondary": 0, "ev_soc": 10, "ev_soc_emergenza": 20}
+# Ora del sensore dentro la finestra di pausa 22:00-06:00 (l'orologio del sistema è fuori)
+NIGHT_WINDOW = {"time": "23:00:00", "pause_start_time": "22:00:00", "pause_end_time": "06:00:00"}
+
+# (nome, stati, chiavi di CONFIG["entities"] non aggiornate, modalità attesa, ampere attesi, campi segnalati)
+CASES = (
+    ("letture fresche", RESUME, (), "normal", 16, ()),
+    ("FTV bloccato", RESUME, ("pv_primary_1",), "paused", None, ("pv1",)),
+    ("corrente casa ferma", RESUME, ("home_current",), "normal", 6, ("home_current",)),
+    ("SOC EV fresco", EMERGENCY, (), "normal", 6, ()),
+    ("SOC EV fermo", EMERGENCY, ("ev_soc",), "paused", None, ("ev_soc",)),
+    ("ora fresca", dict(RESUME, **NIGHT_WINDOW), (), "paused", None, ()),
+    ("ora ferma", dict(RESUME, **NIGHT_WINDOW), ("time",), "normal", 16, ("time",)),
+    ("zeri e helper", RESUME, ("pv_primary_2", "wallbox_power", "min_charge_amps", "batt_soc_min"), "normal", 16, ()),
+)
+
+
+class Harness:
+    def __init__(self):
+        logger = logging.getLogger("wallbox.stale_check")
+        logger.setLevel(logging.CRITICAL)
+        logger.propagate = False
+        self.hass = FakeHass()
+        self.ns = load(self.hass, logger=logger)
+        self.ns["TICK"]["now"] = NOW_TS
+
+    def put(self, overrides, stale_keys, age):
+        """Stati del caso, con ultimo aggiornamento adesso o age secondi fa per le entità non aggiornate."""
+        cfg = self.ns["CONFIG"]
+        hass = self.hass
+        hass.states.data = {}
+        old = [cfg["entities"][key] for key in stale_keys]
+        for entity_id, (state, attributes) in path_states(cfg, overrides).items():
+            hass.states.put(entity_id, state, attributes)
+            obj = hass.states.data[entity_id]
+            ts = NOW_TS - age if entity_id in old else NOW_TS
+            obj.last_updated = obj.last_reported = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+
+    def tick(self, overrides, stale_keys, age):
+        self.put(overrides, stale_keys, age)
+        ns = self.ns
+        ns["STORE"].update({"loaded": False, "saved_ts": 0, "data": {}})
+        ns["main"]()
+        return ns["STORE"]["data"]
+
+    def entity(self, key):
+        return self.hass.states.data[self.ns["CONFIG"]["entities"][key]]
+
+
+def check(h, age):
+    errors = []
+    for name, overrides, stale_keys, mode, amps, flagged in CASES:
+        st = h.tick(overrides, stale_keys, age)
+        got_mode = h.entity("wallbox_set_mode").state
+        got_amps = int(float(h.entity("wallbox_set_current").state))
+        status = h.entity("status_sensor").attributes.get("Sensori Non Aggiornati", "")
+        diag = h.entity("diagnostics_sensor").attributes.get("Sensori Non Aggiornati")
+        found = []
+        if got_mode != mode or (amps is not None and got_amps != amps):
+            found.append(f"wallbox {got_mode} {got_amps}A invece di {mode} {amps}A")
+        if st["stale"] != sorted(flagged) or status != ", ".join(sorted(flagged)) or diag != status:
+            found.append(f"segnalati {st['stale']} (stato {status!r}, diagnostica {diag!r}) invece di {sorted(flagged)}")
+        print(f"{name:22s} {got_mode:7s} {got_amps:3d}A  {'ok' if not found else 'ERRORE'}")
+        errors.extend(f"{name}: {error}" for error in found)
+    return errors
+
+
+def cost(h, iterations):
+    """Mediana in µs di read_snapshot con il controllo di freschezza e con le età massime a 0."""
+    ns = h.ns
+    cfg = ns["CONFIG"]
+    read_snapshot = ns["read_snapshot"]
+    h.put(RESUME, ("pv_primary_1",), 4000)
+    limits = {key: cfg["params"][key] for key in ("stale_power_seconds", "stale_soc_seconds", "stale_helper_seconds")}
+    times = {}
+    for label, values in (("controllo spento", {key: 0 for key in limits}), ("con freschezza", limits)):
+        cfg["params"].update(values)
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            read_snapshot(cfg)
+            samples.append(time.perf_counter() - started)
+        samples.sort()
+        times[label] = percentile(samples, 50)
+    cfg["params"].update(limits)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--age", type=int, default=4000, help="età (s) delle letture non aggiornate (oltre tutte le età massime)")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    h = Harness()
+    errors = check(h, args.age)
+    for error in errors:
+        print(f"  {error}")
+    print(f"\nread_snapshot ({len(h.ns['SNAPSHOT_FIELDS'])} campi, {len(h.ns['FRESHNESS_FIELDS'])} con età massima):")
+    for label, median in cost(h, args.iterations).items():
+        print(f"  {label:18s} {median * 1e6:7.1f} µs")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Wallbox Dynamic Controller - memoria per snapshot dello stato del tick
+Raccoglie gli stati prodotti da get_system_state durante un replay sintetico (come tools/replay.py --demo) e
+misura con tracemalloc quanto costa conservarne migliaia (storico per replay e smoothing) con layout diversi:
+dizionario con una chiave per campo (lo stato prima di STATE_SCHEMA), record a posizioni fisse (lista, come nel
+tick), tupla e array('d') dei soli campi numerici. I valori vengono ricreati per ogni snapshot, come quando
+arrivano da uno storico, così il conto include float e stringhe e non solo il contenitore; previsione, piano e
+quota sono riferimenti a strutture del tick e restano fuori dal conto.
+Verifica anche che le costanti S_<NOME> dello script corrispondano alle posizioni di STATE_SCHEMA e che ogni
+stato raccolto rispetti i tipi dello schema.
+
+Uso:
+  python tools/state_bench.py [--days 3] [--tick 45]
+"""
+import argparse
+import gc
+import logging
+import math
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay import Simulation, Source  # noqa: E402
+
+# Campi struttura: riferimenti condivisi con il tick, non copiati nello storico
+SHARED_KINDS = ("obj",)
+
+
+def schema_errors(ns):
+    """Costanti S_<NOME> fuori posto o mancanti rispetto a STATE_SCHEMA."""
+    schema = ns["STATE_SCHEMA"]
+    errors = []
+    for index, (name, kind, default) in enumerate(schema):
+        const = "S_" + name.upper()
+        if ns.get(const) != index:
+            errors.append(f"{const} = {ns.get(const)} invece di {index}")
+    extra = [k for k, v in ns.items() if k.startswith("S_") and k.isupper() and isinstance(v, int) and v >= len(schema)]
+    return errors + [f"{k} oltre la fine dello schema" for k in extra]
+
+
+def collect(days, tick):
+    """Stati a fine tick (dopo filtri, previsione e piano) di un replay sintetico."""
+    sim = Simulation(None, tick)
+    ns = sim.ns
+    states = []
+    get_system_state = ns["get_system_state"]
+
+    def capture(snap, cfg):
+        state = get_system_state(snap, cfg)
+        states.append(state)
+        return state
+
+    ns["get_system_state"] = capture
+    sim.run(Source("demo", days=days, step=tick).events())
+    return ns, states
+
+
+def layouts(ns):
+    """(nome, conversione da record serializzato) per ogni layout misurato."""
+    schema = ns["STATE_SCHEMA"]
+    names = [f[0] for f in schema]
+    numeric = [i for i, f in enumerate(schema) if f[1] in ("num", "opt", "bool")]
+    nan = math.nan
+
+    def as_dict(values):
+        return dict(zip(names, values))
+
+    def as_array(values):
+        return array("d", [nan if values[i] is None else values[i] for i in numeric])
+
+    return (
+        ("dizionario (chiave per campo)", as_dict),
+        ("record lista (STATE_SCHEMA)", list),
+        ("tupla", tuple),
+        (f"array('d') ({len(numeric)} numerici)", as_array),
+    )
+
+
+def measure(rows, convert):
+    """Byte allocati per snapshot conservando tutti gli stati nel layout indicato."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [convert(pickle.loads(row)) for row in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=3, help="giorni di storico sintetico")
+    parser.add_argument("--tick", type=int, default=45, help="secondi tra un tick e l'altro")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    started = time.perf_counter()
+    ns, states = collect(args.days, args.tick)
+    errors = schema_errors(ns)
+    invalid = [(n, ns["state_invalid"](s)) for n, s in enumerate(states) if ns["state_invalid"](s)]
+    print(f"stati raccolti: {len(states)} in {time.perf_counter() - started:.1f}s, "
+          f"{len(ns['STATE_SCHEMA'])} campi per stato")
+    for error in errors:
+        print(f"schema: {error}")
+    for n, fields in invalid[:5]:
+        print(f"stato {n}: tipi non validi per {fields}")
+
+    shared = [i for i, f in enumerate(ns["STATE_SCHEMA"]) if f[1] in SHARED_KINDS]
+    rows = []
+    for state in states:
+        values = list(state)
+        for i in shared:
+            values[i] = None
+        rows.append(pickle.dumps(values))
+
+    print(f"{'layout':34s} {'byte/snapshot':>13s} {'KiB per 1000':>12s} {'rispetto al dict':>16s}")
+    results = [(name, measure(rows, convert)) for name, convert in layouts(ns)]
+    reference = results[0][1]
+    for name, size in results:
+        print(f"{name:34s} {size:13.0f} {size * 1000 / 1024:12.1f} {reference / size:15.2f}x")
+    sys.exit(1 if errors or invalid else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+"""
+Wallbox Dynamic Controller - ricerca dei parametri su giorni registrati
+Valuta migliaia di combinazioni di parametri sullo stesso storico eseguendo le regole SCENARIO 8-13
+(più protezione sovracorrente, stabilizzazione, anti-flap e modello impianto di tools/replay.py) come
+operazioni NumPy su tutte le combinazioni insieme, tick dopo tick, e riporta il fronte di Pareto
+autoconsumo / energia alla EV / cicli pausa-ripresa.
+
+Uso:
+  python tools/sweep.py storico.csv [--grid parametro=inizio:fine:passi ...] [--workers 0] [--out risultati.csv]
+  python tools/sweep.py --demo --demo-days 3
+  python tools/sweep.py --check     (confronto con il percorso scalare dello script)
+
+Parametri della griglia: pv_safety_margin_ratio, batt_discharge_margin, min_power_ratio_for_min_amps,
+stabilization_delta_amp e l'helper battery_priority_ratio (valori separati da virgola oppure inizio:fine:passi).
+Il riferimento resta il percorso scalare per tick di wallbox_charging_control.py: --check lo confronta con
+la versione vettoriale su stati casuali (calculate_target_amps) e su uno storico completo a ciclo chiuso.
+Valido con smoothing_mode "raw", forecast_charge disattivato, regulator_mode "open_loop" e senza orario di
+partenza EV (filtri su finestra mobile, previsione FTV, regolatore PI e piano di carica non sono vettorializzati).
+Il degrado per letture non aggiornate non è simulato: lo storico viene campionato con l'ultimo valore noto.
+Richiede numpy.
+"""
+import argparse
+import csv
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay import Simulation, Source, open_source, parse_overrides  # noqa: E402
+
+SWEEP_PARAMS = ("pv_safety_margin_ratio", "batt_discharge_margin", "min_power_ratio_for_min_amps",
+                "stabilization_delta_amp", "battery_priority_ratio")
+
+DEFAULT_GRID = {
+    "pv_safety_margin_ratio": "0:0.3:7",
+    "batt_discharge_margin": "0.6:1.0:5",
+    "min_power_ratio_for_min_amps": "0.5:0.9:5",
+    "stabilization_delta_amp": "0.5,1,1.5,2",
+    "battery_priority_ratio": "0:100:5",
+}
+
+# Colonne per tick dello storico campionato (valori registrati, indipendenti dalle decisioni)
+DATA_FIELDS = (
+    "ts", "pv_power", "pv_excess", "soc", "soc_min", "soc_priority", "batt_max", "voltage", "plant_voltage",
+    "min_amp", "max_amp", "min_wallbox_power", "home_max_current", "home_current_rec", "wallbox_rec",
+    "batt_rec", "grid_rec", "charging", "forzacharge", "emergency", "sun_low", "stimulus",
+    "pre_pause", "hard_pause", "rule_pause", "batt_ratio", "departure",
+)
+
+
+# === CAMPIONAMENTO DELLO STORICO ===
+
+class TickSampler(Simulation):
+    """
+    Stessa lettura in streaming e sample-and-hold del simulatore, ma ad ogni tick registra solo gli ingressi
+    del controllore. Le regole che non dipendono dai parametri della griglia (controlli preliminari, pause
+    SCENARI 0-7, tensione, rete) vengono valutate qui una volta con le funzioni dello script.
+    """
+
+    def __init__(self, params=None, tick=45):
+        Simulation.__init__(self, params, tick)
+        self.rows = []
+
+    def run_tick(self, ts):
+        ns = self.ns
+        cfg = ns["CONFIG"]
+        rec = self.rec
+        snap = dict(self.snap)
+        for field in ("home_power", "home_current", "wallbox_power", "batt_power"):
+            snap[field] = rec[field]
+        snap["timestamp"] = ts
+        snap["time"] = time.strftime("%H:%M", time.localtime(ts))
+        ns["TICK"]["now"] = ts
+        ns["TICK"]["debug"] = False
+        record = ns["get_system_state"](snap, cfg)
+        state = dict(zip(ns["STATE_INDEX"], record))
+        pre_pause = ns["controlli_preliminari"](snap, cfg) is not None
+        hard_pause = state["voltage"] <= 0 or (not state["grid_present"] and state["soc_attuale"] < state["soc_min"])
+        rule_pause = False
+        if not (pre_pause or hard_pause):
+            rules = list(record)
+            # SCENARIO 3 dipende dalla corrente simulata: è gestito dalla protezione vettoriale
+            rules[ns["S_HOME_CURRENT"]] = state["home_max_current"]
+            rule_pause = ns["determine_pause_reason"](rules, cfg) is not None
+        emergency = state["emergency"]
+        stimulus = 0.0
+        if (not state["inverter_secondary_active"]) and state["soc_attuale"] >= state["soc_min"] and \
+                state["pv_potential_secondary"] > state["min_wallbox_power"]:
+            stimulus = state["pv_potential_secondary"]
+        pv = max(0.0, rec["pv1"] + rec["pv2"] + rec["pv_secondary"] - rec["pv_losses"])
+        self.rows.append((
+            ts, pv, state["pv_excess"], state["soc_attuale"], state["soc_min"], state["soc_priority"],
+            state["batt_max_discharge"], state["voltage"], rec["voltage"] if rec["voltage"] > 0 else 230.0,
+            state["min_amp"], state["max_amp"], state["min_wallbox_power"], state["home_max_current"],
+            rec["home_current"], rec["wallbox_power"], rec["batt_power"], rec["home_power"] - pv - rec["batt_power"],
+            rec["wallbox_state"] != "idle", bool(state["forzacharge"]), emergency,
+            state["sun_elevation"] < state["elevation_limit"] and not state["is_rising"], stimulus,
+            pre_pause, hard_pause, rule_pause, state["batt_priority_ratio"], snap["ev_departure"] is not None,
+        ))
+
+    def data(self):
+        columns = list(zip(*self.rows)) if self.rows else [[] for _ in DATA_FIELDS]
+        return {name: np.array(col, dtype=float) for name, col in zip(DATA_FIELDS, columns)}
+
+
+def set_helpers(sim, helpers):
+    # Valori fissi per helper di CONFIG["entities"] (chiave -> valore), come se fossero nello storico
+    for key, value in (helpers or {}).items():
+        sim.event(sim.entities[key], str(value), None)
+
+
+def sample_history(source, params=None, tick=45, helpers=None):
+    sampler = TickSampler(params, tick)
+    set_helpers(sampler, helpers)
+    sampler.run(source.events())
+    return sampler.data(), sampler.ns["CONFIG"]["params"]
+
+
+# === REGOLE VETTORIALI ===
+
+def split_vec(delta, batt, grid, batt_max, batt_available, batt_full):
+    """Plant.split di tools/replay.py su array."""
+    pos = delta >= 0
+    from_export = np.minimum(delta, np.maximum(0.0, -grid))
+    rest_pos = delta - from_export
+    from_batt = np.where(batt_available, np.minimum(rest_pos, np.maximum(0.0, batt_max - batt)), 0.0)
+    rest_neg = -delta
+    from_grid = np.minimum(rest_neg, np.maximum(0.0, grid))
+    rest_neg = rest_neg - from_grid
+    to_batt = np.where(batt_full, 0.0, rest_neg)
+    batt_out = np.where(pos, batt + from_batt, batt - to_batt)
+    grid_out = np.where(pos, grid + from_export + rest_pos - from_batt, grid - from_grid - (rest_neg - to_batt))
+    return batt_out, grid_out
+
+
+def target_amps_vec(s, p, wallbox_power, batt_power, fixed):
+    """
+    calculate_target_amps (SCENARI 8-13) su array: s = ingressi del tick, p = parametri per combinazione,
+    wallbox_power / batt_power = valori simulati. Restituisce (ampere, pausa richiesta).
+    """
+    min_wb = s["min_wallbox_power"]
+    min_amp = s["min_amp"]
+    soc = s["soc"]
+    emergency = s["emergency"] > 0
+    shape = np.broadcast(wallbox_power, p["pv_safety_margin_ratio"], s["pv_excess"]).shape
+    available = np.where(emergency, min_wb, 0.0) * np.ones(shape)
+
+    # SCENARIO 9: scarica batteria eccessiva (ha la precedenza sull'emergenza, come nel percorso scalare)
+    discharge_limit = s["batt_max"] * p["batt_discharge_margin"]
+    s9 = (s["forzacharge"] == 0) & (batt_power > discharge_limit) & ((s["pv_excess"] < 100) | (soc < s["soc_priority"]))
+    available = np.where(s9, np.maximum(0.0, wallbox_power - (batt_power - discharge_limit) - fixed["buffer_watts_on_discharge_reduce"]), available)
+
+    # SCENARI 10-12
+    eff = s["pv_excess"] + s["stimulus"]
+    min_thr = min_wb * p["min_power_ratio_for_min_amps"]
+    after_min = eff - min_wb
+    s11 = min_wb + (after_min - after_min * (p["battery_priority_ratio"] / 100.0))
+    s12a = np.where(eff >= min_wb, eff, np.where(eff >= min_thr, min_wb, 0.0))
+    s12b = np.maximum(0.0, eff - eff * p["pv_safety_margin_ratio"])
+    s12c = np.where(eff >= min_thr, min_wb, 0.0)
+    s12 = np.where(soc > fixed["force_charge_soc_threshold"], s12a, np.where(eff >= min_wb, s12b, s12c))
+    branch = np.where(soc < s["soc_min"], 0.0,
+                      np.where(soc < s["soc_priority"], np.where(eff >= min_wb, s11, 0.0), s12))
+    available = np.where(available <= 0, branch, available)
+
+    # SCENARIO 13: conversione in ampere
+    voltage = s["voltage"]
+    positive = (available > 0) & (voltage > 0)
+    safe_voltage = np.where(voltage > 0, voltage, 1.0)
+    available_amp = available / safe_voltage
+    clamped = np.round(np.maximum(min_amp, np.minimum(s["max_amp"], available_amp)))
+    above_min = available_amp >= min_amp
+    forced_min = available >= min_thr
+    amps = np.where(positive & above_min, clamped, np.where(positive & forced_min, np.trunc(min_amp), 0.0))
+    pause = (s["sun_low"] > 0) & ~emergency
+    pause = pause | (positive & ~above_min & ~forced_min)
+    amps = np.where((amps > 0) & (amps < min_amp), 0.0, amps)
+    return amps, pause
+
+
+def run_combos(data, combos, fixed, tick, trace=()):
+    """
+    Ciclo chiuso su tutte le combinazioni: ad ogni tick modello impianto, protezione sovracorrente, pause
+    SCENARI 0-7, SCENARI 8-13, stabilizzazione e anti-flap, con lo stato (comandi, store) per combinazione.
+    """
+    k = len(next(iter(combos.values())))
+    p = {name: np.asarray(values, dtype=float) for name, values in combos.items()}
+    dev_paused = np.ones(k, dtype=bool)          # ultimo comando di modalità (DEFAULTS: in pausa)
+    dev_current = np.full(k, fixed["initial_current"])
+    store_mode = np.full(k, -1)                 # -1 = nessuna, 0 = normal, 1 = paused
+    mode_ts = np.zeros(k)
+    last_amps = np.zeros(k)
+    budget = int(fixed["max_transitions_per_hour"] or 0)
+    ring = np.full((k, max(1, budget)), -np.inf)
+    ring_pos = np.zeros(k, dtype=int)
+    rows = np.arange(k)
+    ev_wh = np.zeros(k)
+    export_wh = np.zeros(k)
+    import_wh = np.zeros(k)
+    resumes = np.zeros(k, dtype=int)
+    deferred = np.zeros(k, dtype=int)
+    traces = {i: [] for i in trace}
+    n = len(data["ts"])
+    for t in range(n):
+        s = {name: col[t] for name, col in data.items()}
+        now = s["ts"]
+        voltage = s["plant_voltage"]
+        batt_args = (s["batt_max"], s["soc"] > s["soc_min"], s["soc"] >= 99.0)
+
+        def plant():
+            wallbox = np.where(~dev_paused & (s["charging"] > 0), dev_current * voltage, 0.0)
+            batt, grid = split_vec(wallbox - s["wallbox_rec"], s["batt_rec"], s["grid_rec"], *batt_args)
+            return wallbox, batt, grid
+
+        wallbox, batt, grid = plant()
+        home_current = s["home_current_rec"] + (wallbox - s["wallbox_rec"]) / voltage
+        if "battery_priority_ratio" not in combos:
+            p["battery_priority_ratio"] = s["batt_ratio"]
+
+        final = np.zeros(k)
+        pause = np.ones(k, dtype=bool)
+        set_paused = np.zeros(k, dtype=bool)      # comando "paused"
+        set_normal = np.zeros(k, dtype=bool)      # comando "normal"
+        set_current = np.zeros(k, dtype=bool)     # comando corrente = final
+
+        if s["pre_pause"]:
+            set_paused[:] = True
+        else:
+            # SCENARIO 3 (fast-path)
+            over = home_current > s["home_max_current"]
+            if fixed["overcurrent_proportional_cut"] and s["voltage"] > 0:
+                cut = np.trunc(wallbox / s["voltage"] - (home_current - s["home_max_current"]))
+                cut = np.where(dev_current > 0, np.minimum(cut, dev_current), cut)
+                cut_ok = over & (cut >= s["min_amp"])
+            else:
+                cut = np.zeros(k)
+                cut_ok = np.zeros(k, dtype=bool)
+            guard_pause = over & ~cut_ok
+            final = np.where(cut_ok, cut, final)
+            pause = np.where(cut_ok, False, pause)
+            set_current |= cut_ok
+            set_paused |= guard_pause
+            last_amps = np.where(cut_ok, cut, last_amps)
+            free = ~over
+            if s["hard_pause"] or s["rule_pause"]:
+                set_paused |= free
+            else:
+                target, want_pause = target_amps_vec(s, p, wallbox, batt, fixed)
+                target = np.where(want_pause, 0.0, target)
+                # SCENARIO 16: stabilizzazione
+                stab = (target > 0) & (last_amps > 0) & (np.abs(target - last_amps) < p["stabilization_delta_amp"])
+                amps = np.where(stab, np.trunc(last_amps), target)
+                want_pause = (target == 0) | (amps < s["min_amp"])
+                # Anti-flap: carica minima prima della pausa, pausa minima e budget orario prima della ripresa
+                elapsed = now - mode_ts
+                hold_charge = want_pause & (store_mode == 0) & (elapsed < fixed["min_charge_seconds"])
+                recent_full = (ring.min(axis=1) > now - 3600) if budget else np.zeros(k, dtype=bool)
+                hold_pause = ~want_pause & (store_mode == 1) & ((elapsed < fixed["min_pause_seconds"]) | recent_full)
+                deferred += free & (hold_charge | hold_pause)
+                charge = free & ((~want_pause & ~hold_pause) | hold_charge)
+                final = np.where(charge, np.where(hold_charge, np.trunc(s["min_amp"]), amps), final)
+                pause = np.where(charge, False, pause)
+                set_current |= charge
+                set_normal |= charge
+                set_paused |= free & ~charge
+
+        dev_current = np.where(set_current, final, dev_current)
+        dev_paused = np.where(set_normal, False, np.where(set_paused, True, dev_paused))
+        # store_record
+        new_mode = np.where(pause, 1, 0)
+        changed = store_mode != new_mode
+        transition = changed & (store_mode >= 0)
+        if budget and transition.any():
+            idx = rows[transition]
+            ring[idx, ring_pos[idx]] = now
+            ring_pos[idx] = (ring_pos[idx] + 1) % budget
+        resumes += (store_mode == 1) & (new_mode == 0)
+        mode_ts = np.where(changed, now, mode_ts)
+        store_mode = new_mode
+        last_amps = np.where(~pause & (final > 0), final, last_amps)
+        for i in traces:
+            traces[i].append(("paused" if dev_paused[i] else "normal", float(dev_current[i])))
+
+        # Energie fino al tick successivo con i comandi appena applicati
+        dt = (data["ts"][t + 1] - now) if t + 1 < n else 0.0
+        if 0 < dt <= 3600:
+            wallbox, batt, grid = plant()
+            h = dt / 3600.0
+            ev_wh += wallbox * h
+            export_wh += np.maximum(0.0, -grid) * h
+            import_wh += np.maximum(0.0, grid) * h
+    return {"ev_wh": ev_wh, "export_wh": export_wh, "import_wh": import_wh,
+            "resumes": resumes, "deferred": deferred, "traces": traces}
+
+
+def pv_energy_wh(data):
+    dt = np.diff(data["ts"])
+    dt = np.where((dt > 0) & (dt <= 3600), dt, 0.0)
+    return float(np.sum(data["pv_power"][:-1] * dt) / 3600.0)
+
+
+# === GRIGLIA, PROCESS POOL E FRONTE DI PARETO ===
+
+def parse_grid(spec):
+    if ":" in spec:
+        start, stop, steps = spec.split(":")
+        return [round(v, 6) for v in np.linspace(float(start), float(stop), int(steps))]
+    return [float(v) for v in spec.split(",")]
+
+
+def build_combos(grid):
+    names = [name for name in SWEEP_PARAMS if name in grid]
+    values = list(itertools.product(*[grid[name] for name in names]))
+    return {name: np.array([v[i] for v in values]) for i, name in enumerate(names)}
+
+
+def fixed_params(params):
+    fixed = {key: params[key] for key in (
+        "buffer_watts_on_discharge_reduce", "force_charge_soc_threshold", "overcurrent_proportional_cut",
+        "min_charge_seconds", "min_pause_seconds", "max_transitions_per_hour")}
+    fixed["initial_current"] = 6.0
+    return fixed
+
+
+def sweep_chunk(data, combos, fixed, tick):
+    result = run_combos(data, combos, fixed, tick)
+    result.pop("traces")
+    return result
+
+
+def sweep(data, combos, fixed, tick, workers=1):
+    """Divide le combinazioni tra i processi: ogni processo esegue il ciclo chiuso sul suo blocco."""
+    k = len(next(iter(combos.values())))
+    chunks = max(1, min(workers, k))
+    bounds = np.linspace(0, k, chunks + 1).astype(int)
+    parts = [{name: values[a:b] for name, values in combos.items()} for a, b in zip(bounds[:-1], bounds[1:])]
+    if chunks == 1:
+        results = [sweep_chunk(data, parts[0], fixed, tick)]
+    else:
+        with ProcessPoolExecutor(max_workers=chunks) as pool:
+            results = list(pool.map(sweep_chunk, [data] * chunks, parts, [fixed] * chunks, [tick] * chunks))
+    return {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+
+
+def pareto_front(objectives):
+    """Indici non dominati; objectives (k, m) da massimizzare."""
+    k = len(objectives)
+    dominated = np.zeros(k, dtype=bool)
+    for start in range(0, k, 512):
+        block = objectives[start:start + 512, None, :]
+        ge = np.all(objectives[None, :, :] >= block, axis=2)
+        gt = np.any(objectives[None, :, :] > block, axis=2)
+        dominated[start:start + 512] = np.any(ge & gt, axis=1)
+    return np.flatnonzero(~dominated)
+
+
+# === CONFRONTO CON IL PERCORSO SCALARE ===
+
+def check_target_amps(ns, samples=20000, seed=1):
+    """calculate_target_amps scalare contro target_amps_vec su stati e parametri casuali."""
+    rnd = random.Random(seed)
+    cfg = ns["CONFIG"]
+    base = dict(cfg["params"])
+    ns["TICK"]["debug"] = False
+    ns["STORE"]["data"] = ns["store_new"]()
+    rows = []
+    for _ in range(samples):
+        voltage = rnd.choice([0.0, 220.0, 230.0, 241.5])
+        min_amp = rnd.choice([6, 6, 8])
+        state = {
+            "pv_excess": rnd.uniform(-500, 7000), "soc_attuale": rnd.uniform(0, 100), "soc_min": rnd.choice([10, 20, 30]),
+            "soc_priority": rnd.choice([50, 60, 80]), "batt_max_discharge": rnd.choice([2000, 3000]),
+            "batt_power": rnd.uniform(-3000, 4000), "wallbox_power": rnd.uniform(0, 3700), "voltage": voltage,
+            "min_amp": min_amp, "max_amp": rnd.choice([0, 10, 16, 32]), "min_wallbox_power": min_amp * voltage,
+            "forzacharge": rnd.random() < 0.1, "ev_soc": rnd.choice([None, 5.0, 50.0]), "ev_soc_emergenza": rnd.choice([0, 10]),
+            "sun_elevation": rnd.uniform(-10, 60), "elevation_limit": 10, "is_rising": rnd.random() < 0.5,
+            "inverter_secondary_active": rnd.random() < 0.5, "pv_potential_secondary": rnd.uniform(0, 3000),
+            "batt_priority_ratio": rnd.uniform(0, 100),
+        }
+        params = {name: rnd.uniform(*bounds) for name, bounds in (
+            ("pv_safety_margin_ratio", (0, 0.4)), ("batt_discharge_margin", (0.5, 1.0)),
+            ("min_power_ratio_for_min_amps", (0.3, 1.0)))}
+        cfg["params"].update(params)
+        state["emergency"] = ns["ev_emergency"](state["ev_soc"], state["ev_soc_emergenza"])
+        amps, reason = ns["calculate_target_amps"](ns["state_new"](state), cfg)
+        rows.append((state, params, amps, reason is not None))
+    cfg["params"].clear()
+    cfg["params"].update(base)
+
+    def col(key):
+        return np.array([r[0][key] if r[0][key] is not None else np.nan for r in rows], dtype=float)
+
+    emergency = np.array([r[0]["ev_soc"] is not None and bool(r[0]["ev_soc_emergenza"]) and r[0]["ev_soc"] < r[0]["ev_soc_emergenza"]
+                          and r[0]["ev_soc"] < 99.0 for r in rows])
+    stimulus = np.where((col("inverter_secondary_active") == 0) & (col("soc_attuale") >= col("soc_min"))
+                        & (col("pv_potential_secondary") > col("min_wallbox_power")), col("pv_potential_secondary"), 0.0)
+    s = {"pv_excess": col("pv_excess"), "soc": col("soc_attuale"), "soc_min": col("soc_min"), "soc_priority": col("soc_priority"),
+         "batt_max": col("batt_max_discharge"), "voltage": col("voltage"), "min_amp": col("min_amp"), "max_amp": col("max_amp"),
+         "min_wallbox_power": col("min_wallbox_power"), "forzacharge": col("forzacharge"), "emergency": emergency.astype(float),
+         "sun_low": ((col("sun_elevation") < col("elevation_limit")) & (col("is_rising") == 0)).astype(float), "stimulus": stimulus}
+    p = {name: np.array([r[1][name] for r in rows]) for name in rows[0][1]}
+    p["battery_priority_ratio"] = col("batt_priority_ratio")
+    amps, pause = target_amps_vec(s, p, col("wallbox_power"), col("batt_power"), fixed_params(base))
+    expected_amps = np.array([r[2] for r in rows], dtype=float)
+    expected_pause = np.array([r[3] for r in rows])
+    return int(np.sum((amps != expected_amps) | (pause != expected_pause))), samples
+
+
+def check_closed_loop(combos=6, days=2, tick=45, seed=3, helpers=None):
+    """Storico sintetico campionato al tick: comandi della versione vettoriale contro il simulatore scalare."""
+    rnd = random.Random(seed)
+    source = Source("demo", days=days, step=tick)
+    data, params = sample_history(source, tick=tick, helpers=helpers)
+    grid = {name: [rnd.choice(parse_grid(DEFAULT_GRID[name])) for _ in range(combos)] for name in SWEEP_PARAMS}
+    vector = run_combos(data, {name: np.array(v) for name, v in grid.items()}, fixed_params(params), tick, trace=range(combos))
+    mismatches = 0
+    for i in range(combos):
+        overrides = {name: grid[name][i] for name in SWEEP_PARAMS if name != "battery_priority_ratio"}
+        sim = Simulation(overrides, tick)
+        set_helpers(sim, helpers)
+        sim.event(sim.entities["battery_priority_ratio"], str(grid["battery_priority_ratio"][i]), None)
+        scalar = []
+        run_tick = sim.ns["run_tick"]
+
+        def traced(snap, start_ts, run_tick=run_tick, scalar=scalar):
+            run_tick(snap, start_ts)
+            scalar.append((snap["wallbox_mode"], float(snap["wallbox_current_set"])))
+
+        sim.ns["run_tick"] = traced
+        sim.run(source.events())
+        if scalar != vector["traces"][i]:
+            mismatches += 1
+            first = next(t for t, (a, b) in enumerate(zip(scalar, vector["traces"][i])) if a != b)
+            print(f"combinazione {i} ({overrides}): primo tick diverso {first}: scalare {scalar[first]} vettoriale {vector['traces'][i][first]}")
+    return mismatches, combos
+
+
+# === CLI ===
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", nargs="?", help="CSV o database SQLite del recorder")
+    parser.add_argument("--tick", type=float, default=45)
+    parser.add_argument("--grid", action="append", metavar="PARAM=SPEC", help="valori di un parametro (a,b,c oppure inizio:fine:passi)")
+    parser.add_argument("--set", action="append", metavar="PARAM=VALORE", help="parametri fissi (CONFIG['params'])")
+    parser.add_argument("--workers", type=int, default=0, help="processi paralleli (0 = tutti i core)")
+    parser.add_argument("--out", help="CSV con i risultati di tutte le combinazioni")
+    parser.add_argument("--demo", action="store_true")
+    parser.add_argument("--demo-days", type=int, default=1)
+    parser.add_argument("--check", action="store_true", help="confronta la versione vettoriale con il percorso scalare")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.check:
+        sim = Simulation()
+        bad_amps, total = check_target_amps(sim.ns)
+        print(f"calculate_target_amps: {bad_amps} differenze su {total} stati casuali")
+        bad_loop = 0
+        # Helper di default e helper stretti (taglio per sovracorrente e SCENARIO 9 frequenti)
+        for seed, helpers in ((3, None), (4, {"home_max_current": 12, "batt_max_discharge": 1500, "batt_soc": 55})):
+            bad, combos = check_closed_loop(seed=seed, helpers=helpers)
+            bad_loop += bad
+            print(f"ciclo chiuso {helpers or 'default'}: {bad} combinazioni diverse su {combos}")
+        sys.exit(1 if bad_amps or bad_loop else 0)
+
+    if not args.source and not args.demo:
+        parser.error("indicare un CSV, un database del recorder oppure --demo")
+    overrides = parse_overrides(args.set)
+    if args.demo:
+        source = Source("demo", days=args.demo_days, step=args.tick)
+    else:
+        source = open_source(args.source, Simulation().fields_by_entity)
+    started = time.perf_counter()
+    data, params = sample_history(source, overrides, args.tick)
+    if params.get("smoothing_mode", "raw") != "raw":
+        print("attenzione: smoothing_mode diverso da 'raw' non è modellato dalla versione vettoriale")
+    if params.get("forecast_charge", False):
+        print("attenzione: forecast_charge (SCENARI 8b e 12d) non è modellato dalla versione vettoriale")
+    if params.get("regulator_mode", "open_loop") != "open_loop":
+        print("attenzione: regulator_mode 'pi' non è modellato dalla versione vettoriale (ampere ad anello aperto)")
+    if data["departure"].any():
+        print("attenzione: orario di partenza EV nello storico, il piano di carica non è modellato dalla versione vettoriale")
+    grid = {name: parse_grid(spec) for name, spec in DEFAULT_GRID.items()}
+    for item in args.grid or []:
+        name, spec = item.split("=", 1)
+        if name not in SWEEP_PARAMS:
+            parser.error(f"parametro non supportato: {name}")
+        grid[name] = parse_grid(spec)
+    combos = build_combos(grid)
+    sampled = time.perf_counter()
+    result = sweep(data, combos, fixed_params(params), args.tick, args.workers or os.cpu_count() or 1)
+    elapsed = time.perf_counter() - sampled
+
+    pv_wh = pv_energy_wh(data)
+    self_consumption = 1.0 - result["export_wh"] / pv_wh if pv_wh > 0 else np.zeros(len(result["export_wh"]))
+    objectives = np.column_stack([self_consumption, result["ev_wh"], -result["resumes"]])
+    front = pareto_front(objectives)
+    front = front[np.argsort(-result["ev_wh"][front])]
+    names = list(combos)
+    k = len(result["ev_wh"])
+    print(f"tick: {len(data['ts'])}  combinazioni: {k}  campionamento {sampled - started:.2f}s  "
+          f"sweep {elapsed:.2f}s ({k * len(data['ts']) / max(elapsed, 1e-9):.0f} tick-combinazione/s)")
+    print(f"fronte di Pareto ({len(front)} combinazioni): autoconsumo / kWh EV / cicli")
+    print("  ".join(names + ["autoconsumo", "ev_kwh", "import_kwh", "cicli"]))
+    for i in front:
+        values = [f"{combos[name][i]:g}" for name in names]
+        values += [f"{self_consumption[i]:.3f}", f"{result['ev_wh'][i] / 1000:.2f}",
+                   f"{result['import_wh'][i] / 1000:.2f}", str(result["resumes"][i])]
+        print("  ".join(values))
+    if args.out:
+        with open(args.out, "w", newline="", encoding="utf8") as fil:
+            writer = csv.writer(fil)
+            writer.writerow(names + ["self_consumption", "ev_kwh", "grid_import_kwh", "cycles", "deferred", "pareto"])
+            on_front = set(front.tolist())
+            for i in range(k):
+                writer.writerow([combos[name][i] for name in names] + [
+                    round(float(self_consumption[i]), 4), round(result["ev_wh"][i] / 1000, 3),
+                    round(result["import_wh"][i] / 1000, 3), int(result["resumes"][i]), int(result["deferred"][i]), i in on_front])
+
+
+if __name__ == "__main__":
+    main()
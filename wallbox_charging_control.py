@@ -34,6 +34,7 @@ CONFIG = {
         "ev_soc": "sensor.ev3_ev_battery_level",
         "ev_target_soc": "input_number.ev_target_soc",
         "ev_soc_emergenza": "input_number.ev_soc_emergenza",
+        "ev_departure_time": "input_datetime.ev_departure_time",
         "time": "sensor.time",
         "pause_start_time": "input_datetime.wbox_orainizio",
         "pause_end_time": "input_datetime.wbox_orafine",
@@ -44,8 +45,17 @@ CONFIG = {
         "date_time_iso": "sensor.date_time_iso",
         "last_wbox_tag": "input_datetime.last_wbox_tag",
         "status_sensor": "sensor.wallbox_status",
+        "controller_state": "sensor.wallbox_controller_state",
+        "diagnostics_sensor": "sensor.wallbox_diagnostics",
+        "energy_solar_sensor": "sensor.wallbox_energy_solar",
+        "energy_battery_sensor": "sensor.wallbox_energy_battery",
+        "energy_grid_sensor": "sensor.wallbox_energy_grid",
         "grid": "binary_sensor.deyeha_grid"
     },
+    # Più wallbox sullo stesso contatore (vuoto = una sola wallbox con le entità qui sopra). Ogni voce:
+    # {"name": "garage", "priority": 1, "entities": {...}, "params": {...}} dove "entities" sostituisce le entità
+    # della singola wallbox (CHARGER_KEYS) e "params" eventuali parametri; le altre entità sono comuni.
+    "chargers": [],
     "params": {
         "post_tag_lock_seconds": 180,
         "stabilization_delta_amp": 1.0,
@@ -56,28 +66,172 @@ CONFIG = {
         "pv_safety_margin_ratio": 0.1,
         "batt_protection_cycles_on_fault": 3,
         "buffer_watts_on_discharge_reduce": 50,
-        "min_amp_default": 6
+        "min_amp_default": 6,
+        "command_reassert_seconds": 900,
+        "command_timeout_seconds": 5.0,   # runtime residente: attesa massima della conferma di ogni comando
+        "command_retries": 2,             # ripetizioni dopo un errore o un timeout, con attesa raddoppiata
+        "command_backoff_seconds": 0.5,   # a ogni tentativo (0.5s, 1s...)
+        "overcurrent_proportional_cut": True,
+        "store_history_size": 20,
+        "store_persist_seconds": 300,
+        "smoothing_mode": "raw",           # raw / ema / pessimistic / worst
+        "smoothing_window": 12,
+        "smoothing_ema_alpha": 0.3,
+        "smoothing_percentile": 20,
+        "smoothing_bin_watts": 10,
+        "smoothing_reset_seconds": 600,
+        "min_charge_seconds": 300,
+        "min_pause_seconds": 180,
+        "max_transitions_per_hour": 6,
+        "transition_cost_wh": 20,
+        "timing_window": 60,
+        "diagnostics_publish_seconds": 60,
+        "status_heartbeat_seconds": 600,   # sensore di stato riscritto almeno ogni N secondi anche senza cambiamenti
+        "status_deadband_watts": 50,       # variazione minima di potenze (W), SOC (%) e correnti (A) per riscriverlo
+        "status_deadband_percent": 1.0,
+        "status_deadband_amps": 0.5,
+        "energy_attribution": "home_first",  # energia alla EV per fonte: "home_first" (casa servita per prima) o "proportional"
+        "energy_max_gap_seconds": 900,    # intervalli tra due tick più lunghi di così non vengono integrati
+        "energy_days": 35,                # totali giornalieri e mensili conservati nello store
+        "energy_months": 24,
+        "energy_publish_seconds": 300,
+        "energy_grid_price": 0.25,        # €/kWh prelevati dalla rete
+        "energy_feed_in_price": 0.10,     # €/kWh ceduti: valore dell'energia FTV (anche passata dalla batteria) non venduta
+        "notification_update_seconds": 900,
+        "forecast_charge": False,         # usa la previsione FTV per SCENARIO 8 e l'avvio anticipato (12d)
+        "forecast_learn_days": 3,
+        "forecast_min_samples": 20,
+        "forecast_persistence_minutes": 30,
+        "forecast_start_ratio": 0.5,
+        "ev_battery_kwh": 58.3,           # capacità utile della batteria EV (piano di carica per la partenza)
+        "ev_charge_efficiency": 0.9,
+        "planner_slot_minutes": 5,
+        "planner_horizon_hours": 24,
+        "planner_solar_confidence": 0.8,
+        "planner_rebuild_seconds": 3600,
+        "stale_power_seconds": 300,      # età massima delle letture di potenza, corrente e tensione (0 = nessun controllo)
+        "stale_soc_seconds": 3600,        # età massima dei SOC di batteria di casa ed EV
+        "stale_helper_seconds": 180,      # età massima dei sensori template di data e ora
+        "regulator_mode": "open_loop",   # "pi": in SCENARIO 12b la corrente insegue il surplus con la potenza misurata
+        "regulator_margin_watts": 60,     # surplus lasciato a casa/batteria dal regolatore (invece di pv_safety_margin_ratio)
+        "regulator_kp": 0.2,
+        "regulator_ki": 0.01,             # per secondo
+        "regulator_integral_watts": 1500, # limite dell'integrale (anti-windup)
+        "regulator_deadband_watts": 40,   # errori più piccoli non vengono integrati
+        "regulator_rise_amps_per_second": 0.1,
+        "regulator_fall_amps_per_second": 0.5,
+        "regulator_follow_ratio": 0.7,    # l'auto assorbe meno di questa frazione del comando: integrale fermo
+        "regulator_reset_seconds": 300,   # oltre questo intervallo tra due tick il regolatore riparte da zero
+        "charger_allocation": "priority",  # multi-wallbox: "priority" (in ordine di priorità) o "fair" (in parti uguali)
+        "decision_table": True,           # runtime residente: scenari dalla tabella compilata (False = cascata)
+        "debug_trace": True
     }
 }
 
 # === 2. HELPERS I/O e LOGGING ===
+# Contesto del tick corrente: il flag di debug viene preso dallo snapshot una sola volta per esecuzione,
+# "device" è l'ultimo stato noto dei comandi wallbox, "commands" i contatori dei comandi inviati/soppressi,
+# "now" l'orario simulato durante il replay offline (None = orologio di sistema), "deferred" l'eventuale
+# transizione pausa/carica rimandata dall'anti-flap, "timing" i secondi spesi in ogni fase del tick,
+# "trace" la traccia delle decisioni del tick (None = debug spento o righe di log immediate), "notify" le
+# condizioni di notifica valutate nel tick, "charger" il nome della wallbox in esecuzione (None con una sola wallbox),
+# "queue" i comandi decisi nel tick e non ancora inviati (dispatch_begin), "track" il surplus da inseguire quando
+# la potenza viene da SCENARIO 12b (None negli altri scenari; usato dal regolatore PI)
+def tick_context():
+    # Campi di TICK con i valori iniziali, tranne "now": l'orologio vale per tutti (tick completo e fast-path)
+    return {"debug": None, "device": {}, "commands": {"issued": 0, "suppressed": 0}, "deferred": None, "timing": {},
+            "trace": None, "notify": {}, "charger": None, "queue": [], "track": None}
+
+TICK = tick_context()
+TICK["now"] = None
+
+def tick_swap(saved):
+    # Scambia i campi di TICK con quelli di saved (come store_swap): il fast-path sovracorrente lavora su un contesto
+    # proprio, senza toccare quello del tick completo che nel runtime residente attende gli esiti dei comandi
+    for k in saved:
+        current = TICK[k]
+        TICK[k] = saved[k]
+        saved[k] = current
+
+# Orologio delle durate: monotono nel runtime residente (passato in data["clock"]); come python_script la
+# sandbox espone solo time.time(), che resta comunque più preciso del sensore template current_timestamp
+PERF_CLOCK = data.get("clock") or time.time
+
+def now_ts():
+    return TICK["now"] if TICK["now"] is not None else time.time()
+
 def debug_enabled():
+    if TICK["debug"] is not None:
+        return TICK["debug"]
     try:
         s = hass.states.get(CONFIG["entities"]["debug_mode"])
         return s is not None and str(s.state).lower() == "on"
     except Exception:
         return False
 
-def log_debug(msg):
+def format_msg(msg, args):
+    # Argomenti in stile %: la stringa viene costruita solo quando il messaggio va davvero emesso
+    if not args:
+        return msg
     try:
-        if debug_enabled():
-            logger.info(f"[Wallbox DEBUG V 2025.11.0] {msg}")
+        return msg % args
+    except Exception:
+        return f"{msg} {args}"
+
+def log_debug(msg, *args):
+    """
+    Messaggio di debug pigro: log_debug("PW %.1fW", pw). Con debug spento non viene formattato nulla.
+    Durante un tick con traccia attiva il messaggio finisce nella traccia, emessa in un solo record a fine tick.
+    """
+    log_debug_args(msg, args)
+
+def log_debug_args(msg, args):
+    # Come log_debug, con gli argomenti già in una tupla (azioni della tabella decisionale)
+    try:
+        if not debug_enabled():
+            return
+        trace = TICK["trace"]
+        if trace is not None:
+            trace["events"].append((msg, args))
+        else:
+            logger.info(f"[Wallbox DEBUG V 2025.11.0] {format_msg(msg, args)}")
     except Exception:
         logger.info("[Wallbox DEBUG V 2025.11.0] (log error)")
 
-def log_warn(msg):
+def log_warn(msg, *args):
+    # Gli avvisi escono subito (anche con debug spento); con la traccia attiva compaiono anche nel record del tick
+    log_warn_args(msg, args)
+
+def log_warn_args(msg, args):
+    try:
+        text = format_msg(msg, args)
+        logger.warning(f"[Wallbox DEBUG V 2025.11.0] {text}")
+        trace = TICK["trace"]
+        if trace is not None:
+            trace["events"].append(("! %s", (text,)))
+    except Exception:
+        pass
+
+# === TRACCIA DECISIONALE PER TICK ===
+def trace_begin(snap, cfg):
+    if snap["debug"] and cfg["params"].get("debug_trace", True):
+        TICK["trace"] = {"hits": [], "events": []}
+    else:
+        TICK["trace"] = None
+
+def trace_flush(final_amps, pause_mode, pause_reason, duration):
+    """Emette la traccia del tick come un unico record: scenari attraversati, esito e messaggi in ordine."""
+    trace = TICK["trace"]
+    if trace is None:
+        return
+    TICK["trace"] = None
+    name = f" {TICK['charger']}" if TICK["charger"] else ""
+    lines = [f"[Wallbox DEBUG V 2025.11.0] TICK{name} {'PAUSA' if pause_mode else 'CARICA'} {final_amps}A"
+             f" - motivo: {pause_reason or 'Nessuno'} - durata {duration}s - scenari: {','.join(trace['hits']) or '-'}"]
+    for msg, args in trace["events"]:
+        lines.append("  " + format_msg(msg, args))
     try:
-        logger.warning(f"[Wallbox DEBUG V 2025.11.0] {msg}")
+        logger.info("\n".join(lines))
     except Exception:
         pass
 
@@ -87,15 +241,14 @@ def get_state_obj(entity_id):
     except Exception:
         return None
 
-def get_str(entity_id, default='unavailable'):
-    s = get_state_obj(entity_id)
+# Parser dei valori: lavorano sull'oggetto stato già letto, nessuna lettura aggiuntiva
+def parse_str(s, entity_id, default='unavailable'):
     if s is None:
         log_warn(f"Entità {entity_id} non trovata. Uso default '{default}'.")
         return default
     return s.state
 
-def get_float(entity_id, default=0.0, decimals=3):
-    s = get_state_obj(entity_id)
+def parse_float(s, entity_id, default=0.0, decimals=3):
     if s is None:
         log_warn(f"Entità {entity_id} non trovata. Uso default {default}.")
         return default
@@ -105,8 +258,16 @@ def get_float(entity_id, default=0.0, decimals=3):
         log_warn(f"Valore non numerico per {entity_id}: {s.state} -> uso default {default}")
         return default
 
-def get_float_attr(entity_id, attribute, default=0.0, decimals=3):
-    s = get_state_obj(entity_id)
+def parse_float_opt(s, decimals=1):
+    # None se sensore non disponibile o non numerico (non forziamo valori di default)
+    if s is None:
+        return None
+    try:
+        return round(float(s.state), decimals)
+    except Exception:
+        return None
+
+def parse_float_attr(s, entity_id, attribute, default=0.0, decimals=3):
     if s is None:
         log_warn(f"Entità {entity_id} non trovata per attributo '{attribute}'. Uso default {default}.")
         return default
@@ -117,14 +278,28 @@ def get_float_attr(entity_id, attribute, default=0.0, decimals=3):
         log_warn(f"Attributo non numerico per {entity_id}.{attribute}: {s.attributes.get(attribute)} -> uso default {default}")
         return default
 
-def get_attr(entity_id, attribute, default=None):
-    s = get_state_obj(entity_id)
+def parse_attr(s, attribute, default=None):
     if s is None:
         return default
     return s.attributes.get(attribute, default)
 
-def get_bool(entity_id, default=False):
-    s = get_state_obj(entity_id)
+def parse_updated(s):
+    # Timestamp (epoch) dell'ultimo aggiornamento dell'entità, 0 se non disponibile
+    if s is None:
+        return 0
+    try:
+        return s.last_updated.timestamp()
+    except Exception:
+        return 0
+
+def parse_reported(s):
+    # Ultima volta che l'integrazione ha riportato un valore, anche uguale al precedente (last_reported, HA 2024.3+)
+    try:
+        return s.last_reported.timestamp()
+    except Exception:
+        return parse_updated(s)
+
+def parse_bool(s, default=False):
     if s is None:
         return default
     v = s.state
@@ -138,6 +313,7 @@ def call_service(domain, service, data, log_error=True, blocking=False):
     (in alcuni ambienti la firma non accetta il keyword).
     Se necessario in futuro si può ripristinare comportamento diverso per altre integrazioni.
     """
+    started = PERF_CLOCK()
     try:
         # Non passare blocking come keyword per compatibilità con python_script
         hass.services.call(domain, service, data)
@@ -146,113 +322,1258 @@ def call_service(domain, service, data, log_error=True, blocking=False):
         if log_error:
             log_warn(f"Errore chiamata servizio {domain}.{service}: {e}")
         return False
+    finally:
+        stage_add("dispatch", started)
+
+# === HELPERS TEMPI PER FASE ===
+# Fasi misurate a ogni tick; "dispatch" somma il tempo delle chiamate di servizio ed è escluso dalle fasi
+# che le contengono, "total" va dall'inizio della lettura dello snapshot alla pubblicazione dello stato
+TIMING_STAGES = ("snapshot", "preliminari", "forecast", "planner", "pause_rules", "target_amps", "dispatch", "publish", "total")
+
+def stage_start():
+    return [PERF_CLOCK(), TICK["timing"].get("dispatch", 0.0)]
+
+def stage_end(stage, started):
+    # Tempo della fase al netto delle chiamate di servizio fatte nel frattempo
+    t = TICK["timing"]
+    dispatched = t.get("dispatch", 0.0) - started[1]
+    t[stage] = t.get(stage, 0.0) + (PERF_CLOCK() - started[0]) - dispatched
+
+def stage_add(stage, started):
+    t = TICK["timing"]
+    t[stage] = t.get(stage, 0.0) + (PERF_CLOCK() - started)
 
 # === HELPERS NOTIFICHE ===
+def notification_entity_id(notification_id):
+    # Con più wallbox ognuna ha le sue notifiche
+    return f"wallbox_{notification_id}_{TICK['charger']}" if TICK["charger"] else f"wallbox_{notification_id}"
+
 def send_persistent_notification(notification_id, title, message, priority="info"):
+    started = PERF_CLOCK()
     try:
         service_data = {
-            "notification_id": f"wallbox_{notification_id}",
+            "notification_id": notification_entity_id(notification_id),
             "title": title,
             "message": message
         }
         hass.services.call("persistent_notification", "create", service_data)
-        log_debug(f"Notifica persistente inviata: {notification_id}")
+        log_debug("Notifica persistente inviata: %s", notification_id)
         return True
     except Exception as e:
         log_warn(f"Errore invio notifica {notification_id}: {e}")
         return False
+    finally:
+        stage_add("dispatch", started)
 
 def dismiss_persistent_notification(notification_id):
+    # Chiamata solo sul fronte di disattivazione (notifications_sync): nessuna lettura dello stato della notifica
+    started = PERF_CLOCK()
     try:
-        entity_id = f"persistent_notification.wallbox_{notification_id}"
-        # Controlla se esiste lo stato della notifica prima di chiamare il servizio
-        if hass.states.get(entity_id) is None:
-            #log_debug(f"[Wallbox] Nessuna notifica persistente da rimuovere: {notification_id}")
-            return True
-        service_data = {"notification_id": f"wallbox_{notification_id}"}
+        service_data = {"notification_id": notification_entity_id(notification_id)}
         hass.services.call("persistent_notification", "dismiss", service_data)
-        log_debug(f"Notifica rimossa: {notification_id}")
+        log_debug("Notifica rimossa: %s", notification_id)
         return True
     except Exception as e:
         log_warn(f"Errore rimozione notifica {notification_id}: {e}")
         return False
+    finally:
+        stage_add("dispatch", started)
+
+# Notifiche gestite per fronti: ogni tick dichiara le condizioni che ha valutato (notify_condition) e a fine tick
+# notifications_sync invia create solo quando una condizione si attiva o il testo cambia (al massimo ogni
+# notification_update_seconds) e dismiss solo quando si spegne. Lo stato delle notifiche vive nello store;
+# per aggiungere una condizione basta una voce in NOTIFICATIONS, senza letture aggiuntive.
+NOTIFICATIONS = {
+    "ev_emergency": ("🚨 Emergenza EV - Carica Forzata", "error"),
+    "grid_absent_battery_low": ("⚠️ Grid Assente - Carica Bloccata", "warning"),
+}
+
+def notify_condition(notification_id, active, message=None):
+    TICK["notify"][notification_id] = (active, message)
+
+def notification_visible(notification_id):
+    # Solo con stato sconosciuto (store nuovo): le versioni precedenti non tenevano traccia delle notifiche inviate
+    return get_state_obj(f"persistent_notification.{notification_entity_id(notification_id)}") is not None
 
-# === 3. LETTURA STATO ===
-def get_system_state(cfg):
+def notifications_sync(cfg):
+    declared = TICK["notify"]
+    if not declared:
+        return
+    TICK["notify"] = {}
+    known = STORE["data"].setdefault("notifications", {})
+    every = cfg["params"].get("notification_update_seconds", 900)
+    now = now_ts()
+    for notification_id in declared:
+        active, message = declared[notification_id]
+        entry = known.get(notification_id)
+        if entry is None:
+            # Se la condizione è attiva la notifica viene (ri)creata comunque: la lettura serve solo per un eventuale dismiss
+            entry = {"active": (not active) and notification_visible(notification_id), "ts": 0, "msg": ""}
+            known[notification_id] = entry
+        if active:
+            changed = message != entry["msg"] and (now - entry["ts"]) >= every
+            if not entry["active"] or changed:
+                title, priority = NOTIFICATIONS[notification_id]
+                if TICK["charger"]:
+                    title = f"{title} ({TICK['charger']})"
+                if send_persistent_notification(notification_id, title, message, priority):
+                    known[notification_id] = {"active": True, "ts": now, "msg": message}
+        elif entry["active"]:
+            if dismiss_persistent_notification(notification_id):
+                known[notification_id] = {"active": False, "ts": now, "msg": ""}
+
+# === HELPERS COMANDI WALLBOX ===
+# I comandi vengono inviati solo se lo stato richiesto è diverso dall'ultimo stato noto del dispositivo,
+# oppure se quello stato non viene riaffermato da più di "command_reassert_seconds". L'ultima riaffermazione
+# è il più recente tra last_updated dell'entità e l'ultimo invio registrato nello store: HA non cambia
+# last_updated quando riceve la stessa opzione o lo stesso valore.
+def command_needed(current, desired, updated_ts, cfg, reassert=True):
+    if current is None or current != desired:
+        return True
+    max_age = cfg["params"].get("command_reassert_seconds", 0) if reassert else 0
+    if not max_age:
+        return False
+    return (not updated_ts) or (now_ts() - updated_ts) >= max_age
+
+def send_command(key, desired, domain, service, data, cfg, reassert=True):
+    dev = TICK["device"]
+    counters = TICK["commands"]
+    if not command_needed(dev.get(key), desired, dev.get(key + "_ts", 0), cfg, reassert):
+        counters["suppressed"] = counters["suppressed"] + 1
+        log_debug("Comando soppresso: %s.%s %s=%s già applicato", domain, service, key, desired)
+        return True
+    counters["issued"] = counters["issued"] + 1
+    # Stato del dispositivo aggiornato subito (un secondo comando uguale nello stesso tick viene soppresso);
+    # se l'invio fallisce dispatch_result lo riporta a sconosciuto
+    dev[key] = desired
+    dev[key + "_ts"] = now_ts()
+    STORE["data"].setdefault("sent", {})[key] = dev[key + "_ts"]
+    dispatch_queue("wallbox", key, domain, service, data, dev)
+    return True
+
+def command_wallbox_mode(mode, cfg):
     e = cfg["entities"]
-    p = cfg["params"]
-    s = {}
-
-    s["voltage"] = get_float(e["voltage"])
-    s["forzacharge"] = get_bool(e["force_charge"])
-    s["pv1"] = get_float(e["pv_primary_1"])
-    s["pv2"] = get_float(e["pv_primary_2"])
-    s["pv_primary"] = s["pv1"] + s["pv2"]
-    s["pv_secondary"] = get_float(e["pv_secondary"])
-    s["pv_losses"] = get_float(e["pv_losses"])
-    pv_lordo = s["pv_primary"] + s["pv_secondary"]
-    s["pv_power"] = max(0.0, pv_lordo - s["pv_losses"])
-    s["batt_power"] = get_float(e["batt_power"])
-    s["batt_max_discharge"] = get_float(e["batt_max_discharge"])
-    s["soc_attuale"] = get_float(e["batt_soc"])
-    s["soc_min"] = get_float(e["batt_soc_min"])
-    s["soc_priority"] = get_float(e["batt_soc_priority"])
-    s["home_power"] = get_float(e["home_power"])
-    s["wallbox_power"] = get_float(e["wallbox_power"], 0)
-    s["home_domestic_power"] = max(0.0, s["home_power"] - s["wallbox_power"])
-    s["home_current"] = get_float(e["home_current"])
-    s["home_max_current"] = get_float(e["home_max_current"])
-    s["pv_excess"] = s["pv_power"] - s["home_domestic_power"]
-
-    # EV SOC: None se sensore non disponibile (non forziamo 100 di default)
-    ev_obj = get_state_obj(e["ev_soc"])
-    if ev_obj is None:
-        s["ev_soc"] = None
+    return send_command("mode", mode, "select", "select_option", {"entity_id": e["wallbox_set_mode"], "option": mode}, cfg)
+
+def command_wallbox_current(amps, cfg):
+    e = cfg["entities"]
+    return send_command("current", amps, "number", "set_value", {"entity_id": e["wallbox_set_current"], "value": amps}, cfg)
+
+# === INVIO DEI COMANDI (CATENE ORDINATE, IN PARALLELO TRA LORO) ===
+# I comandi del tick vengono raccolti in TICK["queue"] e inviati da dispatch_begin a fine decisione, raggruppati
+# in catene: i comandi di una catena partono in ordine e un errore ferma i successivi (la corrente va impostata
+# prima di mode=normal, altrimenti la wallbox riparte con la corrente vecchia), catene diverse sono indipendenti
+# (wallbox, helper, altre wallbox). Nel runtime residente data["dispatch"] (engine.CommandDispatcher) esegue le
+# catene in parallelo con conferma (blocking), timeout per chiamata e ripetizioni con backoff, mentre il tick
+# pubblica lo stato; dispatch_finish attende gli esiti prima di salvare lo store. Come python_script l'invio è
+# sequenziale, senza attesa della conferma né ripetizioni (la sandbox non ha thread). Nel runtime residente l'attesa
+# avviene senza il lock dell'engine: il fast-path sovracorrente che interviene nel frattempo ferma i comandi non
+# ancora partiti (esito "preempted").
+DISPATCH = {"pending": []}   # [catene, attesa degli esiti] inviate e non ancora concluse
+
+def dispatch_queue(chain, key, domain, service, data, dev=None):
+    # Il comando porta con sé store e contatori della wallbox che lo ha deciso (più wallbox: store_swap)
+    TICK["queue"].append([chain if TICK["charger"] is None else f"{chain}:{TICK['charger']}", key, domain, service, data,
+                          dev, STORE["data"], TICK["commands"]])
+
+def dispatch_serial(calls):
+    """Esiti [stato, secondi, tentativi, errore] delle catene inviate una chiamata alla volta (python_script)."""
+    results = []
+    for chain in calls:
+        outcome = []
+        for domain, service, payload in chain:
+            if outcome and outcome[-1][0] != "ok":
+                outcome.append(["skipped", 0.0, 0, None])
+                continue
+            started = PERF_CLOCK()
+            try:
+                hass.services.call(domain, service, payload)
+                outcome.append(["ok", PERF_CLOCK() - started, 1, None])
+            except Exception as exc:
+                outcome.append(["error", PERF_CLOCK() - started, 1, str(exc)])
+        results.append(outcome)
+    return results
+
+def dispatch_begin(cfg):
+    """Invia i comandi in coda, una catena per dispositivo (nel runtime residente senza attenderne l'esito)."""
+    queue = TICK["queue"]
+    if not queue:
+        return
+    TICK["queue"] = []
+    started = PERF_CLOCK()
+    if len(queue) == 1:
+        # Un solo comando (il caso più frequente): una catena, senza raggruppare per dispositivo
+        batches = [queue]
+        calls = [[queue[0][2:5]]]
     else:
-        try:
-            s["ev_soc"] = round(float(ev_obj.state), 1)
-        except Exception:
-            s["ev_soc"] = None
+        chains = {}
+        order = []
+        for cmd in queue:
+            if cmd[0] not in chains:
+                chains[cmd[0]] = []
+                order.append(cmd[0])
+            chains[cmd[0]].append(cmd)
+        batches = [chains[name] for name in order]
+        calls = [[[cmd[2], cmd[3], cmd[4]] for cmd in batch] for batch in batches]
+    runner = data.get("dispatch")
+    if runner:
+        p = cfg["params"]
+        wait = runner(calls, p.get("command_timeout_seconds", 5.0), p.get("command_retries", 2), p.get("command_backoff_seconds", 0.5))
+    else:
+        results = dispatch_serial(calls)
+        wait = lambda: results
+    DISPATCH["pending"].append([batches, wait])
+    stage_add("dispatch", started)
+
+def dispatch_finish():
+    """Attende gli esiti dei comandi inviati e li registra (tempo di attesa nella fase dispatch)."""
+    pending = DISPATCH["pending"]
+    if not pending:
+        return
+    DISPATCH["pending"] = []
+    started = PERF_CLOCK()
+    for batches, wait in pending:
+        for batch, outcome in zip(batches, wait()):
+            for cmd, result in zip(batch, outcome):
+                dispatch_result(cmd, result)
+    stage_add("dispatch", started)
+
+def dispatch_result(cmd, result):
+    chain, key, domain, service = cmd[:4]
+    dev, st, counters = cmd[5:]
+    status, latency, attempts, error = result
+    if attempts > 1:
+        counters["retried"] = counters.get("retried", 0) + attempts - 1
+    if status == "preempted":
+        # Fermato dal fast-path sovracorrente intervenuto nel frattempo: non è un errore, lo stato resta da rileggere
+        if dev is not None:
+            dev[key] = None
+            st.get("sent", {}).pop(key, None)
+        log_debug("Comando %s.%s non inviato (%s): sostituito dal fast-path sovracorrente", domain, service, chain)
+        return
+    if status != "ok":
+        counters["failed"] = counters.get("failed", 0) + 1
+        if dev is not None:
+            dev[key] = None
+            # Invio non riuscito: il prossimo tick può riaffermare subito
+            st.get("sent", {}).pop(key, None)
+        if status == "skipped":
+            log_warn(f"Comando {domain}.{service} non inviato ({chain}): comando precedente fallito")
+        else:
+            log_warn(f"Errore chiamata servizio {domain}.{service} ({chain}, {attempts} tentativi): {error}")
+    if status == "skipped":
+        return
+    # Latenza per comando (ms): ultima, massima, numero di invii e timeout
+    stats = st.setdefault("dispatch", {}).setdefault(key, {"last": 0.0, "max": 0.0, "n": 0, "timeouts": 0})
+    stats["last"] = round(latency * 1000, 1)
+    stats["max"] = max(stats["max"], stats["last"])
+    stats["n"] = stats["n"] + 1
+    if status == "timeout":
+        stats["timeouts"] = stats["timeouts"] + 1
+
+def device_state(snap, st):
+    # Ultimo stato noto dei comandi, ricavato dallo snapshot (le correnti sono confrontate come interi);
+    # l'età di ogni comando parte dall'ultimo cambio dell'entità o dall'ultimo invio, il più recente dei due
+    current = snap["wallbox_current_set"]
+    sent = st.get("sent", {})
+    return {
+        "mode": snap["wallbox_mode"],
+        "mode_ts": max(snap["wallbox_mode_ts"], sent.get("mode", 0)),
+        "current": int(round(current)) if current is not None else None,
+        "current_ts": max(snap["wallbox_current_ts"], sent.get("current", 0)),
+    }
 
-    s["ev_target"] = get_float(e["ev_target_soc"])
-    s["ev_soc_emergenza"] = get_float(e["ev_soc_emergenza"], default=0.0)
+# === STORE DI STATO DEL CONTROLLORE ===
+# Memoria tra un tick e l'altro: ultimi N stati compatti, ultimo comando, ultimo cambio modalità, cicli di
+# protezione batteria e contatori per scenario. In modalità residente resta in memoria; come python_script
+# viene salvato in un unico attributo "store" dell'entità controller_state e riletto dallo snapshot successivo
+# (in forma compatta, vedi store_save).
+RESIDENT = bool(data.get("load_only", False))
+STORE_VERSION = 1
+# Colonne delle righe di history (oltre al timestamp in prima posizione)
+STORE_HISTORY_FIELDS = ("pv_power", "pv_excess", "batt_power", "home_power", "wallbox_power", "soc_attuale", "home_current")
+STORE = {"loaded": False, "saved_ts": 0, "data": {}}
+
+def store_new():
+    return {
+        "v": STORE_VERSION,
+        "amps": 0,          # ultimi ampere di carica applicati (usati dalla stabilizzazione)
+        "mode": None,       # ultima modalità comandata: "normal" / "paused"
+        "mode_ts": 0,       # timestamp dell'ultimo cambio di modalità
+        "cycles": 0,        # cicli di protezione batteria rimanenti (SCENARIO 6)
+        "counters": {},     # numero di attivazioni per scenario
+        "commands": {"issued": 0, "suppressed": 0, "failed": 0, "retried": 0},
+        "sent": {},                 # ultimo invio per comando della wallbox ("mode", "current"), per la riaffermazione
+        "dispatch": {},             # latenza dei comandi per tipo (runtime residente: con conferma)
+        "history": [],
+        "transitions": [],          # timestamp dei cambi di modalità dell'ultima ora (anti-flap)
+        "transitions_total": 0,
+        "deferred_total": 0,
+        "timing": {},               # ultime timing_window durate (µs) per fase del tick
+        "notifications": {},        # notifiche persistenti: attiva, ultimo invio e testo
+        "diag_ts": 0,               # ultima pubblicazione del sensore diagnostico
+        "status": status_new(),     # ultimo stato pubblicato del sensore di stato (confronto con banda morta)
+        "energy": energy_new(),     # energia alla EV per fonte: ultimo campione, totali e righe per giorno e mese
+        "regulator": regulator_new(),   # regolatore PI: attivo, uscita (A), integrale (W), ultimo errore (W)
+        "stale": [],                # campi con letture non aggiornate all'ultimo tick
+        "stale_ticks": 0,           # tick decisi con almeno una lettura non aggiornata
+    }
 
-    s["ora_attuale"] = get_str(e["time"])[:5]
-    s["ora_inizio_pausa"] = get_str(e["pause_start_time"], "00:00:00")[:5]
-    s["ora_fine_pausa"] = get_str(e["pause_end_time"], "00:00:00")[:5]
+def store_load(snap):
+    """Restituisce lo store del controllore; lo ricostruisce dal blob dello snapshot solo se non è già in memoria."""
+    if RESIDENT and STORE["loaded"]:
+        return STORE["data"]
+    st = store_new()
+    blob = snap["store"]
+    if blob and blob.get("v") == STORE_VERSION:
+        # Copie: gli attributi letti appartengono allo state machine di HA e non vanno modificati
+        st["amps"] = blob.get("amps", 0)
+        st["mode"] = blob.get("mode")
+        st["mode_ts"] = blob.get("mode_ts", 0)
+        st["cycles"] = blob.get("cycles", 0)
+        st["counters"] = {k: v for k, v in blob.get("counters", {}).items()}
+        commands = blob.get("commands", {})
+        st["commands"] = {k: commands.get(k, 0) for k in st["commands"]}
+        st["sent"] = {k: v for k, v in blob.get("sent", {}).items()}
+        st["history"] = [list(row) for row in blob.get("history", [])]
+        st["transitions"] = [t for t in blob.get("transitions", [])]
+        st["transitions_total"] = blob.get("transitions_total", 0)
+        st["deferred_total"] = blob.get("deferred_total", 0)
+        st["timing"] = {k: [v for v in vals] for k, vals in blob.get("timing", {}).items()}
+        st["diag_ts"] = blob.get("diag_ts", 0)
+        st["stale"] = [f for f in blob.get("stale", [])]
+        st["stale_ticks"] = blob.get("stale_ticks", 0)
+        st["dispatch"] = {k: {f: v[f] for f in v} for k, v in blob.get("dispatch", {}).items()}
+        status = blob.get("status")
+        if status:
+            st["status"] = {k: status[k] for k in status}
+        st["notifications"] = {k: {f: v[f] for f in v} for k, v in blob.get("notifications", {}).items()}
+        if blob.get("energy"):
+            st["energy"] = energy_copy(blob["energy"])
+        if blob.get("regulator"):
+            st["regulator"] = {k: v for k, v in blob["regulator"].items()}
+        st["filters"] = filters_restore(blob.get("filters", {}), CONFIG)
+        model = blob.get("pv_model")
+        if model:
+            fresh = new_pv_model()
+            st["pv_model"] = {k: [v for v in model.get(k, fresh[k])] for k in ("k", "n", "d", "nd")}
+            st["pv_model"]["ts"] = model.get("ts", 0)
+        if blob.get("plan"):
+            st["plan"] = plan_restore(blob["plan"])
+    else:
+        # Migrazione: prima esecuzione con lo store, riparto dall'helper usato dalle versioni precedenti
+        st["amps"] = int(snap["last_wallbox_current"] or 0)
+    STORE["data"] = st
+    STORE["loaded"] = True
+    return st
+
+def store_absorb_protection_cycles(snap, cfg):
+    # I cicli impostati sull'helper (es. da un'automazione su guasto) passano nello store con una sola scrittura
+    helper_cycles = int(snap["batt_protection_cycles"] or 0)
+    if helper_cycles > 0:
+        st = STORE["data"]
+        st["cycles"] = max(st.get("cycles", 0), helper_cycles)
+        dispatch_queue("helper", "batt_protection_cycles", "input_number", "set_value",
+                       {"entity_id": cfg["entities"]["batt_protection_cycles"], "value": 0})
+
+def store_set(key, value):
+    STORE["data"][key] = value
+
+def scenario_hit(label):
+    counters = STORE["data"].setdefault("counters", {})
+    counters[label] = counters.get(label, 0) + 1
+    if TICK["trace"] is not None:
+        TICK["trace"]["hits"].append(label)
+
+def store_record(final_amps, pause_mode, state, cfg):
+    """Aggiorna lo store a fine tick: comando applicato, cambio modalità e riga di history compatta."""
+    st = STORE["data"]
+    now = now_ts()
+    mode = "paused" if pause_mode else "normal"
+    if st.get("mode") != mode:
+        if st.get("mode") is not None:
+            st["transitions"] = [t for t in st.get("transitions", []) if now - t < 3600] + [now]
+            st["transitions_total"] = st.get("transitions_total", 0) + 1
+        st["mode"] = mode
+        st["mode_ts"] = now
+    if not pause_mode and final_amps > 0:
+        st["amps"] = final_amps
+    if state is not None:
+        row = [round(now, 1)] + [round(state[STATE_INDEX[f]], 1) for f in STORE_HISTORY_FIELDS]
+        history = st.setdefault("history", [])
+        history.append(row)
+        size = cfg["params"].get("store_history_size", 20)
+        if len(history) > size:
+            st["history"] = history[-size:]
+
+def store_save(cfg):
+    # In modalità residente il blob serve solo a ripartire dopo un riavvio: lo scriviamo al massimo ogni store_persist_seconds.
+    # Come python_script è l'unica memoria tra un'esecuzione e l'altra e va scritto a ogni tick: restano fuori le sezioni
+    # ricostruibili o solo diagnostiche (piano di carica, finestre dei tempi per fase, righe di energia oltre il giorno e
+    # il mese correnti), così la riga del recorder resta piccola e lontana dal limite di 16 KiB degli attributi
+    now = time.time()
+    if RESIDENT and (now - STORE["saved_ts"]) < cfg["params"].get("store_persist_seconds", 300):
+        return
+    st = STORE["data"]
+    # Copia superficiale: lo store in memoria continua a cambiare, lo stato pubblicato no
+    blob = {k: st[k] for k in st}
+    blob["counters"] = {k: v for k, v in st.get("counters", {}).items()}
+    blob["commands"] = {k: v for k, v in st.get("commands", {}).items()}
+    blob["sent"] = {k: v for k, v in st.get("sent", {}).items()}
+    blob["dispatch"] = {k: {f: v[f] for f in v} for k, v in st.get("dispatch", {}).items()}
+    blob["history"] = [row for row in st.get("history", [])]
+    blob["transitions"] = [t for t in st.get("transitions", [])]
+    blob["stale"] = [f for f in st.get("stale", [])]
+    blob["filters"] = filters_dump(st.get("filters", {}))
+    # La geometria del sole si ricalcola dallo snapshot: nel blob va solo il modello appreso
+    blob.pop("sun_geo", None)
+    if "pv_model" in st:
+        model = st["pv_model"]
+        blob["pv_model"] = {k: [v for v in model[k]] for k in ("k", "n", "d", "nd")}
+        blob["pv_model"]["ts"] = model["ts"]
+    blob.pop("plan", None)
+    blob.pop("timing", None)
+    if RESIDENT:
+        if st.get("plan"):
+            blob["plan"] = plan_dump(st["plan"])
+        blob["timing"] = {k: [v for v in vals] for k, vals in st.get("timing", {}).items()}
+    blob["notifications"] = {k: {f: v[f] for f in v} for k, v in st.get("notifications", {}).items()}
+    if "status" in st:
+        # Gli attributi pubblicati non vengono mai modificati (publish_status li sostituisce): condivisi, non copiati
+        blob["status"] = {k: st["status"][k] for k in st["status"]}
+    if "energy" in st:
+        blob["energy"] = energy_copy(st["energy"])
+        if not RESIDENT:
+            blob["energy"]["days"] = blob["energy"]["days"][-1:]
+            blob["energy"]["months"] = blob["energy"]["months"][-1:]
+    if "regulator" in st:
+        blob["regulator"] = {k: v for k, v in st["regulator"].items()}
+    try:
+        hass.states.set(cfg["entities"]["controller_state"], st.get("mode") or "unknown", {
+            "store": blob,
+            "friendly_name": "Wallbox Controller State",
+            "icon": "mdi:database"
+        })
+        STORE["saved_ts"] = now
+    except Exception as exc:
+        log_warn(f"Errore nel salvataggio dello store: {exc}")
+
+# === 3. SNAPSHOT E LETTURA STATO ===
+# Campi dello snapshot: (campo, chiave in CONFIG["entities"], tipo, attributo, default).
+# Ogni entità viene letta una sola volta per tick; il parsing avviene qui e non più nelle funzioni decisionali.
+SNAPSHOT_FIELDS = (
+    ("debug", "debug_mode", "bool", None, False),
+    ("voltage", "voltage", "float", None, 0.0),
+    ("wallbox_state", "wallbox_state", "str", None, "unavailable"),
+    ("timestamp", "current_timestamp", "float", None, 0),
+    ("wallbox_mode", "wallbox_set_mode", "str", None, "unavailable"),
+    ("wallbox_mode_ts", "wallbox_set_mode", "updated", None, 0),
+    ("wallbox_current_set", "wallbox_set_current", "float_opt", None, None),
+    ("wallbox_current_ts", "wallbox_set_current", "updated", None, 0),
+    ("last_tag_ts", "last_tag_time", "float_attr", "timestamp", 0),
+    ("pv1", "pv_primary_1", "float", None, 0.0),
+    ("pv2", "pv_primary_2", "float", None, 0.0),
+    ("pv_secondary", "pv_secondary", "float", None, 0.0),
+    ("pv_losses", "pv_losses", "float", None, 0.0),
+    ("batt_power", "batt_power", "float", None, 0.0),
+    ("batt_max_discharge", "batt_max_discharge", "float", None, 0.0),
+    ("soc_attuale", "batt_soc", "float", None, 0.0),
+    ("soc_min", "batt_soc_min", "float", None, 0.0),
+    ("soc_priority", "batt_soc_priority", "float", None, 0.0),
+    ("batt_protection_cycles", "batt_protection_cycles", "float", None, 0),
+    ("min_charge_amps", "min_charge_amps", "float", None, 0.0),
+    ("max_charge_amps", "max_charge_amps", "float", None, 0.0),
+    ("forzacharge", "force_charge", "bool", None, False),
+    ("home_power", "home_power", "float", None, 0.0),
+    ("home_current", "home_current", "float", None, 0.0),
+    ("home_max_current", "home_max_current", "float", None, 0.0),
+    ("wallbox_power", "wallbox_power", "float", None, 0),
+    ("ev_soc", "ev_soc", "float_opt", None, None),
+    ("ev_target", "ev_target_soc", "float", None, 0.0),
+    ("ev_soc_emergenza", "ev_soc_emergenza", "float", None, 0.0),
+    ("ev_departure", "ev_departure_time", "attr", "timestamp", None),
+    ("time", "time", "str", None, "unavailable"),
+    ("pause_start_time", "pause_start_time", "str", None, "00:00:00"),
+    ("pause_end_time", "pause_end_time", "str", None, "00:00:00"),
+    ("sun_elevation", "sun", "float_attr", "elevation", 0.0),
+    ("sun_rising", "sun", "attr", "rising", False),
+    ("sun_next_noon", "sun", "attr", "next_noon", None),
+    ("sun_next_setting", "sun", "attr", "next_setting", None),
+    ("elevation_limit", "sun_elevation_threshold", "float", None, 0.0),
+    ("batt_priority_ratio", "battery_priority_ratio", "float", None, 0.0),
+    ("last_wallbox_current", "last_wallbox_current", "float", None, 0),
+    ("date_time_iso", "date_time_iso", "str", None, "unavailable"),
+    ("grid_present", "grid", "bool", None, True),
+    ("store", "controller_state", "attr", "store", None),
+)
+
+# Sottoinsieme letto dal fast-path di protezione sovracorrente (runtime residente)
+OVERCURRENT_FIELDS = tuple([f for f in SNAPSHOT_FIELDS if f[0] in (
+    "debug", "voltage", "home_current", "home_max_current", "wallbox_power", "min_charge_amps",
+    "wallbox_mode", "wallbox_mode_ts", "wallbox_current_set", "wallbox_current_ts", "last_wallbox_current", "store")])
+
+# Freschezza delle letture: campo dello snapshot -> parametro con l'età massima della sua classe di segnale.
+# Potenze, correnti e tensione cambiano a ogni lettura: un valore fermo oltre stale_power_seconds è un sensore
+# bloccato (es. inverter Deye dopo una caduta del Modbus); i SOC cambiano lentamente (stale_soc_seconds); i
+# sensori template di data e ora si aggiornano ogni minuto (stale_helper_seconds). Gli helper impostati a mano
+# (input_number, input_boolean...) non scadono. L'età viene da last_reported (HA 2024.3 e successivi: aggiornato
+# anche quando il valore non cambia) o, se manca, da last_updated; le letture a 0 non scadono (inverter spento,
+# wallbox in pausa, batteria ferma restano a 0 per ore anche senza last_reported).
+FRESHNESS_FIELDS = {
+    "voltage": "stale_power_seconds",
+    "pv1": "stale_power_seconds",
+    "pv2": "stale_power_seconds",
+    "pv_secondary": "stale_power_seconds",
+    "batt_power": "stale_power_seconds",
+    "home_power": "stale_power_seconds",
+    "home_current": "stale_power_seconds",
+    "wallbox_power": "stale_power_seconds",
+    "soc_attuale": "stale_soc_seconds",
+    "ev_soc": "stale_soc_seconds",
+    "timestamp": "stale_helper_seconds",
+    "time": "stale_helper_seconds",
+}
 
-    s["sun_elevation"] = get_float_attr(e["sun"], "elevation")
-    # CORRETTO: leggere attributo rising (booleano) invece di usare lo stato testuale
-    s["is_rising"] = bool(get_attr(e["sun"], "rising", False))
-    s["elevation_limit"] = get_float(e["sun_elevation_threshold"])
+def read_snapshot(cfg, fields=None, objs=None):
+    """
+    Legge UNA volta tutte le entità di CONFIG["entities"] e restituisce un record con i valori già convertiti.
+    Con fields vengono lette solo le entità dei campi indicati (fast-path); objs (entity_id -> stato) condivide
+    le letture tra più snapshot dello stesso tick (più wallbox).
+    Nello stesso passaggio snap["stale"] raccoglie le letture più vecchie dell'età massima della loro classe
+    (FRESHNESS_FIELDS, campo -> età in s), usando gli oggetti stato già letti.
+    Lo snapshot non va modificato: le funzioni decisionali leggono solo da qui (o dallo stato derivato).
+    """
+    e = cfg["entities"]
+    if fields is None:
+        fields = SNAPSHOT_FIELDS
+    # Solo le entità usate dai campi: i sensori scritti dallo script (stato, diagnostica) non vengono riletti
+    if objs is None:
+        objs = {}
+    for key in [f[1] for f in fields]:
+        entity_id = e[key]
+        if entity_id not in objs:
+            objs[entity_id] = get_state_obj(entity_id)
 
+    p = cfg["params"]
+    now = now_ts()
+    stale = {}
+    snap = {}
+    for field, key, kind, attribute, default in fields:
+        entity_id = e[key]
+        s = objs[entity_id]
+        if kind == "float":
+            snap[field] = parse_float(s, entity_id, default)
+        elif kind == "bool":
+            snap[field] = parse_bool(s, default)
+        elif kind == "str":
+            snap[field] = parse_str(s, entity_id, default)
+        elif kind == "float_attr":
+            snap[field] = parse_float_attr(s, entity_id, attribute, default)
+        elif kind == "float_opt":
+            snap[field] = parse_float_opt(s)
+        elif kind == "updated":
+            snap[field] = parse_updated(s)
+        else:
+            snap[field] = parse_attr(s, attribute, default)
+        limit = FRESHNESS_FIELDS.get(field)
+        if limit is not None and s is not None and p.get(limit, 0) and snap[field] != 0:
+            reported = parse_reported(s)
+            if reported and now - reported > p[limit]:
+                stale[field] = int(now - reported)
+    snap["stale"] = stale
+    return snap
+
+# === 3a. STATO DEL TICK A SCHEMA FISSO ===
+# Lo stato del tick è una lista a posizioni fisse (python_script non ammette classi, quindi niente __slots__):
+# accesso per indice costante e circa metà della memoria di un dizionario per snapshot conservato (misure in
+# tools/state_bench.py: per storici lunghi di replay e smoothing i soli campi numerici stanno in un array('d')).
+# Lo schema è l'unico posto con tipi e default: ogni campo è sempre presente, quindi chi legge usa state[S_...]
+# senza default propri. I campi derivati vengono calcolati una volta in state_derive; filtri su finestra mobile,
+# ripartizione tra wallbox, previsione e piano aggiornano poi i loro campi.
+# Tipi: "num" (int o float), "opt" (num o None), "bool", "str", "obj" (strutture: previsione, piano, quota).
+STATE_SCHEMA = (
+    # Letture dallo snapshot
+    ("voltage", "num", 0.0),
+    ("forzacharge", "bool", False),
+    ("pv1", "num", 0.0),
+    ("pv2", "num", 0.0),
+    ("pv_secondary", "num", 0.0),
+    ("pv_losses", "num", 0.0),
+    ("batt_power", "num", 0.0),
+    ("batt_max_discharge", "num", 0.0),
+    ("soc_attuale", "num", 0.0),
+    ("soc_min", "num", 0.0),
+    ("soc_priority", "num", 0.0),
+    ("home_power", "num", 0.0),
+    ("wallbox_power", "num", 0.0),
+    ("home_current", "num", 0.0),
+    ("home_max_current", "num", 0.0),
+    ("ev_soc", "opt", None),            # None se il sensore non è disponibile (niente 100 di default)
+    ("ev_target", "num", 0.0),
+    ("ev_soc_emergenza", "num", 0.0),
+    ("ora_attuale", "str", "00:00"),
+    ("ora_inizio_pausa", "str", "00:00"),
+    ("ora_fine_pausa", "str", "00:00"),
+    ("sun_elevation", "num", 0.0),
+    ("is_rising", "bool", False),
+    ("elevation_limit", "num", 0.0),
+    ("min_amp", "num", 6),              # effective_min_amp: mai sotto min_amp_default
+    ("max_amp", "num", 0.0),
+    ("batt_priority_ratio", "num", 0.0),
+    ("grid_present", "bool", True),
+    ("timestamp", "num", 0.0),
+    # Dallo store del controllore
+    ("last_wallbox_current", "num", 0),
+    ("batt_protection_cycles", "num", 0),
+    # Derivati (state_derive)
+    ("pv_primary", "num", 0.0),
+    ("pv_power", "num", 0.0),
+    ("home_domestic_power", "num", 0.0),
+    ("pv_excess", "num", 0.0),
+    ("min_wallbox_power", "num", 0.0),
+    ("inverter_secondary_active", "bool", False),
+    ("pv_potential_secondary", "num", 0.0),
+    ("emergency", "bool", False),
+    # Pipeline del tick: valori grezzi prima dei filtri, quota della wallbox, previsione e piano
+    ("pv_excess_raw", "opt", None),
+    ("batt_power_raw", "opt", None),
+    ("home_power_raw", "opt", None),
+    ("allocation", "obj", None),
+    ("forecast", "obj", None),
+    ("plan", "obj", None),
+    ("stale", "obj", None),             # letture non aggiornate (campo -> età in s) dallo snapshot, None se tutte fresche
+)
+# Posizioni dei campi: S_<NOME> = indice in STATE_SCHEMA (stesso ordine; tools/state_bench.py lo verifica)
+(S_VOLTAGE, S_FORZACHARGE, S_PV1, S_PV2, S_PV_SECONDARY, S_PV_LOSSES, S_BATT_POWER, S_BATT_MAX_DISCHARGE,
+ S_SOC_ATTUALE, S_SOC_MIN, S_SOC_PRIORITY, S_HOME_POWER, S_WALLBOX_POWER, S_HOME_CURRENT, S_HOME_MAX_CURRENT,
+ S_EV_SOC, S_EV_TARGET, S_EV_SOC_EMERGENZA, S_ORA_ATTUALE, S_ORA_INIZIO_PAUSA, S_ORA_FINE_PAUSA, S_SUN_ELEVATION,
+ S_IS_RISING, S_ELEVATION_LIMIT, S_MIN_AMP, S_MAX_AMP, S_BATT_PRIORITY_RATIO, S_GRID_PRESENT, S_TIMESTAMP,
+ S_LAST_WALLBOX_CURRENT, S_BATT_PROTECTION_CYCLES,
+ S_PV_PRIMARY, S_PV_POWER, S_HOME_DOMESTIC_POWER, S_PV_EXCESS, S_MIN_WALLBOX_POWER, S_INVERTER_SECONDARY_ACTIVE,
+ S_PV_POTENTIAL_SECONDARY, S_EMERGENCY,
+ S_PV_EXCESS_RAW, S_BATT_POWER_RAW, S_HOME_POWER_RAW, S_ALLOCATION, S_FORECAST, S_PLAN, S_STALE) = range(len(STATE_SCHEMA))
+STATE_INDEX = {f[0]: i for i, f in enumerate(STATE_SCHEMA)}
+
+def state_kind_ok(kind, value):
+    if kind == "num":
+        return isinstance(value, (int, float))
+    if kind == "opt":
+        return value is None or isinstance(value, (int, float))
+    if kind == "bool":
+        return isinstance(value, bool)
+    if kind == "str":
+        return isinstance(value, str)
+    return True
+
+def state_invalid(state):
+    """Campi con un valore del tipo sbagliato per lo schema (lista vuota = record valido)."""
+    if len(state) != len(STATE_SCHEMA):
+        return ["<lunghezza>"]
+    return [f[0] for f, value in zip(STATE_SCHEMA, state) if not state_kind_ok(f[1], value)]
+
+# Default validati al caricamento: uno schema incoerente deve fermare lo script, non il tick
+STATE_DEFAULTS = [f[2] for f in STATE_SCHEMA]
+if state_invalid(STATE_DEFAULTS):
+    raise ValueError(f"STATE_SCHEMA: default non validi per {state_invalid(STATE_DEFAULTS)}")
+
+def state_new(values=None):
+    """Record di stato con i default dello schema; values (campo -> valore) imposta i campi indicati."""
+    s = list(STATE_DEFAULTS)
+    if values:
+        for name in values:
+            s[STATE_INDEX[name]] = values[name]
+    return s
+
+def effective_min_amp(min_charge_amps, cfg):
     # garantiamo min_amp minimo
-    s["min_amp"] = max(p.get("min_amp_default", 6), get_float(e["min_charge_amps"]) or p.get("min_amp_default", 6))
-    s["max_amp"] = get_float(e["max_charge_amps"])
-    s["min_wallbox_power"] = s["min_amp"] * s["voltage"]
-    s["batt_priority_ratio"] = get_float(e["battery_priority_ratio"])
+    default = cfg["params"].get("min_amp_default", 6)
+    return max(default, min_charge_amps or default)
+
+def ev_emergency(ev_soc, threshold):
+    # Emergenza EV: sensore disponibile, soglia impostata e SOC sotto soglia (99% = sensore saturo, non emergenza)
+    return bool(ev_soc is not None and threshold and ev_soc < threshold and ev_soc < 99.0)
+
+def get_system_state(snap, cfg):
+    s = list(STATE_DEFAULTS)
+    s[S_VOLTAGE] = snap["voltage"]
+    s[S_FORZACHARGE] = snap["forzacharge"]
+    s[S_PV1] = snap["pv1"]
+    s[S_PV2] = snap["pv2"]
+    s[S_PV_SECONDARY] = snap["pv_secondary"]
+    s[S_PV_LOSSES] = snap["pv_losses"]
+    s[S_BATT_POWER] = snap["batt_power"]
+    s[S_BATT_MAX_DISCHARGE] = snap["batt_max_discharge"]
+    s[S_SOC_ATTUALE] = snap["soc_attuale"]
+    s[S_SOC_MIN] = snap["soc_min"]
+    s[S_SOC_PRIORITY] = snap["soc_priority"]
+    s[S_HOME_POWER] = snap["home_power"]
+    s[S_WALLBOX_POWER] = snap["wallbox_power"]
+    s[S_HOME_CURRENT] = snap["home_current"]
+    s[S_HOME_MAX_CURRENT] = snap["home_max_current"]
+    s[S_EV_SOC] = snap["ev_soc"]
+    s[S_EV_TARGET] = snap["ev_target"]
+    s[S_EV_SOC_EMERGENZA] = snap["ev_soc_emergenza"]
+    s[S_ORA_ATTUALE] = snap["time"][:5]
+    s[S_ORA_INIZIO_PAUSA] = snap["pause_start_time"][:5]
+    s[S_ORA_FINE_PAUSA] = snap["pause_end_time"][:5]
+    s[S_SUN_ELEVATION] = snap["sun_elevation"]
+    # CORRETTO: leggere attributo rising (booleano) invece di usare lo stato testuale
+    s[S_IS_RISING] = bool(snap["sun_rising"])
+    s[S_ELEVATION_LIMIT] = snap["elevation_limit"]
+    s[S_MIN_AMP] = effective_min_amp(snap["min_charge_amps"], cfg)
+    s[S_MAX_AMP] = snap["max_charge_amps"]
+    s[S_BATT_PRIORITY_RATIO] = snap["batt_priority_ratio"]
+    s[S_GRID_PRESENT] = snap["grid_present"]
+    s[S_TIMESTAMP] = snap["timestamp"]
+    # Valori dallo store del controllore (non più dagli helper input_number)
+    s[S_LAST_WALLBOX_CURRENT] = STORE["data"].get("amps", 0)
+    s[S_BATT_PROTECTION_CYCLES] = STORE["data"].get("cycles", 0)
+    if snap.get("stale"):
+        state_degrade(s, snap["stale"])
+    state_derive(s, cfg)
+
+    log_debug("STATO LETTO: PV=%.1fW Excess=%.1fW BattPW=%.1fW SOC=%.1f%% MinPW=%.1fW",
+              s[S_PV_POWER], s[S_PV_EXCESS], s[S_BATT_POWER], s[S_SOC_ATTUALE], s[S_MIN_WALLBOX_POWER])
+    return s
 
-    s["inverter_secondary_active"] = s["pv_secondary"] > p["min_secondary_inverter_power"]
-    #s["pv_potential_secondary"] = max(s["pv1"], s["pv2"])
-    s["pv_potential_secondary"] = s["pv1"]
-    s["grid_present"] = get_bool(e["grid"], True)
+# Letture di potenza da cui dipende il surplus: se una non è aggiornata il surplus non è affidabile
+STALE_SURPLUS = ("voltage", "pv1", "pv2", "pv_secondary", "batt_power", "home_power", "wallbox_power")
 
-    s["timestamp"] = get_float(e["current_timestamp"], 0)
+def state_degrade(s, stale):
+    """
+    Sostituisce le letture non aggiornate con valori prudenti, prima dei campi derivati: surplus non affidabile ->
+    FTV a 0 (niente carica dal solare, restano emergenza EV e piano di carica); corrente di casa ferma -> non oltre
+    la corrente minima (la protezione dell'interruttore generale è cieca); SOC di casa fermo -> non sopra il minimo
+    (la batteria tiene la sua quota); SOC EV fermo -> sconosciuto; data e ora ferme -> orologio del sistema.
+    """
+    s[S_STALE] = stale
+    if [f for f in STALE_SURPLUS if f in stale]:
+        s[S_PV1] = 0.0
+        s[S_PV2] = 0.0
+        s[S_PV_SECONDARY] = 0.0
+    if "home_current" in stale:
+        s[S_MAX_AMP] = min(s[S_MAX_AMP], s[S_MIN_AMP])
+    if "soc_attuale" in stale:
+        s[S_SOC_ATTUALE] = min(s[S_SOC_ATTUALE], s[S_SOC_MIN])
+    if "ev_soc" in stale:
+        s[S_EV_SOC] = None
+    if "timestamp" in stale or "time" in stale:
+        now = now_ts()
+        s[S_TIMESTAMP] = now
+        s[S_ORA_ATTUALE] = time.strftime("%H:%M", time.localtime(now))
+
+def stale_note(stale):
+    """Conta i tick con letture non aggiornate e avvisa quando l'elenco cambia, non a ogni tick."""
+    st = STORE["data"]
+    names = sorted(stale) if stale else []
+    if names != st.get("stale", []):
+        if names:
+            log_warn("Sensori non aggiornati: %s -> decisione prudente", ", ".join([f"{k} ({stale[k]}s)" for k in names]))
+        else:
+            log_warn("Sensori di nuovo aggiornati: %s", ", ".join(st.get("stale", [])))
+        st["stale"] = names
+    if names:
+        st["stale_ticks"] = st.get("stale_ticks", 0) + 1
+
+def state_derive(s, cfg):
+    """Campi derivati dalle letture, una volta per tick: chi decide li legge già pronti."""
+    s[S_PV_PRIMARY] = s[S_PV1] + s[S_PV2]
+    pv_lordo = s[S_PV_PRIMARY] + s[S_PV_SECONDARY]
+    s[S_PV_POWER] = max(0.0, pv_lordo - s[S_PV_LOSSES])
+    s[S_HOME_DOMESTIC_POWER] = max(0.0, s[S_HOME_POWER] - s[S_WALLBOX_POWER])
+    s[S_PV_EXCESS] = s[S_PV_POWER] - s[S_HOME_DOMESTIC_POWER]
+    s[S_MIN_WALLBOX_POWER] = s[S_MIN_AMP] * s[S_VOLTAGE]
+    s[S_INVERTER_SECONDARY_ACTIVE] = s[S_PV_SECONDARY] > cfg["params"]["min_secondary_inverter_power"]
+    #s[S_PV_POTENTIAL_SECONDARY] = max(s[S_PV1], s[S_PV2])
+    s[S_PV_POTENTIAL_SECONDARY] = s[S_PV1]
+    s[S_EMERGENCY] = ev_emergency(s[S_EV_SOC], s[S_EV_SOC_EMERGENZA])
+
+# === 3b. FILTRI SU FINESTRA MOBILE (PV / CONSUMI) ===
+# Per ogni segnale: ring buffer di dimensione fissa, EMA, min/max con code monotone e istogramma sparso
+# per i percentili. Ogni campione costa O(1) (ammortizzato) e la memoria è limitata da smoothing_window.
+# Lato pessimistico: "low" = conta il valore basso (surplus), "high" = conta il valore alto (scarica, consumi).
+FILTER_SIGNALS = (("pv_excess", "low"), ("batt_power", "high"), ("home_power", "high"))
+
+def filter_new():
+    return {"buf": [], "pos": 0, "seq": 0, "ema": None, "ts": 0,
+            "minq": [], "minh": 0, "maxq": [], "maxh": 0, "hist": {}}
+
+def filter_queue_push(f, qkey, hkey, seq, value, first_valid, size, keep):
+    # Coda monotona [seq, valore]: in testa c'è sempre il min (o max) della finestra
+    q = f[qkey]
+    while len(q) > f[hkey] and not keep(q[-1][1], value):
+        q.pop()
+    q.append([seq, value])
+    head = f[hkey]
+    while q[head][0] < first_valid:
+        head = head + 1
+    if head > size:
+        # compattazione ammortizzata: la coda non cresce oltre ~2 finestre
+        f[qkey] = q[head:]
+        head = 0
+    f[hkey] = head
+
+def filter_push(f, value, cfg, update_ema=True):
+    p = cfg["params"]
+    size = max(1, int(p.get("smoothing_window", 12)))
+    width = p.get("smoothing_bin_watts", 10) or 1
+    seq = f["seq"]
+    buf = f["buf"]
+    hist = f["hist"]
+    # Ring buffer + istogramma: il valore che esce dalla finestra viene tolto dal suo bin
+    if len(buf) < size:
+        buf.append(value)
+    else:
+        old_bin = int(buf[f["pos"]] // width)
+        buf[f["pos"]] = value
+        f["pos"] = (f["pos"] + 1) % size
+        count = hist.get(old_bin, 0) - 1
+        if count > 0:
+            hist[old_bin] = count
+        else:
+            hist.pop(old_bin, None)
+    new_bin = int(value // width)
+    hist[new_bin] = hist.get(new_bin, 0) + 1
+
+    first_valid = seq + 1 - min(size, len(buf))
+    filter_queue_push(f, "minq", "minh", seq, value, first_valid, size, lambda a, b: a < b)
+    filter_queue_push(f, "maxq", "maxh", seq, value, first_valid, size, lambda a, b: a > b)
+    f["seq"] = seq + 1
+
+    if update_ema:
+        alpha = p.get("smoothing_ema_alpha", 0.3)
+        f["ema"] = value if f["ema"] is None else f["ema"] + alpha * (value - f["ema"])
+
+def filter_min(f):
+    return f["minq"][f["minh"]][1]
+
+def filter_max(f):
+    return f["maxq"][f["maxh"]][1]
+
+def filter_percentile(f, pct, width, high_side):
+    # Percentile nearest-rank sui bin; si prende il bordo più pessimistico del bin, limitato a [min, max]
+    n = len(f["buf"])
+    k = max(1, int(math.ceil(pct / 100.0 * n)))
+    hist = f["hist"]
+    acc = 0
+    value = filter_max(f)
+    for b in sorted(hist):
+        acc = acc + hist[b]
+        if acc >= k:
+            value = (b + 1) * width if high_side else b * width
+            break
+    return max(filter_min(f), min(filter_max(f), value))
+
+def filters_dump(filters):
+    # Nel blob salviamo solo finestra, EMA e timestamp: code e istogramma si ricostruiscono al caricamento
+    return {name: {"buf": [v for v in f["buf"]], "pos": f["pos"], "ema": f["ema"], "ts": f["ts"]}
+            for name, f in filters.items()}
+
+def filters_restore(dumped, cfg):
+    filters = {}
+    for name in dumped:
+        d = dumped[name]
+        buf = d.get("buf", [])
+        pos = d.get("pos", 0)
+        f = filter_new()
+        for v in buf[pos:] + buf[:pos]:
+            filter_push(f, v, cfg, update_ema=False)
+        f["ema"] = d.get("ema")
+        f["ts"] = d.get("ts", 0)
+        filters[name] = f
+    return filters
+
+def apply_filters(state, cfg):
+    """
+    Aggiorna i filtri con i valori istantanei e, secondo smoothing_mode, sostituisce nello stato
+    pv_excess / batt_power / home_power con il valore filtrato (i grezzi restano in <nome>_raw).
+    """
+    p = cfg["params"]
+    mode = p.get("smoothing_mode", "raw")
+    width = p.get("smoothing_bin_watts", 10) or 1
+    pct = p.get("smoothing_percentile", 20)
+    filters = STORE["data"].setdefault("filters", {})
+    now = now_ts()
+    for name, side in FILTER_SIGNALS:
+        i = STATE_INDEX[name]
+        raw = state[i]
+        f = filters.get(name)
+        # Dopo una lunga interruzione la finestra non rappresenta più la situazione attuale
+        if f is None or (now - f["ts"]) > p.get("smoothing_reset_seconds", 600):
+            f = filter_new()
+            filters[name] = f
+        filter_push(f, raw, cfg)
+        f["ts"] = now
+        state[STATE_INDEX[name + "_raw"]] = raw
+        if mode == "ema":
+            state[i] = round(f["ema"], 3)
+        elif mode == "pessimistic":
+            state[i] = filter_percentile(f, pct if side == "low" else 100 - pct, width, side == "high")
+        elif mode == "worst":
+            state[i] = filter_min(f) if side == "low" else filter_max(f)
+    if mode != "raw":
+        log_debug("FILTRI (%s): Excess=%.1fW (grezzo %.1fW) BattPW=%.1fW (grezzo %.1fW)",
+                  mode, state[S_PV_EXCESS], state[S_PV_EXCESS_RAW], state[S_BATT_POWER], state[S_BATT_POWER_RAW])
+
+# === 3c. PREVISIONE PRODUZIONE FTV (CIELO SERENO + CORREZIONI ORARIE APPRESE) ===
+# Modello locale, nessun servizio esterno. L'elevazione futura segue sin(e) = A + B·cos(H), con H angolo orario
+# ricavato da next_noon di sun.sun; A e B vengono dal semiarco diurno (next_setting) e dall'elevazione attuale.
+# La produzione a cielo sereno per grado di elevazione è una tabella calcolata una volta; il fattore appreso per
+# fascia oraria (media mobile nel tempo di PV misurata / cielo sereno) contiene potenza di picco, orientamento,
+# ombre e meteo tipico. Nei primi minuti pesa di più il cielo attuale (nuvole), che sfuma verso il fattore
+# appreso con forecast_persistence_minutes. Costo per tick: qualche decina di operazioni, nessuna lettura.
+FORECAST_HORIZONS = (15, 30, 60, 90, 120)
+SIN_SUNRISE = math.sin(math.radians(-0.833))
+
+def clear_sky_table():
+    # Modello di Haurwitz normalizzato a 1 con sole allo zenit, un valore per grado di elevazione
+    table = [0.0]
+    for deg in range(1, 91):
+        s = math.sin(math.radians(deg))
+        table.append(s * math.exp(-0.057 / s) / math.exp(-0.057))
+    return table
+
+CLEAR_SKY = clear_sky_table()
+
+def clear_sky(elevation):
+    if elevation <= 0:
+        return 0.0
+    if elevation >= 90:
+        return CLEAR_SKY[90]
+    i = int(elevation)
+    return CLEAR_SKY[i] + (CLEAR_SKY[i + 1] - CLEAR_SKY[i]) * (elevation - i)
+
+def parse_iso_ts(value):
+    try:
+        return datetime.datetime.fromisoformat(str(value)).timestamp()
+    except Exception:
+        return None
 
-    log_debug("STATO LETTO: PV={:.1f}W Excess={:.1f}W BattPW={:.1f}W SOC={:.1f}% MinPW={:.1f}W".format(
-        s["pv_power"], s["pv_excess"], s["batt_power"], s["soc_attuale"], s["min_wallbox_power"]))
-    return s
+def hour_angle(noon, now):
+    # Gradi dal mezzogiorno solare (15° all'ora), riportati in [-180, 180)
+    return ((now - noon) / 240.0 + 180.0) % 360.0 - 180.0
+
+def elevation_at(geo, angle):
+    sin_e = geo["a"] + geo["b"] * math.cos(math.radians(angle))
+    return math.degrees(math.asin(max(-1.0, min(1.0, sin_e))))
+
+def sun_geometry(snap, now, st):
+    """Parametri di sin(e) = A + B·cos(H) in cache nello store; None se sun.sun non espone next_noon/next_setting."""
+    geo = st.setdefault("sun_geo", {"key": None, "noon": None, "h0": 90.0, "a": None, "b": None})
+    key = f"{snap['sun_next_noon']}|{snap['sun_next_setting']}"
+    if geo["key"] != key:
+        geo["key"] = key
+        noon = parse_iso_ts(snap["sun_next_noon"])
+        setting = parse_iso_ts(snap["sun_next_setting"])
+        geo["noon"] = noon
+        if noon is not None and setting is not None:
+            # Dopo mezzogiorno next_noon è già domani: il modulo riporta la distanza al tramonto dello stesso giorno
+            geo["h0"] = ((setting - noon) % 86400) / 240.0
+    if geo["noon"] is None:
+        return None
+    cos_h0 = math.cos(math.radians(geo["h0"]))
+    denom = math.cos(math.radians(hour_angle(geo["noon"], now))) - cos_h0
+    # Vicino ad alba/tramonto il sistema è mal condizionato: si tengono A e B dell'ultimo calcolo valido
+    if abs(denom) > 0.2:
+        geo["b"] = (math.sin(math.radians(snap["sun_elevation"])) - SIN_SUNRISE) / denom
+        geo["a"] = SIN_SUNRISE - geo["b"] * cos_h0
+    return geo if geo["a"] is not None else None
+
+def new_pv_model():
+    return {"k": [0.0] * 24, "n": [0] * 24, "d": [0.0] * 24, "nd": [0] * 24, "ts": 0}
+
+def forecast_learn(model, hour, cs_now, pv_power, domestic, now, p):
+    # Media mobile nel tempo (costante forecast_learn_days giorni di quella fascia), indipendente dalla cadenza dei tick
+    last = model.get("ts", 0)
+    model["ts"] = now
+    if not last:
+        return
+    dt = max(0.0, min(now - last, 300.0))
+    decay = 1.0 - math.exp(-dt / (p.get("forecast_learn_days", 3) * 3600.0))
+    # Profilo orario dei consumi domestici (usato dal piano di carica oltre l'orizzonte della misura attuale)
+    nd = model["nd"][hour]
+    model["d"][hour] = model["d"][hour] + max(decay, 1.0 / (nd + 1)) * (domestic - model["d"][hour])
+    model["nd"][hour] = min(nd + 1, 100000)
+    if cs_now < 0.05:
+        return
+    n = model["n"][hour]
+    model["k"][hour] = model["k"][hour] + max(decay, 1.0 / (n + 1)) * (pv_power / cs_now - model["k"][hour])
+    model["n"][hour] = min(n + 1, 100000)
+
+def pv_expected(model, geo, angle_now, minute_of_day, minutes, cloud, persistence):
+    # Produzione prevista tra minutes minuti: fattore appreso della fascia x cielo sereno, corretto dalle nuvole attuali
+    w = math.exp(-minutes / persistence)
+    slot = int((minute_of_day + minutes) // 60) % 24
+    return model["k"][slot] * clear_sky(elevation_at(geo, angle_now + minutes * 0.25)) * (w * cloud + 1.0 - w)
+
+def pv_forecast(state, snap, cfg):
+    """
+    Previsione di produzione e surplus (PV - consumo domestico attuale) a FORECAST_HORIZONS minuti.
+    Restituisce None senza dati del sole; "ready" è vero quando tutte le fasce orarie coinvolte hanno
+    almeno forecast_min_samples campioni appresi.
+    """
+    p = cfg["params"]
+    st = STORE["data"]
+    now = now_ts()
+    geo = sun_geometry(snap, now, st)
+    if geo is None:
+        return None
+    try:
+        minute_of_day = int(state[S_ORA_ATTUALE][:2]) * 60 + int(state[S_ORA_ATTUALE][3:5])
+    except Exception:
+        return None
+    model = st.get("pv_model") or new_pv_model()
+    st["pv_model"] = model
+    hour = minute_of_day // 60
+    cs_now = clear_sky(state[S_SUN_ELEVATION])
+    domestic = state[S_HOME_DOMESTIC_POWER]
+    # Con letture non aggiornate il modello non impara (la produzione è stata azzerata da state_degrade)
+    if not state[S_STALE]:
+        forecast_learn(model, hour, cs_now, state[S_PV_POWER], domestic, now, p)
+    expected_now = model["k"][hour] * cs_now
+    cloud = max(0.0, min(1.5, state[S_PV_POWER] / expected_now)) if expected_now > 50 else 1.0
+    persistence = p.get("forecast_persistence_minutes", 30) or 1
+    min_samples = p.get("forecast_min_samples", 20)
+    angle_now = hour_angle(geo["noon"], now)
+    ready = model["n"][hour] >= min_samples
+    pv = []
+    surplus = []
+    for minutes in FORECAST_HORIZONS:
+        ready = ready and model["n"][((minute_of_day + minutes) // 60) % 24] >= min_samples
+        value = pv_expected(model, geo, angle_now, minute_of_day, minutes, cloud, persistence)
+        pv.append(round(value))
+        surplus.append(round(value - domestic))
+    # geo e model (riferimenti allo store) servono al piano di carica, anche delle altre wallbox
+    return {"ready": ready, "pv": pv, "surplus": surplus, "cloud": round(cloud, 2),
+            "minute": minute_of_day, "angle": angle_now, "geo": geo, "model": model}
+
+def forecast_attribute(fc):
+    # Surplus previsto per orizzonte, es. "15m:1200 30m:1350 ..."; "-" finché il modello non ha abbastanza campioni
+    if not fc or not fc["ready"]:
+        return "-"
+    return " ".join(f"{m}m:{v}" for m, v in zip(FORECAST_HORIZONS, fc["surplus"]))
+
+def forecast_usable(state, cfg):
+    fc = state[S_FORECAST]
+    return fc if (cfg["params"].get("forecast_charge", False) and fc and fc["ready"]) else None
+
+# === 3d. PIANO DI CARICA PER LA PARTENZA ===
+# Con l'orario di partenza (input_datetime, solo ora oppure data e ora) l'energia che manca a ev_target_soc viene
+# distribuita su fasce da planner_slot_minutes fino alla partenza (al massimo planner_horizon_hours). Ogni fascia ha
+# una quota solare (surplus FTV previsto, tra potenza minima e massima della wallbox) e un margine di rete/batteria
+# (potenza massima - quota solare); le fasce dentro la finestra di pausa non si usano. Il sole copre quanto può
+# (scontato di planner_solar_confidence), il resto va preso dalla rete il più tardi possibile, così il sole reale
+# ha tutto il tempo di fare meglio della previsione. Con le somme cumulative dalla partenza all'indietro la fascia
+# di avvio della rete si trova con una ricerca binaria; ad ogni tick si scartano le fasce passate e si ricalcolano
+# solo le prime, le uniche su cui pesano nuvole e consumi attuali. Ricostruzione completa solo al cambio di
+# partenza/ampere o ogni planner_rebuild_seconds.
+PLANNER_VOLTAGE = 230.0
+
+def in_time_window(start, end, hhmm):
+    try:
+        return (start < end and start <= hhmm <= end) or (start > end and (hhmm >= start or hhmm <= end))
+    except Exception:
+        return False
+
+def departure_ts(value, now, horizon):
+    # input_datetime solo orario: timestamp = secondi dalla mezzanotte (prossima occorrenza); con data: epoch
+    try:
+        value = float(value)
+    except Exception:
+        return None
+    if value < 86400:
+        lt = time.localtime(now)
+        ts = now - (lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec) + value
+        if ts <= now:
+            ts += 86400
+    else:
+        ts = value
+    return ts if now < ts <= now + horizon else None
+
+def planner_context(state, cfg):
+    """Valori comuni a tutte le fasce di questo tick (previsione, consumi, limiti della wallbox)."""
+    p = cfg["params"]
+    fc = state[S_FORECAST]
+    ctx = {"geo": None, "model": None, "minute": 0, "angle": 0.0, "cloud": 1.0,
+           "persistence": p.get("forecast_persistence_minutes", 30) or 1,
+           "domestic": state[S_HOME_DOMESTIC_POWER],
+           "p_min": state[S_MIN_AMP] * PLANNER_VOLTAGE, "p_max": max(state[S_MIN_AMP], state[S_MAX_AMP]) * PLANNER_VOLTAGE,
+           "ratio": p["min_power_ratio_for_min_amps"],
+           "pause_start": state[S_ORA_INIZIO_PAUSA], "pause_end": state[S_ORA_FINE_PAUSA]}
+    # Senza previsione pronta il piano non conta sul sole: tutta l'energia mancante è considerata da rete
+    if fc and fc["ready"]:
+        ctx["geo"] = fc["geo"]
+        ctx["model"] = fc["model"]
+        ctx["minute"] = fc["minute"]
+        ctx["angle"] = fc["angle"]
+        ctx["cloud"] = fc["cloud"]
+    return ctx
+
+def planner_slot(ctx, minutes):
+    # Quota solare e margine di rete (W) della fascia che inizia tra minutes minuti
+    minute = int(ctx["minute"] + minutes) % 1440
+    if in_time_window(ctx["pause_start"], ctx["pause_end"], f"{minute // 60:02d}:{minute % 60:02d}"):
+        return 0, 0
+    solar = 0
+    if ctx["geo"] is not None:
+        model = ctx["model"]
+        w = math.exp(-minutes / ctx["persistence"])
+        domestic = w * ctx["domestic"] + (1.0 - w) * model["d"][minute // 60]
+        surplus = pv_expected(model, ctx["geo"], ctx["angle"], ctx["minute"], minutes, ctx["cloud"], ctx["persistence"]) - domestic
+        if surplus >= ctx["p_min"] * ctx["ratio"]:
+            solar = round(min(max(surplus, ctx["p_min"]), ctx["p_max"]))
+    return solar, round(ctx["p_max"]) - solar
+
+def plan_sums(plan, count):
+    # Somme cumulative (Wh) dalla fascia j alla partenza, ricalcolate solo per le prime count fasce
+    slot_h = plan["slot_s"] / 3600.0
+    solar = plan["solar"]
+    head = plan["head"]
+    ssum = plan["ssum"]
+    hsum = plan["hsum"]
+    for j in range(count - 1, -1, -1):
+        ssum[j] = ssum[j + 1] + solar[j] * slot_h
+        hsum[j] = hsum[j + 1] + head[j] * slot_h
+
+def plan_refresh(plan, ctx, now, count):
+    first_ts = plan["first"] * plan["slot_s"]
+    for j in range(count):
+        # Fascia corrente valutata da adesso, le altre dal loro inizio
+        minutes = max(0.0, (first_ts + j * plan["slot_s"] - now) / 60.0)
+        slot = planner_slot(ctx, minutes)
+        plan["solar"][j] = slot[0]
+        plan["head"][j] = slot[1]
+    plan_sums(plan, count)
+
+def plan_restore(saved):
+    plan = {k: saved[k] for k in ("key", "first", "built", "slot_s")}
+    plan["solar"] = [v for v in saved["solar"]]
+    plan["head"] = [v for v in saved["head"]]
+    plan["ssum"] = [0.0] * (len(plan["solar"]) + 1)
+    plan["hsum"] = [0.0] * (len(plan["solar"]) + 1)
+    plan_sums(plan, len(plan["solar"]))
+    return plan
+
+def plan_dump(plan):
+    # Le somme cumulative si ricostruiscono al caricamento: nel blob solo le fasce
+    saved = {k: plan[k] for k in ("key", "first", "built", "slot_s")}
+    saved["key"] = [v for v in plan["key"]]
+    saved["solar"] = [v for v in plan["solar"]]
+    saved["head"] = [v for v in plan["head"]]
+    return saved
+
+def plan_latest_start(hsum, need, lo, hi):
+    # Ultima fascia i in [lo, hi) con hsum[i] >= need (hsum non crescente); lo - 1 se nessuna basta
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if hsum[mid] >= need:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo - 1
+
+def plan_update(state, snap, cfg):
+    """
+    Aggiorna il piano di carica verso la partenza e restituisce la decisione per la fascia corrente:
+    power (W da garantire adesso, 0 se basta il sole), energia mancante, quota solare e da rete, avvio della rete.
+    None se partenza non impostata/fuori orizzonte, SOC EV non disponibile o target già raggiunto.
+    """
+    p = cfg["params"]
+    st = STORE["data"]
+    now = now_ts()
+    dep = departure_ts(snap["ev_departure"], now, p.get("planner_horizon_hours", 24) * 3600)
+    ev_soc = state[S_EV_SOC]
+    if dep is None or ev_soc is None or ev_soc >= state[S_EV_TARGET] or state[S_VOLTAGE] <= 0:
+        st.pop("plan", None)
+        return None
+    slot_s = int(p.get("planner_slot_minutes", 5) * 60)
+    first = int(now // slot_s)
+    count = max(1, int(dep // slot_s) - first)
+    key = [round(dep), state[S_MIN_AMP], state[S_MAX_AMP], slot_s]
+    ctx = planner_context(state, cfg)
+    plan = st.get("plan")
+    if plan is None or plan["key"] != key or first < plan["first"] or now - plan["built"] >= p.get("planner_rebuild_seconds", 3600):
+        plan = {"key": key, "first": first, "built": now, "slot_s": slot_s,
+                "solar": [0] * count, "head": [0] * count, "ssum": [0.0] * (count + 1), "hsum": [0.0] * (count + 1)}
+        plan_refresh(plan, ctx, now, count)
+        st["plan"] = plan
+    else:
+        drop = min(first - plan["first"], len(plan["solar"]) - 1)
+        if drop > 0:
+            # Fasce passate: le somme cumulative delle rimanenti non cambiano
+            for k in ("solar", "head", "ssum", "hsum"):
+                plan[k] = plan[k][drop:]
+            plan["first"] = first
+        count = len(plan["solar"])
+        refresh = int(math.ceil(2 * ctx["persistence"] * 60.0 / slot_s))
+        plan_refresh(plan, ctx, now, min(count, refresh))
+
+    slot_h = slot_s / 3600.0
+    # La fascia corrente vale solo per il tempo che ne resta
+    h0 = ((first + 1) * slot_s - now) / 3600.0
+    solar_wh = plan["ssum"][0] - plan["solar"][0] * (slot_h - h0)
+    energy_wh = (state[S_EV_TARGET] - ev_soc) / 100.0 * p.get("ev_battery_kwh", 58.3) * 1000.0 / p.get("ev_charge_efficiency", 0.9)
+    need = energy_wh - solar_wh * p.get("planner_solar_confidence", 0.8)
+    result = {"departure": dep, "energy_wh": energy_wh, "solar_wh": solar_wh, "grid_wh": max(0.0, need),
+              "power": 0.0, "grid_start": None, "feasible": True}
+    if need <= 0:
+        return result
+    hsum = plan["hsum"]
+    if count > 1 and hsum[1] >= need:
+        # Rete non ancora necessaria: parte dalla fascia i, da dove resta solo il margine che serve
+        i = plan_latest_start(hsum, need, 1, count)
+        head_i = plan["head"][i]
+        offset = (hsum[i] - need) / head_i * 3600.0 if head_i > 0 else 0.0
+        result["grid_start"] = (first + i) * slot_s + offset
+        return result
+    # Serve rete già in questa fascia: quota solare + quanto manca nel tempo che resta, almeno la potenza minima
+    later = hsum[1] if count > 1 else 0.0
+    missing = need - later
+    head_now = min(plan["head"][0], missing / h0) if h0 > 0 else plan["head"][0]
+    result["grid_start"] = now
+    result["feasible"] = missing <= plan["head"][0] * h0
+    if plan["solar"][0] + head_now > 0:
+        result["power"] = max(ctx["p_min"], plan["solar"][0] + head_now)
+    return result
+
+def plan_attribute(result):
+    # Riassunto del piano per il sensore di stato: fasce solari e da rete compattate in intervalli orari
+    plan = STORE["data"].get("plan")
+    if not result or not plan:
+        return "-"
+    slot_s = plan["slot_s"]
+    grid_from = result["grid_start"] if result["grid_start"] is not None else result["departure"]
+    runs = []
+    current = None
+    for j in range(len(plan["solar"])):
+        start = (plan["first"] + j) * slot_s
+        mode = "rete" if start + slot_s > grid_from and plan["head"][j] > 0 else ("sole" if plan["solar"][j] > 0 else None)
+        if mode != current:
+            if current is not None:
+                runs.append([runs_start, start, current])
+            current = mode
+            runs_start = max(start, result["grid_start"] or start) if mode == "rete" else start
+    if current is not None:
+        runs.append([runs_start, result["departure"], current])
+    return {
+        "partenza": time.strftime("%H:%M", time.localtime(result["departure"])),
+        "energia_kwh": round(result["energy_wh"] / 1000.0, 2),
+        "sole_kwh": round(result["solar_wh"] / 1000.0, 2),
+        "rete_kwh": round(result["grid_wh"] / 1000.0, 2),
+        "avvio_rete": time.strftime("%H:%M", time.localtime(result["grid_start"])) if result["grid_start"] is not None else "-",
+        "raggiungibile": result["feasible"],
+        "fasce": [f"{time.strftime('%H:%M', time.localtime(a))}-{time.strftime('%H:%M', time.localtime(b))} {m}" for a, b, m in runs],
+    }
 
 # === 4. CONTROLLI PRELIMINARI ===
-def controlli_preliminari(cfg):
-    e = cfg["entities"]
+def controlli_preliminari(snap, cfg):
     p = cfg["params"]
 
-    if get_str(e["wallbox_state"]) == "idle":
+    if snap["wallbox_state"] == "idle":
         return "Connettore non collegato"
 
-    last_tag_ts = get_float_attr(e["last_tag_time"], "timestamp", 0)
-    now_ts = get_float(e["current_timestamp"], 0)
+    last_tag_ts = snap["last_tag_ts"]
+    now_ts = snap["timestamp"]
     diff = (now_ts - last_tag_ts) if (last_tag_ts and now_ts and last_tag_ts > 0) else 0
     if diff and diff < p["post_tag_lock_seconds"]:
         remaining = int(p["post_tag_lock_seconds"] - diff)
@@ -260,68 +1581,136 @@ def controlli_preliminari(cfg):
 
     return None
 
+# === 4b. PROTEZIONE SOVRACORRENTE (SCENARIO 3 FAST-PATH) ===
+def overcurrent_guard(home_current, home_max_current, wallbox_power, voltage, min_amp, commanded_amps, cfg):
+    """
+    Se la casa supera home_max_current riduce la corrente della wallbox dell'eccesso misurato
+    (per difetto); se si scende sotto min_amp, o il taglio proporzionale è disattivato, mette in pausa.
+    Usa solo corrente casa, potenza wallbox e tensione: nessuna logica PV/batteria.
+    Restituisce None se non serve intervenire, altrimenti (ampere, ragione) con 0 = pausa.
+    """
+    if home_current <= home_max_current:
+        return None
+    reason = f"Consumo casa eccessivo: {home_current:.1f}A > {home_max_current:.1f}A"
+    if not cfg["params"].get("overcurrent_proportional_cut", True) or voltage <= 0:
+        return 0, reason
+    excess_amp = home_current - home_max_current
+    new_amps = int(wallbox_power / voltage - excess_amp)
+    if commanded_amps:
+        new_amps = min(new_amps, commanded_amps)
+    if new_amps < min_amp:
+        return 0, reason
+    return new_amps, f"{reason} -> ridotta a {new_amps}A"
+
+def apply_overcurrent_guard(guard, cfg):
+    amps, reason = guard
+    if amps == 0:
+        scenario_hit("3")
+        log_warn("SCENARIO 3: %s -> pausa", reason)
+        command_wallbox_mode("paused", cfg)
+        return 0, True, reason
+    scenario_hit("3")
+    log_warn("SCENARIO 3: %s", reason)
+    command_wallbox_current(amps, cfg)
+    store_set("amps", amps)
+    return amps, False, reason
+
+def overcurrent_tick():
+    """
+    Fast-path per il runtime residente: legge solo le entità della protezione e interviene subito,
+    senza snapshot completo né logica PV/batteria. Restituisce None se non è servito intervenire.
+    Gira con un TICK proprio: coda, stato dei comandi, tempi per fase e traccia del tick eventualmente
+    in attesa degli esiti (lock rilasciato, engine.WallboxEngine) restano quelli del tick.
+    """
+    saved = tick_context()
+    tick_swap(saved)
+    try:
+        if CONFIG.get("chargers"):
+            return site_overcurrent_tick()
+        return charger_overcurrent_tick()
+    finally:
+        tick_swap(saved)
+
+def charger_overcurrent_tick():
+    snap = read_snapshot(CONFIG, OVERCURRENT_FIELDS)
+    store = store_load(snap)
+    # Contatori dei comandi e debug di questo fast-path (send_command usa TICK["commands"])
+    TICK["commands"] = store["commands"]
+    TICK["debug"] = snap["debug"]
+    TICK["device"] = device_state(snap, store)
+    guard = overcurrent_guard(snap["home_current"], snap["home_max_current"], snap["wallbox_power"], snap["voltage"],
+                              effective_min_amp(snap["min_charge_amps"], CONFIG), TICK["device"]["current"], CONFIG)
+    if guard is None:
+        return None
+    # Un tick in attesa di conferma può avere comandi ancora da inviare (es. mode=normal): lo stato letto
+    # non basta per sopprimere il comando di protezione, che parte comunque e li ferma (engine.WallboxEngine)
+    TICK["device"] = {"mode": None, "current": None}
+    result = apply_overcurrent_guard(guard, CONFIG)
+    # Come a fine tick: la pausa (o la riduzione) entra nello store per anti-flap e contatori delle transizioni
+    store_record(result[0], result[1], None, CONFIG)
+    dispatch_begin(CONFIG)
+    dispatch_finish()
+    return result
+
 # === 5. DETERMINA RAGIONI DI PAUSA (SCENARI 0..7) ===
 def determine_pause_reason(state, cfg):
-    e = cfg["entities"]
     p = cfg["params"]
 
-    # Emergency EV: sensore deve essere disponibile
-    ev_soc = state.get("ev_soc")
-    ev_emerg = state.get("ev_soc_emergenza", 0.0)
-    is_emergency = False
-    if (ev_soc is not None) and ev_emerg and ev_soc < ev_emerg and ev_soc < 99.0:
-        is_emergency = True
-        log_warn(f"SCENARIO 0 (EMERGENZA EV): EV SOC {ev_soc}% < soglia {ev_emerg}%")
-        send_persistent_notification(
-            "ev_emergency",
-            "🚨 Emergenza EV - Carica Forzata",
-            f"EV SOC critico: {ev_soc}% (soglia: {ev_emerg}%). Carica minima forzata.",
-            "error"
-        )
+    # Emergency EV: sensore deve essere disponibile (campo derivato in state_derive)
+    ev_soc = state[S_EV_SOC]
+    ev_emerg = state[S_EV_SOC_EMERGENZA]
+    is_emergency = state[S_EMERGENCY]
+    if is_emergency:
+        scenario_hit("0")
+        log_warn("SCENARIO 0 (EMERGENZA EV): EV SOC %s%% < soglia %s%%", ev_soc, ev_emerg)
+        notify_condition("ev_emergency", True, f"EV SOC critico: {ev_soc}% (soglia: {ev_emerg}%). Carica minima forzata.")
 
     # SCENARIO 1: Forza carica -> niente pause
-    if state.get("forzacharge"):
+    if state[S_FORZACHARGE]:
+        scenario_hit("1")
         log_debug("SCENARIO 1: Carica forzata attiva")
         return None
 
     # SCENARIO 2: EV target raggiunto
-    if (ev_soc is not None) and ev_soc >= state.get("ev_target", 0):
+    if (ev_soc is not None) and ev_soc >= state[S_EV_TARGET]:
+        scenario_hit("2")
         return f"EV SOC target raggiunto ({ev_soc:.1f}%)"
 
-    # SCENARIO 3: Consumo casa eccessivo
-    if state.get("home_current", 0) > state.get("home_max_current", 0):
-        return f"Consumo casa eccessivo: {state['home_current']:.1f}A > {state['home_max_current']:.1f}A"
+    # SCENARIO 3: Consumo casa eccessivo (in main viene già gestito prima dal fast-path overcurrent_guard)
+    if state[S_HOME_CURRENT] > state[S_HOME_MAX_CURRENT]:
+        scenario_hit("3")
+        return f"Consumo casa eccessivo: {state[S_HOME_CURRENT]:.1f}A > {state[S_HOME_MAX_CURRENT]:.1f}A"
 
     # SCENARIO 4: Finestra di pausa (oraria)
-    start = state.get("ora_inizio_pausa")
-    end = state.get("ora_fine_pausa")
-    now = state.get("ora_attuale")
-    try:
-        if (start < end and start <= now <= end) or (start > end and (now >= start or now <= end)):
-            if is_emergency:
-                log_debug("SCENARIO 4: Pausa oraria bypassata per emergenza EV")
-            else:
-                return f"Finestra di pausa attiva ({start}-{end})"
-    except Exception:
-        pass
+    start = state[S_ORA_INIZIO_PAUSA]
+    end = state[S_ORA_FINE_PAUSA]
+    now = state[S_ORA_ATTUALE]
+    if in_time_window(start, end, now):
+        if is_emergency:
+            log_debug("SCENARIO 4: Pausa oraria bypassata per emergenza EV")
+        else:
+            scenario_hit("4")
+            return f"Finestra di pausa attiva ({start}-{end})"
 
     # SCENARIO 5: SOC batteria critico
-    if state.get("soc_attuale", 100) < state.get("soc_min", 0):
+    if state[S_SOC_ATTUALE] < state[S_SOC_MIN]:
         if is_emergency:
             log_debug("SCENARIO 5: SOC batteria critico bypassato per emergenza EV")
         else:
-            return f"SOC batteria critico: {state['soc_attuale']:.1f}% < {state['soc_min']:.1f}%"
+            scenario_hit("5")
+            return f"SOC batteria critico: {state[S_SOC_ATTUALE]:.1f}% < {state[S_SOC_MIN]:.1f}%"
 
     # SCENARIO 6: Protezione cicli batteria
-    cycles = get_float(e["batt_protection_cycles"], 0)
+    cycles = state[S_BATT_PROTECTION_CYCLES]
     if cycles > 0:
         new_cycles = max(0, int(cycles) - 1)
-        # Non passiamo blocking al servizio per compatibilità
-        call_service("input_number", "set_value", {"entity_id": e["batt_protection_cycles"], "value": new_cycles})
-        log_debug(f"SCENARIO 6: Protezione batteria attiva ({int(cycles)} -> {new_cycles} cicli rimanenti).")
+        store_set("cycles", new_cycles)
+        scenario_hit("6")
+        log_debug("SCENARIO 6: Protezione batteria attiva (%d -> %d cicli rimanenti).", int(cycles), new_cycles)
         return f"Protezione batteria attiva ({new_cycles} cicli rimanenti)"
 
     # SCENARIO 7: Nessuna pausa forzata
+    scenario_hit("7")
     log_debug("SCENARIO 7: Nessuna regola di pausa bloccante attiva")
     return None
 
@@ -331,158 +1720,620 @@ def calculate_target_amps(state, cfg):
     available_power = 0.0   # INIZIALIZZIAMO A 0 per evitare None-behaviour
     pause_reason = None
 
-    ev_soc = state.get("ev_soc")
-    ev_emerg = state.get("ev_soc_emergenza", 0.0)
-    is_emergency = (ev_soc is not None and ev_emerg and ev_soc < ev_emerg and ev_soc < 99.0)
+    is_emergency = state[S_EMERGENCY]
+    fc = forecast_usable(state, cfg)
+    min_power_threshold = state[S_MIN_WALLBOX_POWER] * p["min_power_ratio_for_min_amps"]
 
     # SCENARIO 8: Sole basso (pre-condizione per mettere in pausa)
-    if state.get("sun_elevation", 0) < state.get("elevation_limit", 0) and not state.get("is_rising", True):
-        log_debug(f"SCENARIO 8: Sole basso in discesa ({state.get('sun_elevation'):.1f}° < {state.get('elevation_limit'):.1f}°).")
+    sun_low = state[S_SUN_ELEVATION] < state[S_ELEVATION_LIMIT] and not state[S_IS_RISING]
+    if sun_low and fc and min(fc["surplus"][0], fc["surplus"][1]) >= min_power_threshold:
+        # SCENARIO 8b: la previsione dà ancora surplus utile per 30 minuti -> niente pausa, decidono gli scenari 10-13
+        scenario_hit("8b")
+        log_debug("SCENARIO 8b: Sole basso ma surplus previsto %sW/%sW a 15/30 min -> proseguo", fc["surplus"][0], fc["surplus"][1])
+    elif sun_low:
+        scenario_hit("8")
+        log_debug("SCENARIO 8: Sole basso in discesa (%.1f° < %.1f°).", state[S_SUN_ELEVATION], state[S_ELEVATION_LIMIT])
         # Non return immediato: permettiamo a emergenza EV (8a) di bypassare la pausa
         if not is_emergency:
-            pause_reason = f"Sole basso in discesa ({state.get('sun_elevation'):.1f}°)"
+            pause_reason = f"Sole basso in discesa ({state[S_SUN_ELEVATION]:.1f}°)"
             # available_power rimane 0 -> verrà trasformato in pausa successivamente
 
     # SCENARIO 8a: Emergenza EV -> forza min_amp e bypass pausa oraria/SOC
     if is_emergency:
-        log_warn(f"SCENARIO 8a: Emergenza EV -> forzo carica minima {state.get('min_amp')}A")
-        available_power = state.get("min_wallbox_power", state.get("min_amp", p.get("min_amp_default",6)) * state.get("voltage", 230))
+        scenario_hit("8a")
+        log_warn("SCENARIO 8a: Emergenza EV -> forzo carica minima %sA", state[S_MIN_AMP])
+        available_power = state[S_MIN_WALLBOX_POWER]
         # invio notifica gestita già in determine_pause_reason (se necessario)
         # Non sovrascriviamo pause_reason se la emergenza deve bypassarla
 
     # SCENARIO 9: Scarica batteria eccessiva -> riduzione dinamica (solo se non forzato)
-    if (not state.get("forzacharge", False)) and state.get("batt_power", 0) > (state.get("batt_max_discharge", 0) * p["batt_discharge_margin"]):
-        if state.get("pv_excess", 0) < 100 or state.get("soc_attuale", 0) < state.get("soc_priority", 0):
-            discharge_limit = state.get("batt_max_discharge", 0) * p["batt_discharge_margin"]
-            over_discharge_watts = state.get("batt_power") - discharge_limit
-            new_target_power = state.get("wallbox_power", 0) - over_discharge_watts - p.get("buffer_watts_on_discharge_reduce", 50)
+    if (not state[S_FORZACHARGE]) and state[S_BATT_POWER] > (state[S_BATT_MAX_DISCHARGE] * p["batt_discharge_margin"]):
+        if state[S_PV_EXCESS] < 100 or state[S_SOC_ATTUALE] < state[S_SOC_PRIORITY]:
+            discharge_limit = state[S_BATT_MAX_DISCHARGE] * p["batt_discharge_margin"]
+            over_discharge_watts = state[S_BATT_POWER] - discharge_limit
+            new_target_power = state[S_WALLBOX_POWER] - over_discharge_watts - p.get("buffer_watts_on_discharge_reduce", 50)
             available_power = max(0.0, new_target_power)
-            log_debug(f"SCENARIO 9: Scarica batteria eccessiva -> nuova PW {available_power:.1f}W")
+            scenario_hit("9")
+            log_debug("SCENARIO 9: Scarica batteria eccessiva -> nuova PW %.1fW", available_power)
 
     # SCENARIO 10-12: logiche basate su excess e SOC (solo se available_power non ancora deciso dall'emergenza o scarica eccessiva)
     if available_power <= 0:
-        effective_excess = state.get("pv_excess", 0.0)
+        effective_excess = state[S_PV_EXCESS]
 
         # Stimolo inverter secondario
-        if (not state.get("inverter_secondary_active")) and state.get("soc_attuale", 0) >= state.get("soc_min", 0) and state.get("pv_potential_secondary", 0) > state.get("min_wallbox_power", 0):
-            stimulus_power = state.get("pv_potential_secondary", 0)
+        if (not state[S_INVERTER_SECONDARY_ACTIVE]) and state[S_SOC_ATTUALE] >= state[S_SOC_MIN] and state[S_PV_POTENTIAL_SECONDARY] > state[S_MIN_WALLBOX_POWER]:
+            stimulus_power = state[S_PV_POTENTIAL_SECONDARY]
             effective_excess += stimulus_power
-            log_debug(f"Stimolo inverter secondario: aggiungo {stimulus_power:.1f}W (Excess stimolato: {effective_excess:.1f}W)")
+            log_debug("Stimolo inverter secondario: aggiungo %.1fW (Excess stimolato: %.1fW)", stimulus_power, effective_excess)
 
         # SCENARIO 10: SOC sotto min -> nessuna carica
-        if state.get("soc_attuale", 0) < state.get("soc_min", 0):
+        if state[S_SOC_ATTUALE] < state[S_SOC_MIN]:
+            scenario_hit("10")
             log_debug("SCENARIO 10: SOC Batteria sotto min -> PW disponibile = 0W")
             available_power = 0.0
 
         # SCENARIO 11: Priorità Batteria (tra min e priority)
-        elif state.get("soc_min", 0) <= state.get("soc_attuale", 0) < state.get("soc_priority", 0):
-            if effective_excess >= state.get("min_wallbox_power", 0):
-                excess_after_min = effective_excess - state.get("min_wallbox_power")
-                excess_for_batt = excess_after_min * (state.get("batt_priority_ratio", 0) / 100.0)
-                available_power = state.get("min_wallbox_power") + (excess_after_min - excess_for_batt)
-                log_debug(f"SCENARIO 11: PW Wallbox={available_power:.1f}W, PW Batt={excess_for_batt:.1f}W")
+        elif state[S_SOC_MIN] <= state[S_SOC_ATTUALE] < state[S_SOC_PRIORITY]:
+            if effective_excess >= state[S_MIN_WALLBOX_POWER]:
+                excess_after_min = effective_excess - state[S_MIN_WALLBOX_POWER]
+                excess_for_batt = excess_after_min * (state[S_BATT_PRIORITY_RATIO] / 100.0)
+                available_power = state[S_MIN_WALLBOX_POWER] + (excess_after_min - excess_for_batt)
+                scenario_hit("11")
+                log_debug("SCENARIO 11: PW Wallbox=%.1fW, PW Batt=%.1fW", available_power, excess_for_batt)
             else:
-                log_debug(f"SCENARIO 11a: Excess insufficiente ({effective_excess:.1f}W) -> PW=0")
+                scenario_hit("11a")
+                log_debug("SCENARIO 11a: Excess insufficiente (%.1fW) -> PW=0", effective_excess)
                 available_power = 0.0
 
         # SCENARIO 12: Batteria carica / SOC alto o normale
         else:
             # SCENARIO 12a: SOC molto alto -> forza max charge
-            if state.get("soc_attuale", 0) > p["force_charge_soc_threshold"]:
-                if effective_excess >= state.get("min_wallbox_power", 0):
+            if state[S_SOC_ATTUALE] > p["force_charge_soc_threshold"]:
+                if effective_excess >= state[S_MIN_WALLBOX_POWER]:
                     available_power = effective_excess
-                    log_debug(f"SCENARIO 12a: Max Charge usando surplus {available_power:.1f}W")
+                    scenario_hit("12a")
+                    log_debug("SCENARIO 12a: Max Charge usando surplus %.1fW", available_power)
                 else:
-                    min_power_threshold = state.get("min_wallbox_power", 0) * p["min_power_ratio_for_min_amps"]
+                    min_power_threshold = state[S_MIN_WALLBOX_POWER] * p["min_power_ratio_for_min_amps"]
                     if effective_excess >= min_power_threshold:
-                        available_power = state.get("min_wallbox_power", 0)
-                        log_debug(f"SCENARIO 12a-bis: Excess {effective_excess:.1f}W > soglia {min_power_threshold:.1f}W -> forzo carica minima")
+                        available_power = state[S_MIN_WALLBOX_POWER]
+                        scenario_hit("12a-bis")
+                        log_debug("SCENARIO 12a-bis: Excess %.1fW > soglia %.1fW -> forzo carica minima", effective_excess, min_power_threshold)
                     else:
                         available_power = 0.0
-                        log_debug(f"SCENARIO 12a-ter: Excess insufficiente ({effective_excess:.1f}W) -> PW=0")
+                        scenario_hit("12a-ter")
+                        log_debug("SCENARIO 12a-ter: Excess insufficiente (%.1fW) -> PW=0", effective_excess)
             # SCENARIO 12b: SOC normale, excess sufficiente
-            elif effective_excess >= state.get("min_wallbox_power", 0):
+            elif effective_excess >= state[S_MIN_WALLBOX_POWER]:
                 safety_margin = effective_excess * p["pv_safety_margin_ratio"]
                 available_power = max(0.0, effective_excess - safety_margin)
-                log_debug(f"SCENARIO 12b: Excess sufficiente -> PW netta {available_power:.1f}W (margin {safety_margin:.1f}W)")
+                TICK["track"] = effective_excess
+                scenario_hit("12b")
+                log_debug("SCENARIO 12b: Excess sufficiente -> PW netta %.1fW (margin %.1fW)", available_power, safety_margin)
             # SCENARIO 12c: Excess inferiore al minimo ma sopra soglia di attivazione
             else:
-                min_power_threshold = state.get("min_wallbox_power", 0) * p["min_power_ratio_for_min_amps"]
                 if effective_excess >= min_power_threshold:
-                    available_power = state.get("min_wallbox_power", 0)
-                    log_debug(f"SCENARIO 12c-bis: Excess {effective_excess:.1f}W > soglia {min_power_threshold:.1f}W -> forzo carica minima")
+                    available_power = state[S_MIN_WALLBOX_POWER]
+                    scenario_hit("12c-bis")
+                    log_debug("SCENARIO 12c-bis: Excess %.1fW > soglia %.1fW -> forzo carica minima", effective_excess, min_power_threshold)
+                # SCENARIO 12d: surplus in crescita, previsto sopra il minimo a 15 e 30 minuti -> avvio anticipato al minimo
+                elif (fc and fc["surplus"][0] > effective_excess and min(fc["surplus"][0], fc["surplus"][1]) >= state[S_MIN_WALLBOX_POWER]
+                      and effective_excess >= state[S_MIN_WALLBOX_POWER] * p.get("forecast_start_ratio", 0.5)):
+                    available_power = state[S_MIN_WALLBOX_POWER]
+                    scenario_hit("12d")
+                    log_debug("SCENARIO 12d: Excess %.1fW, previsti %sW/%sW a 15/30 min -> avvio anticipato al minimo",
+                              effective_excess, fc["surplus"][0], fc["surplus"][1])
                 else:
-                    log_debug(f"SCENARIO 12c: Excess insufficiente ({effective_excess:.1f}W) -> PW=0")
+                    scenario_hit("12c")
+                    log_debug("SCENARIO 12c: Excess insufficiente (%.1fW) -> PW=0", effective_excess)
                     available_power = 0.0
 
+    # SCENARIO 8c: piano di carica per la partenza -> potenza da garantire in questa fascia (sole + rete/batteria)
+    plan = state[S_PLAN]
+    if plan and plan["power"] > available_power:
+        available_power = plan["power"]
+        pause_reason = None
+        TICK["track"] = None
+        scenario_hit("8c")
+        log_debug("SCENARIO 8c: Partenza alle %s, mancano %.1fkWh -> garantisco %.0fW",
+                  time.strftime("%H:%M", time.localtime(plan["departure"])), plan["energy_wh"] / 1000.0, available_power)
+
     # Conversione in ampere e clamp
     clamped_amp = 0
-    if available_power is not None and available_power > 0 and state.get("voltage", 0) > 0:
-        available_amp = available_power / state["voltage"]
-        if available_amp >= state.get("min_amp", p.get("min_amp_default", 6)):
-            clamped_amp = int(round(max(state.get("min_amp", p.get("min_amp_default",6)), min(state.get("max_amp", 32), available_amp))))
-            log_debug(f"SCENARIO 13: PW {available_power:.1f}W -> {available_amp:.1f}A -> imposto {clamped_amp}A")
+    if available_power is not None and available_power > 0 and state[S_VOLTAGE] > 0:
+        available_amp = available_power / state[S_VOLTAGE]
+        if available_amp >= state[S_MIN_AMP]:
+            clamped_amp = int(round(max(state[S_MIN_AMP], min(state[S_MAX_AMP], available_amp))))
+            scenario_hit("13")
+            log_debug("SCENARIO 13: PW %.1fW -> %.1fA -> imposto %sA", available_power, available_amp, clamped_amp)
         else:
             # Se la potenza calcolata è inferiore al minimo ma sopra la soglia di attivazione -> forzo min_amp
-            min_power_threshold = state.get("min_wallbox_power", 0) * p["min_power_ratio_for_min_amps"]
+            min_power_threshold = state[S_MIN_WALLBOX_POWER] * p["min_power_ratio_for_min_amps"]
             if available_power >= min_power_threshold:
-                clamped_amp = int(state.get("min_amp", p.get("min_amp_default",6)))
-                log_debug(f"SCENARIO 13a: PW {available_power:.1f}W > soglia {min_power_threshold:.1f}W -> forzo {clamped_amp}A")
+                clamped_amp = int(state[S_MIN_AMP])
+                scenario_hit("13a")
+                log_debug("SCENARIO 13a: PW %.1fW > soglia %.1fW -> forzo %sA", available_power, min_power_threshold, clamped_amp)
             else:
                 clamped_amp = 0
                 if available_power is not None:
+                    scenario_hit("14")
                     pause_reason = f"Potenza calcolata troppo bassa ({available_power:.1f}W)"
 
     # Requisito aggiuntivo: wallbox non accetta valore inferiore al min_amp -> in quel caso PAUSA
-    if clamped_amp > 0 and clamped_amp < state.get("min_amp", p.get("min_amp_default",6)):
-        log_debug(f"Ampere calcolati ({clamped_amp}A) < min_amp ({state.get('min_amp')}A) -> imposto pausa")
+    if clamped_amp > 0 and clamped_amp < state[S_MIN_AMP]:
+        log_debug("Ampere calcolati (%sA) < min_amp (%sA) -> imposto pausa", clamped_amp, state[S_MIN_AMP])
         clamped_amp = 0
         if not pause_reason:
-            pause_reason = f"Ampere calcolati inferiori al minimo richiesto ({state.get('min_amp')}A)"
+            pause_reason = f"Ampere calcolati inferiori al minimo richiesto ({state[S_MIN_AMP]}A)"
 
     return clamped_amp, pause_reason
 
-# === 7. APPLICA STATO ALLA WALLBOX ===
-def apply_wallbox_state(target_amps, pause_reason, cfg):
-    e = cfg["entities"]
+# === 6b. TABELLA DECISIONALE COMPILATA (SCENARI 0..14) ===
+# Gli stessi scenari di determine_pause_reason e calculate_target_amps come tabelle ordinate di regole: condizioni
+# ed effetti sono espressioni sui campi di un record piatto a posizioni fisse (stato del tick, parametri, derivati).
+# decision_source ne genera il codice di decision_record, decide_pause e decide_amps, compilato una sola volta al
+# caricamento dal runtime residente (data["compile"]): le condizioni diventano confronti tra variabili locali.
+# Le funzioni generate non toccano store, log e notifiche: restituiscono le azioni (scenari attraversati, log,
+# notifica di emergenza, cicli di protezione, surplus da inseguire) che apply_decision_actions esegue nell'ordine
+# della cascata.
+# Come python_script (niente compile) e con decision_table: False il tick usa la cascata, che resta il riferimento:
+# tools/decision_check.py confronta le due versioni su stati casuali e sui valori di soglia e ne misura i tempi.
+
+# Record: lo stato del tick (STATE_SCHEMA, per posizione) seguito da parametri e campi derivati
+DECISION_PARAMS = (
+    ("min_power_ratio_for_min_amps", None), ("force_charge_soc_threshold", None), ("batt_discharge_margin", None),
+    ("pv_safety_margin_ratio", None), ("buffer_watts_on_discharge_reduce", 50), ("forecast_start_ratio", 0.5),
+)
+# Surplus previsto a 15/30 min: None se la previsione non è usabile; piano: None se non c'è potenza da garantire
+DECISION_DERIVED = (
+    ("threshold", "min_wallbox_power * min_power_ratio_for_min_amps"),
+    ("fc_15", "fc['surplus'][0] if fc else None"),
+    ("fc_30", "fc['surplus'][1] if fc else None"),
+    ("plan_power", "plan['power'] if plan else None"),
+    ("plan_departure", "plan['departure'] if plan else None"),
+    ("plan_kwh", "plan['energy_wh'] / 1000.0 if plan else None"),
+)
+
+SUN_LOW = "(sun_elevation < elevation_limit and not is_rising)"
+BATTERY_PRIORITY = "(soc_min <= soc_attuale < soc_priority)"
+SOC_FORCE = "(soc_attuale > force_charge_soc_threshold)"
+
+# SCENARI 0-7: (scenario, condizione, esito, ragione o notifica (formato, argomenti), log (formato, argomenti)).
+# Esiti: "alert" segnala l'emergenza EV e prosegue, "charge" chiude senza pausa, "pause" chiude con la ragione,
+# "pause_unless_emergency" come "pause" ma con emergenza EV registra il bypass (log) e prosegue,
+# "cycles" consuma un ciclo di protezione (cycles / left negli argomenti).
+PAUSE_RULES = (
+    ("0", "emergency", "alert",
+     ("EV SOC critico: %s%% (soglia: %s%%). Carica minima forzata.", ("ev_soc", "ev_soc_emergenza")),
+     ("SCENARIO 0 (EMERGENZA EV): EV SOC %s%% < soglia %s%%", ("ev_soc", "ev_soc_emergenza"))),
+    ("1", "forzacharge", "charge", None, ("SCENARIO 1: Carica forzata attiva", ())),
+    ("2", "ev_soc is not None and ev_soc >= ev_target", "pause", ("EV SOC target raggiunto (%.1f%%)", ("ev_soc",)), None),
+    ("3", "home_current > home_max_current", "pause",
+     ("Consumo casa eccessivo: %.1fA > %.1fA", ("home_current", "home_max_current")), None),
+    ("4", "in_time_window(ora_inizio_pausa, ora_fine_pausa, ora_attuale)", "pause_unless_emergency",
+     ("Finestra di pausa attiva (%s-%s)", ("ora_inizio_pausa", "ora_fine_pausa")),
+     ("SCENARIO 4: Pausa oraria bypassata per emergenza EV", ())),
+    ("5", "soc_attuale < soc_min", "pause_unless_emergency",
+     ("SOC batteria critico: %.1f%% < %.1f%%", ("soc_attuale", "soc_min")),
+     ("SCENARIO 5: SOC batteria critico bypassato per emergenza EV", ())),
+    ("6", "batt_protection_cycles > 0", "cycles", ("Protezione batteria attiva (%d cicli rimanenti)", ("left",)),
+     ("SCENARIO 6: Protezione batteria attiva (%d -> %d cicli rimanenti).", ("cycles", "left"))),
+    ("7", "True", "charge", None, ("SCENARIO 7: Nessuna regola di pausa bloccante attiva", ())),
+)
+
+# SCENARI 8-12 in fasi: (fase, condizione d'ingresso | None, solo la prima regola vera, regole).
+# Regola: (scenario | None, condizione, istruzioni sui registri power / excess / aux / reason, log | None);
+# log: (livello, formato, argomenti). aux porta nel log un valore intermedio dello scenario.
+POWER_STAGES = (
+    ("sole", None, True, (
+        ("8b", f"{SUN_LOW} and fc_15 is not None and min(fc_15, fc_30) >= threshold", (),
+         ("debug", "SCENARIO 8b: Sole basso ma surplus previsto %sW/%sW a 15/30 min -> proseguo", ("fc_15", "fc_30"))),
+        # Niente chiusura immediata: l'emergenza EV (8a) deve poter bypassare la pausa
+        ("8", SUN_LOW, ("if not emergency:", "    reason = 'Sole basso in discesa (%.1f°)' % (sun_elevation,)"),
+         ("debug", "SCENARIO 8: Sole basso in discesa (%.1f° < %.1f°).", ("sun_elevation", "elevation_limit"))),
+    )),
+    ("override", None, False, (
+        ("8a", "emergency", ("power = min_wallbox_power",),
+         ("warn", "SCENARIO 8a: Emergenza EV -> forzo carica minima %sA", ("min_amp",))),
+        ("9", "not forzacharge and batt_power > batt_max_discharge * batt_discharge_margin"
+              " and (pv_excess < 100 or soc_attuale < soc_priority)",
+         ("over_discharge_watts = batt_power - batt_max_discharge * batt_discharge_margin",
+          "power = max(0.0, wallbox_power - over_discharge_watts - buffer_watts_on_discharge_reduce)"),
+         ("debug", "SCENARIO 9: Scarica batteria eccessiva -> nuova PW %.1fW", ("power",))),
+    )),
+    ("stimolo", "power <= 0", False, (
+        (None, "not inverter_secondary_active and soc_attuale >= soc_min and pv_potential_secondary > min_wallbox_power",
+         ("excess = excess + pv_potential_secondary",),
+         ("debug", "Stimolo inverter secondario: aggiungo %.1fW (Excess stimolato: %.1fW)", ("pv_potential_secondary", "excess"))),
+    )),
+    ("surplus", "power <= 0", True, (
+        ("10", "soc_attuale < soc_min", ("power = 0.0",),
+         ("debug", "SCENARIO 10: SOC Batteria sotto min -> PW disponibile = 0W", ())),
+        ("11", f"{BATTERY_PRIORITY} and excess >= min_wallbox_power",
+         ("excess_after_min = excess - min_wallbox_power", "aux = excess_after_min * (batt_priority_ratio / 100.0)",
+          "power = min_wallbox_power + (excess_after_min - aux)"),
+         ("debug", "SCENARIO 11: PW Wallbox=%.1fW, PW Batt=%.1fW", ("power", "aux"))),
+        ("11a", BATTERY_PRIORITY, ("power = 0.0",),
+         ("debug", "SCENARIO 11a: Excess insufficiente (%.1fW) -> PW=0", ("excess",))),
+        ("12a", f"{SOC_FORCE} and excess >= min_wallbox_power", ("power = excess",),
+         ("debug", "SCENARIO 12a: Max Charge usando surplus %.1fW", ("power",))),
+        ("12a-bis", f"{SOC_FORCE} and excess >= threshold", ("power = min_wallbox_power",),
+         ("debug", "SCENARIO 12a-bis: Excess %.1fW > soglia %.1fW -> forzo carica minima", ("excess", "threshold"))),
+        ("12a-ter", SOC_FORCE, ("power = 0.0",),
+         ("debug", "SCENARIO 12a-ter: Excess insufficiente (%.1fW) -> PW=0", ("excess",))),
+        ("12b", "excess >= min_wallbox_power",
+         ("aux = excess * pv_safety_margin_ratio", "power = max(0.0, excess - aux)", "actions.append(('track', excess))"),
+         ("debug", "SCENARIO 12b: Excess sufficiente -> PW netta %.1fW (margin %.1fW)", ("power", "aux"))),
+        ("12c-bis", "excess >= threshold", ("power = min_wallbox_power",),
+         ("debug", "SCENARIO 12c-bis: Excess %.1fW > soglia %.1fW -> forzo carica minima", ("excess", "threshold"))),
+        ("12d", "fc_15 is not None and fc_15 > excess and min(fc_15, fc_30) >= min_wallbox_power"
+                " and excess >= min_wallbox_power * forecast_start_ratio", ("power = min_wallbox_power",),
+         ("debug", "SCENARIO 12d: Excess %.1fW, previsti %sW/%sW a 15/30 min -> avvio anticipato al minimo",
+          ("excess", "fc_15", "fc_30"))),
+        ("12c", "True", ("power = 0.0",), ("debug", "SCENARIO 12c: Excess insufficiente (%.1fW) -> PW=0", ("excess",))),
+    )),
+    ("piano", None, False, (
+        ("8c", "plan_power is not None and plan_power > power",
+         ("power = plan_power", "reason = None", "aux = time.strftime('%H:%M', time.localtime(plan_departure))",
+          "actions.append(('track', None))"),
+         ("debug", "SCENARIO 8c: Partenza alle %s, mancano %.1fkWh -> garantisco %.0fW", ("aux", "plan_kwh", "power"))),
+    )),
+)
+
+# Conversione in ampere e clamp (SCENARI 13, 13a, 14), in coda a decide_amps: come in calculate_target_amps
+DECISION_AMPS = (
+    "    clamped_amp = 0",
+    "    if power > 0 and voltage > 0:",
+    "        available_amp = power / voltage",
+    "        if available_amp >= min_amp:",
+    "            clamped_amp = int(round(max(min_amp, min(max_amp, available_amp))))",
+    "            actions.append(('hit', '13'))",
+    "            if debug:",
+    "                actions.append(('debug', 'SCENARIO 13: PW %.1fW -> %.1fA -> imposto %sA', (power, available_amp, clamped_amp)))",
+    "        elif power >= threshold:",
+    "            clamped_amp = int(min_amp)",
+    "            actions.append(('hit', '13a'))",
+    "            if debug:",
+    "                actions.append(('debug', 'SCENARIO 13a: PW %.1fW > soglia %.1fW -> forzo %sA', (power, threshold, clamped_amp)))",
+    "        else:",
+    "            actions.append(('hit', '14'))",
+    "            reason = 'Potenza calcolata troppo bassa (%.1fW)' % (power,)",
+    "    if clamped_amp > 0 and clamped_amp < min_amp:",
+    "        if debug:",
+    "            actions.append(('debug', 'Ampere calcolati (%sA) < min_amp (%sA) -> imposto pausa', (clamped_amp, min_amp)))",
+    "        clamped_amp = 0",
+    "        if not reason:",
+    "            reason = 'Ampere calcolati inferiori al minimo richiesto (%sA)' % (min_amp,)",
+    "    return clamped_amp, reason, actions",
+)
+
+def decision_args(args):
+    return "(" + ", ".join(args) + ("," if len(args) == 1 else "") + ")"
+
+def decision_log(log, indent):
+    level, fmt, args = log
+    line = f"actions.append(({repr(level)}, {repr(fmt)}, {decision_args(args)}))"
+    if level == "warn":
+        return [indent + line]
+    return [indent + "if debug:", indent + "    " + line]
+
+def decision_source():
+    """Codice Python di decision_record, decide_pause e decide_amps generato dalle tabelle."""
+    # Lo stato è già a posizioni fisse: il record lo estende con parametri e derivati senza copiarne i campi uno a uno
+    # (nelle funzioni generate i campi che le regole non leggono restano variabili locali inutilizzate)
+    state_names = ", ".join(f[0] for f in STATE_SCHEMA)
+    extra = [f[0] for f in DECISION_PARAMS] + [f[0] for f in DECISION_DERIVED]
+    unpack = f"    {state_names}, " + ", ".join(extra) + " = r"
+    lines = ["def decision_record(state, cfg):", "    p = cfg['params']", "    fc = forecast_usable(state, cfg)",
+             f"    plan = state[{S_PLAN}]", f"    {state_names} = state"]
+    lines += [f"    {name} = p.get({repr(name)}, {repr(default)})" for name, default in DECISION_PARAMS]
+    lines += [f"    {name} = {expr}" for name, expr in DECISION_DERIVED]
+    lines += ["    return state + [" + ", ".join(extra) + "]", ""]
+
+    lines += ["def decide_pause(r, debug=False):", unpack, "    actions = []"]
+    for label, cond, kind, text, log in PAUSE_RULES:
+        lines.append(f"    if {cond}:")
+        hit = f"        actions.append(('hit', {repr(label)}))"
+        reason = f"{repr(text[0])} % {decision_args(text[1])}" if text else None
+        if kind == "alert":
+            lines += [hit] + decision_log(("warn",) + log, "        ")
+            lines.append(f"        actions.append(('notify', 'ev_emergency', {reason}))")
+        elif kind == "pause_unless_emergency":
+            lines += ["        if emergency:"] + decision_log(("debug",) + log, "            ")
+            lines += ["        else:", "    " + hit, f"            return {reason}, actions"]
+        elif kind == "cycles":
+            lines += ["        cycles = int(batt_protection_cycles)", "        left = max(0, cycles - 1)",
+                      "        actions.append(('cycles', left))", hit] + decision_log(("debug",) + log, "        ")
+            lines.append(f"        return {reason}, actions")
+        else:
+            lines.append(hit)
+            if log:
+                lines += decision_log(("debug",) + log, "        ")
+            lines.append(f"        return {reason if kind == 'pause' else 'None'}, actions")
+    lines += ["    return None, actions", ""]
+
+    lines += ["def decide_amps(r, debug=False):", unpack, "    actions = []",
+              "    power = 0.0", "    excess = pv_excess", "    aux = None", "    reason = None"]
+    for stage, guard, first, rules in POWER_STAGES:
+        indent = "    "
+        lines.append(f"    # {stage}")
+        if guard:
+            lines.append(f"    if {guard}:")
+            indent = "        "
+        for n, (label, cond, body, log) in enumerate(rules):
+            if first and n > 0:
+                lines.append(f"{indent}else:" if cond == "True" else f"{indent}elif {cond}:")
+            else:
+                lines.append(f"{indent}if {cond}:")
+            lines += [indent + "    " + line for line in body]
+            if label is not None:
+                lines.append(f"{indent}    actions.append(('hit', {repr(label)}))")
+            if log:
+                lines += decision_log(log, indent + "    ")
+            if not body and label is None and not log:
+                lines.append(indent + "    pass")
+    lines += list(DECISION_AMPS) + [""]
+    return "\n".join(lines)
+
+def apply_decision_actions(actions):
+    """Esegue nell'ordine le azioni restituite da decide_pause / decide_amps."""
+    counters = STORE["data"].setdefault("counters", {})
+    trace = TICK["trace"]
+    for action in actions:
+        kind = action[0]
+        if kind == "hit":
+            # Come scenario_hit, con contatori e traccia letti una volta
+            label = action[1]
+            counters[label] = counters.get(label, 0) + 1
+            if trace is not None:
+                trace["hits"].append(label)
+        elif kind == "debug":
+            log_debug_args(action[1], action[2])
+        elif kind == "warn":
+            log_warn_args(action[1], action[2])
+        elif kind == "notify":
+            notify_condition(action[1], True, action[2])
+        elif kind == "cycles":
+            store_set("cycles", action[1])
+        elif kind == "track":
+            TICK["track"] = action[1]
+
+def decide(record, debug=False):
+    """Decisione completa sul record: (ragione delle regole di pausa, ampere, ragione del calcolo, azioni)."""
+    pause_reason, actions = DECISION["decide_pause"](record, debug)
+    if pause_reason:
+        return pause_reason, 0, None, actions
+    amps, calc_reason, more = DECISION["decide_amps"](record, debug)
+    return None, amps, calc_reason, actions + more
+
+def decide_batch(records, debug=False):
+    # Modalità batch (simulazioni, verifiche): le stesse funzioni compilate su una lista di record
+    return [decide(record, debug) for record in records]
+
+# Compilata una volta al caricamento; vuota come python_script (il tick usa la cascata)
+DECISION = {}
+if data.get("compile"):
+    DECISION = data["compile"](decision_source(), {"in_time_window": in_time_window, "forecast_usable": forecast_usable, "time": time})
+
+# === 6c. REGOLATORE PI SULLA POTENZA MISURATA (SCENARIO 12b) ===
+# Ad anello aperto la corrente è surplus / tensione meno il margine pv_safety_margin_ratio, qualunque cosa assorba
+# davvero l'auto (spesso meno del comandato, e con tensione diversa da quella misurata). Con regulator_mode "pi",
+# quando la potenza viene da SCENARIO 12b, il regolatore porta la potenza misurata della wallbox al surplus meno
+# regulator_margin_watts: l'errore (surplus - margine - wallbox_power) è la potenza che va in batteria/rete oltre
+# il margine. Uscita = riferimento + kp * errore + integrale, limitata tra min e max ampere e in velocità
+# (regulator_rise/fall_amps_per_second); anti-windup con integrazione condizionata: l'integrale resta fermo se
+# l'uscita è limitata nel verso dell'errore, se l'auto non segue il comando (regulator_follow_ratio) o dentro la
+# banda morta, ed è comunque limitato a regulator_integral_watts. Negli altri scenari, in pausa o dopo un buco di
+# regulator_reset_seconds riparte dagli ampere ad anello aperto. tools/regulator_sim.py lo verifica su un modello
+# di auto e impianto.
+def regulator_new():
+    return {"on": False, "amps": 0.0, "i": 0.0, "e": 0.0, "ts": 0}
+
+def regulator_amps(target_amps, state, cfg):
+    """Ampere del regolatore PI per gli ampere ad anello aperto target_amps (> 0, senza ragione di pausa)."""
+    p = cfg["params"]
+    st = STORE["data"]
+    reg = st.setdefault("regulator", regulator_new())
+    track = TICK["track"]
+    voltage = state[S_VOLTAGE]
+    now = now_ts()
+    dt = now - reg["ts"]
+    if track is None or voltage <= 0:
+        reg["on"] = False
+        return target_amps
+    if not reg["on"] or TICK["device"]["mode"] != "normal" or not 0 < dt <= p.get("regulator_reset_seconds", 300):
+        # Avvio (o ripresa dopo una pausa / un altro scenario): si parte dagli ampere ad anello aperto
+        reg.update({"on": True, "amps": float(target_amps), "i": 0.0, "e": 0.0, "ts": now})
+        log_debug("REGOLATORE PI: avvio da %sA", target_amps)
+        return target_amps
+    measured = state[S_WALLBOX_POWER]
+    setpoint = track - p.get("regulator_margin_watts", 60)
+    error = setpoint - measured
+    wanted = (setpoint + p.get("regulator_kp", 0.2) * error + reg["i"]) / voltage
+    previous = reg["amps"]
+    out = min(wanted, previous + p.get("regulator_rise_amps_per_second", 0.1) * dt)
+    out = max(out, previous - p.get("regulator_fall_amps_per_second", 0.5) * dt)
+    out = max(state[S_MIN_AMP], min(state[S_MAX_AMP], out))
+    # Anti-windup: niente integrazione se l'uscita è limitata nel verso dell'errore o se l'auto non segue il comando
+    limited = (error > 0 and out < wanted) or (error < 0 and out > wanted)
+    lagging = error > 0 and measured < p.get("regulator_follow_ratio", 0.7) * round(previous) * voltage
+    if abs(error) > p.get("regulator_deadband_watts", 40) and not limited and not lagging:
+        bound = p.get("regulator_integral_watts", 1500)
+        reg["i"] = max(-bound, min(bound, reg["i"] + p.get("regulator_ki", 0.01) * error * dt))
+    reg["amps"] = out
+    reg["e"] = error
+    reg["ts"] = now
+    amps = int(round(out))
+    log_debug("REGOLATORE PI: surplus %.1fW, wallbox %.1fW, errore %.1fW, integrale %.1fW -> %.2fA -> %sA (anello aperto %sA)",
+              track, measured, error, reg["i"], out, amps, target_amps)
+    return amps
+
+# === 7. SCHEDULER ANTI-FLAP PAUSA/CARICA ===
+def transitions_last_hour(st, now):
+    return [t for t in st.get("transitions", []) if now - t < 3600]
+
+def schedule_transition(want_pause, cfg):
+    """
+    Decide se il passaggio carica <-> pausa richiesto può avvenire adesso:
+    carica minima (min_charge_seconds) prima di una pausa, pausa minima (min_pause_seconds) e budget
+    di transizioni orarie (max_transitions_per_hour) prima di una ripresa.
+    Restituisce None se la transizione è consentita, altrimenti la spiegazione del rinvio.
+    """
+    p = cfg["params"]
+    st = STORE["data"]
+    current = st.get("mode")
+    desired = "paused" if want_pause else "normal"
+    if current is None or current == desired:
+        return None
+    now = now_ts()
+    elapsed = now - st.get("mode_ts", 0)
+    if want_pause:
+        min_on = p.get("min_charge_seconds", 0)
+        if elapsed < min_on:
+            return f"Pausa rimandata: carica minima ancora per {int(min_on - elapsed)}s"
+        return None
+    min_off = p.get("min_pause_seconds", 0)
+    if elapsed < min_off:
+        return f"Ripresa rimandata: pausa minima ancora per {int(min_off - elapsed)}s"
+    budget = p.get("max_transitions_per_hour", 0)
+    recent = transitions_last_hour(st, now)
+    if budget and len(recent) >= budget:
+        free_in = int(3600 - (now - min(recent)))
+        return f"Ripresa rimandata: {len(recent)}/{budget} transizioni nell'ultima ora (libera tra {free_in}s)"
+    return None
+
+def note_deferred(explanation):
+    st = STORE["data"]
+    st["deferred_total"] = st.get("deferred_total", 0) + 1
+    TICK["deferred"] = explanation
+    log_debug("ANTI-FLAP: %s", explanation)
+
+# === 7b. APPLICA STATO ALLA WALLBOX ===
+def apply_pause(reason, state, cfg, deferrable):
+    # Le pause di sicurezza/regole non passano dall'anti-flap; quelle per potenza insufficiente sì
+    if deferrable:
+        deferred = schedule_transition(True, cfg)
+        if deferred:
+            # Resto in carica al minimo finché non è trascorso il tempo minimo di carica
+            min_amp = int(state[S_MIN_AMP])
+            note_deferred(f"{deferred} ({reason})")
+            command_wallbox_current(min_amp, cfg)
+            command_wallbox_mode("normal", cfg)
+            return min_amp, False, TICK["deferred"]
+    command_wallbox_mode("paused", cfg)
+    return 0, True, reason
+
+def apply_wallbox_state(target_amps, pause_reason, state, cfg, deferrable=False):
     p = cfg["params"]
 
     # Se target_amps è 0 O c'è una ragione di pausa -> METTI IN PAUSA
     if pause_reason or target_amps == 0:
-        log_debug(f"SCENARIO 15: Applico pausa -> {pause_reason or 'Potenza insufficiente'}")
-        call_service("select", "select_option", {"entity_id": e["wallbox_set_mode"], "option": "paused"})
-        return 0, True, pause_reason or "Potenza insufficiente"
+        scenario_hit("15")
+        log_debug("SCENARIO 15: Applico pausa -> %s", pause_reason or "Potenza insufficiente")
+        return apply_pause(pause_reason or "Potenza insufficiente", state, cfg, deferrable)
 
     # Stabilizzazione
-    last_amp = get_float(e["last_wallbox_current"], 0)
+    last_amp = state[S_LAST_WALLBOX_CURRENT]
     final_amps = target_amps
     if target_amps > 0 and last_amp > 0:
         if abs(target_amps - last_amp) < p["stabilization_delta_amp"]:
             final_amps = int(last_amp)
-            log_debug(f"SCENARIO 16: Stabilizzazione -> mantengo {final_amps}A")
+            scenario_hit("16")
+            log_debug("SCENARIO 16: Stabilizzazione -> mantengo %sA", final_amps)
 
     # Verifica che final_amps sia >= min_amp (wallbox non accetta inferiore)
-    if final_amps < state_local.get("min_amp", p.get("min_amp_default",6)):
-        log_debug(f"SCENARIO 17a: Ampere insufficienti ({final_amps}A) -> pausa")
-        call_service("select", "select_option", {"entity_id": e["wallbox_set_mode"], "option": "paused"})
-        return 0, True, "Ampere insufficienti"
+    if final_amps < state[S_MIN_AMP]:
+        scenario_hit("17a")
+        log_debug("SCENARIO 17a: Ampere insufficienti (%sA) -> pausa", final_amps)
+        return apply_pause("Ampere insufficienti", state, cfg, deferrable)
+
+    # Ripresa dalla pausa: soggetta a pausa minima e budget di transizioni
+    if deferrable:
+        deferred = schedule_transition(False, cfg)
+        if deferred:
+            note_deferred(deferred)
+            command_wallbox_mode("paused", cfg)
+            return 0, True, deferred
 
     # Applicazione corrente
-    log_debug(f"SCENARIO 17: Applico carica -> impostati {final_amps}A")
-    call_service("number", "set_value", {"entity_id": e["wallbox_set_current"], "value": final_amps})
-    call_service("input_number", "set_value", {"entity_id": e["last_wallbox_current"], "value": final_amps})
-    call_service("select", "select_option", {"entity_id": e["wallbox_set_mode"], "option": "normal"})
+    scenario_hit("17")
+    log_debug("SCENARIO 17: Applico carica -> impostati %sA", final_amps)
+    command_wallbox_current(final_amps, cfg)
+    command_wallbox_mode("normal", cfg)
     return final_amps, False, "Carica attiva"
 
-# Note: apply_wallbox_state needs min_amp value; to avoid passing state everywhere we will keep a wrapper that passes state_local
-
 # === 8. AGGIORNA SENSORE DI STATO ===
-def update_status_sensor(final_amps, pause_mode, pause_reason, state_data, cfg, start_ts, end_ts):
-    e = cfg["entities"]
-    execution_time = 0
-    if start_ts and end_ts:
-        execution_time = end_ts - start_ts
+# Ogni scrittura del sensore di stato è una riga nel recorder e un push a tutte le dashboard aperte: lo riscriviamo
+# solo quando cambia lo stato o un attributo significativo, e comunque almeno ogni status_heartbeat_seconds.
+# Potenze, SOC e correnti hanno una banda morta (attributo -> parametro) rispetto all'ultimo valore pubblicato,
+# così anche una deriva lenta prima o poi viene scritta. Nei testi di STATUS_TEXT (ragioni con conti alla rovescia
+# e potenze) conta solo il testo senza cifre; gli altri attributi contano a ogni variazione, tranne quelli di
+# STATUS_PASSIVE (cambiano a ogni tick) che vengono aggiornati solo insieme agli altri.
+# Ultimo aggiornamento, durata del tick e contatori dei comandi sono telemetria: stanno nel sensore diagnostico.
+STATUS_DEADBANDS = {
+    "Power FTV": "status_deadband_watts",
+    "Deye Stringa EST": "status_deadband_watts",
+    "Deye Stringa OVEST": "status_deadband_watts",
+    "Genius PW Prevista": "status_deadband_watts",
+    "PW Casa": "status_deadband_watts",
+    "PW Solare Eccesso": "status_deadband_watts",
+    "PW Batteria": "status_deadband_watts",
+    "SOC Casa": "status_deadband_percent",
+    "Quota Surplus W": "status_deadband_watts",
+    "Quota Corrente A": "status_deadband_amps",
+}
+STATUS_TEXT = ("Ragione Pausa", "Transizione Rimandata")
+STATUS_PASSIVE = ("Previsione Surplus W",)
+
+def status_new():
+    return {"state": None, "attrs": {}, "ts": 0, "written": 0, "skipped": 0}
+
+def status_text_key(text):
+    return "".join([c for c in text if not c.isdigit()])
 
+def status_changed(last, state_str, attrs, p):
+    """True se stato o attributi differiscono dall'ultima pubblicazione oltre le bande morte."""
+    if last["state"] != state_str or len(last["attrs"]) != len(attrs):
+        return True
+    old = last["attrs"]
+    for key in attrs:
+        if key in STATUS_PASSIVE:
+            continue
+        if key not in old:
+            return True
+        band = STATUS_DEADBANDS.get(key)
+        if key in STATUS_TEXT:
+            if attrs[key] != old[key] and status_text_key(attrs[key]) != status_text_key(old[key]):
+                return True
+        elif band is None:
+            if attrs[key] != old[key]:
+                return True
+        elif abs(attrs[key] - old[key]) >= (p.get(band, 0) or 1e-9):
+            return True
+    return False
+
+def publish_status(entity_id, state_str, attrs, cfg):
+    """Scrive il sensore di stato se è cambiato qualcosa di significativo o è scaduto l'heartbeat."""
+    st = STORE["data"]
+    last = st.setdefault("status", status_new())
+    now = now_ts()
+    p = cfg["params"]
+    if (now - last["ts"]) < p.get("status_heartbeat_seconds", 600) and not status_changed(last, state_str, attrs, p):
+        last["skipped"] = last["skipped"] + 1
+        return False
+    try:
+        hass.states.set(entity_id, state_str, attrs)
+    except Exception as exc:
+        log_warn(f"Errore nell'aggiornamento del sensore di stato: {exc}")
+        return False
+    last["state"] = state_str
+    last["attrs"] = attrs
+    last["ts"] = now
+    last["written"] = last["written"] + 1
+    return True
+
+def update_status_sensor(final_amps, pause_mode, pause_reason, state_data, cfg):
+    e = cfg["entities"]
     if pause_reason == "Connettore non collegato":
         final_state_str = "🔌 Non Collegato"
         final_icon = "mdi:power-plug-off"
@@ -491,122 +2342,630 @@ def update_status_sensor(final_amps, pause_mode, pause_reason, state_data, cfg,
         final_icon = "mdi:pause" if pause_mode else "mdi:ev-station"
 
     attrs = {
-        "Rete Elettrica": "Connessa" if state_data.get("grid_present", True) else "Disconnessa",
-        "Power FTV": round(state_data.get("pv_power", 0), 1),
-        "Deye Stringa EST": round(state_data.get("pv_primary", 0), 1),
-        "Deye Stringa OVEST": round(state_data.get("pv_secondary", 0), 1),
-        "Inverter Genius": state_data.get("inverter_secondary_active", False),
-        "Genius PW Prevista": round(state_data.get("pv_potential_secondary", 0), 1),
-        "PW Casa": round(state_data.get("home_power", 0), 1),
-        "PW Solare Eccesso": round(state_data.get("pv_excess", 0), 1),
-        "PW Batteria": round(state_data.get("batt_power", 0), 1),
-        "SOC Casa": round(state_data.get("soc_attuale", 0), 1),
+        "Rete Elettrica": "Connessa" if state_data[S_GRID_PRESENT] else "Disconnessa",
+        "Power FTV": round(state_data[S_PV_POWER], 1),
+        "Deye Stringa EST": round(state_data[S_PV_PRIMARY], 1),
+        "Deye Stringa OVEST": round(state_data[S_PV_SECONDARY], 1),
+        "Inverter Genius": state_data[S_INVERTER_SECONDARY_ACTIVE],
+        "Genius PW Prevista": round(state_data[S_PV_POTENTIAL_SECONDARY], 1),
+        "PW Casa": round(state_data[S_HOME_POWER], 1),
+        "PW Solare Eccesso": round(state_data[S_PV_EXCESS], 1),
+        "PW Batteria": round(state_data[S_BATT_POWER], 1),
+        "SOC Casa": round(state_data[S_SOC_ATTUALE], 1),
         "Amp. -> Wallbox": final_amps,
         "Pausa": "SI" if pause_mode else "NO",
         "Ragione Pausa": pause_reason or "",
-        "Ult. Aggiornamento": get_str(e["date_time_iso"]),
-        "Durata Script": round(execution_time, 3),
+        "Transizione Rimandata": TICK["deferred"] or "",
+        "Transizioni Ultima Ora": len(transitions_last_hour(STORE["data"], now_ts())),
+        "Transizioni Totali": STORE["data"].get("transitions_total", 0),
+        "Transizioni Rimandate": STORE["data"].get("deferred_total", 0),
+        "Costo Transizioni kWh": round(STORE["data"].get("transitions_total", 0) * cfg["params"].get("transition_cost_wh", 0) / 1000.0, 3),
+        "Previsione Surplus W": forecast_attribute(state_data[S_FORECAST]),
+        "Piano Carica": plan_attribute(state_data[S_PLAN]),
         "icon": final_icon,
         "Nome Sensore": "Wallbox Status",
         "info": "v2025.11.0"
     }
+    if state_data[S_STALE]:
+        attrs["Sensori Non Aggiornati"] = ", ".join(sorted(state_data[S_STALE]))
+    share = state_data[S_ALLOCATION]
+    if share:
+        attrs["Wallbox"] = TICK["charger"]
+        attrs["Quota Surplus W"] = round(share["surplus"], 1)
+        attrs["Quota Corrente A"] = round(share["current"], 1)
+    publish_status(e["status_sensor"], final_state_str, attrs, cfg)
+
+# === 8b. TEMPI PER FASE E SENSORE DIAGNOSTICO ===
+def timing_record(cfg):
+    """Aggiunge i tempi del tick alle finestre mobili per fase (µs interi, al massimo timing_window campioni)."""
+    size = cfg["params"].get("timing_window", 60)
+    if not size:
+        return
+    windows = STORE["data"].setdefault("timing", {})
+    t = TICK["timing"]
+    for stage in TIMING_STAGES:
+        samples = windows.get(stage, [])
+        samples.append(int(round(t.get(stage, 0.0) * 1000000)))
+        windows[stage] = samples[-size:] if len(samples) > size else samples
+
+def timing_percentile(sorted_samples, pct):
+    return sorted_samples[int(round(pct / 100.0 * (len(sorted_samples) - 1)))]
+
+def publish_diagnostics(cfg, last_update, duration):
+    """
+    Pubblica ultimo valore e p50/p95/p99 di ogni fase e la telemetria del tick (ultimo aggiornamento, durata,
+    comandi, scritture del sensore di stato), al massimo ogni diagnostics_publish_seconds.
+    """
+    st = STORE["data"]
+    now = now_ts()
+    if (now - st.get("diag_ts", 0)) < cfg["params"].get("diagnostics_publish_seconds", 60):
+        return
+    st["diag_ts"] = now
+    windows = st.get("timing", {})
+    t = TICK["timing"]
+    attrs = {}
+    for stage in TIMING_STAGES:
+        attrs[f"{stage}_ms"] = round(t.get(stage, 0.0) * 1000, 3)
+        samples = sorted(windows.get(stage, []))
+        if samples:
+            attrs[f"{stage}_p50_ms"] = round(timing_percentile(samples, 50) / 1000.0, 3)
+            attrs[f"{stage}_p95_ms"] = round(timing_percentile(samples, 95) / 1000.0, 3)
+            attrs[f"{stage}_p99_ms"] = round(timing_percentile(samples, 99) / 1000.0, 3)
+    attrs["Campioni"] = len(windows.get("total", []))
+    status = st.get("status", status_new())
+    attrs["Ult. Aggiornamento"] = last_update
+    attrs["Durata Script"] = duration
+    attrs["Comandi Inviati"] = TICK["commands"]["issued"]
+    attrs["Comandi Soppressi"] = TICK["commands"]["suppressed"]
+    attrs["Comandi Falliti"] = TICK["commands"].get("failed", 0)
+    attrs["Comandi Ripetuti"] = TICK["commands"].get("retried", 0)
+    for key, stats in st.get("dispatch", {}).items():
+        attrs[f"Comando {key} ms"] = stats["last"]
+        attrs[f"Comando {key} max ms"] = stats["max"]
+    attrs["Sensori Non Aggiornati"] = ", ".join(st.get("stale", []))
+    attrs["Tick Con Sensori Non Aggiornati"] = st.get("stale_ticks", 0)
+    reg = st.get("regulator")
+    if cfg["params"].get("regulator_mode") == "pi" and reg:
+        attrs["Regolatore"] = "attivo" if reg["on"] else "anello aperto"
+        attrs["Regolatore Errore W"] = round(reg["e"], 1)
+        attrs["Regolatore Integrale W"] = round(reg["i"], 1)
+    attrs["Stato Scritto"] = status["written"]
+    attrs["Stato Non Scritto"] = status["skipped"]
+    attrs["Orologio"] = "monotono" if data.get("clock") else "time.time"
+    attrs["unit_of_measurement"] = "ms"
+    attrs["friendly_name"] = "Wallbox Diagnostics"
+    attrs["icon"] = "mdi:timer-outline"
     try:
-        hass.states.set(e["status_sensor"], final_state_str, attrs)
+        hass.states.set(cfg["entities"]["diagnostics_sensor"], attrs["total_ms"], attrs)
     except Exception as exc:
-        log_warn(f"Errore nell'aggiornamento del sensore di stato: {exc}")
+        log_warn(f"Errore nell'aggiornamento del sensore diagnostico: {exc}")
+
+# === 8c. CONTABILITÀ ENERGIA DELLA WALLBOX ===
+# A ogni tick la potenza della wallbox viene divisa tra FTV, batteria e rete; l'energia di ogni fonte è l'integrale
+# a trapezi di queste potenze sui timestamp reali dei tick (now_ts). Dopo un buco più lungo di
+# energy_max_gap_seconds o un tick chiuso dai controlli preliminari (nessuno stato letto) l'intervallo non viene
+# integrato: meglio un totale un po' più basso che energia inventata. Si usano le letture grezze, non i valori
+# filtrati su cui decidono gli scenari.
+# - home_first: i consumi domestici prendono per primi FTV e batteria; alla EV va il surplus FTV, poi la scarica
+#   della batteria che avanza oltre il deficit della casa, il resto dalla rete. Con più wallbox il surplus è la
+#   quota della wallbox, già al netto di quanto comandato dalle wallbox con priorità più alta.
+# - proportional: ogni fonte copre tutti i consumi (casa + wallbox) in proporzione alla loro potenza.
+# Totali cumulativi in Wh (mai azzerati, per i sensori del pannello Energia) e righe compatte
+# [giorno o mese, Wh FTV, Wh batteria, Wh rete, €] per gli ultimi energy_days giorni e energy_months mesi.
+# Il costo vale l'energia dalla rete al prezzo di acquisto e quella FTV o dalla batteria al prezzo di cessione
+# (ricavo mancato); il risparmio è il confronto con la stessa energia tutta dalla rete.
+ENERGY_SOURCES = (
+    # (sensore, nome, icona)
+    ("energy_solar_sensor", "Wallbox Energia Solare", "mdi:solar-power"),
+    ("energy_battery_sensor", "Wallbox Energia Batteria", "mdi:home-battery"),
+    ("energy_grid_sensor", "Wallbox Energia Rete", "mdi:transmission-tower"),
+)
+
+def energy_new():
+    return {"ts": None, "w": [0.0, 0.0, 0.0], "wh": [0.0, 0.0, 0.0], "days": [], "months": [], "pub_ts": 0}
+
+def energy_copy(en):
+    # Liste e righe non vengono mai modificate (energy_account e energy_bucket le sostituiscono): basta la copia del dict
+    return {"ts": en.get("ts"), "w": en.get("w", [0.0, 0.0, 0.0]), "wh": en.get("wh", [0.0, 0.0, 0.0]),
+            "days": en.get("days", []), "months": en.get("months", []), "pub_ts": en.get("pub_ts", 0)}
+
+def energy_sources(state, p):
+    """Potenza della wallbox (W) divisa tra FTV, batteria e rete."""
+    wallbox = max(0.0, state[S_WALLBOX_POWER])
+    if wallbox <= 0:
+        return [0.0, 0.0, 0.0]
+    batt = state[S_BATT_POWER_RAW] if state[S_BATT_POWER_RAW] is not None else state[S_BATT_POWER]
+    if p.get("energy_attribution", "home_first") == "proportional":
+        home = state[S_HOME_POWER_RAW] if state[S_HOME_POWER_RAW] is not None else state[S_HOME_POWER]
+        home = max(home, wallbox)
+        pv = min(state[S_PV_POWER], home)
+        from_batt = min(max(0.0, batt), home - pv)
+        ratio = wallbox / home
+        return [pv * ratio, from_batt * ratio, (home - pv - from_batt) * ratio]
+    excess = state[S_PV_EXCESS_RAW] if state[S_PV_EXCESS_RAW] is not None else state[S_PV_EXCESS]
+    pv = min(wallbox, max(0.0, excess))
+    from_batt = min(wallbox - pv, max(0.0, batt - max(0.0, -excess)))
+    return [pv, from_batt, wallbox - pv - from_batt]
+
+def energy_bucket(rows, key, wh, cost, size):
+    # Riga del giorno (o mese) corrente, creata al primo intervallo integrato; restano le ultime size righe
+    # Lista e riga nuove a ogni intervallo: quelle precedenti possono essere condivise con il blob pubblicato
+    if not rows or rows[-1][0] != key:
+        rows = rows[-(size - 1):] if size > 1 else []
+        row = [key, 0.0, 0.0, 0.0, 0.0]
+    else:
+        row = rows[-1]
+        rows = rows[:-1]
+    return rows + [[key, row[1] + wh[0], row[2] + wh[1], row[3] + wh[2], row[4] + cost]]
+
+def energy_cost(wh, p):
+    return (wh[2] * p.get("energy_grid_price", 0.0) + (wh[0] + wh[1]) * p.get("energy_feed_in_price", 0.0)) / 1000.0
+
+def energy_account(state, cfg):
+    """Integra l'energia alla EV dall'ultimo tick e pubblica i sensori per fonte (state None = intervallo saltato)."""
+    en = STORE["data"].setdefault("energy", energy_new())
+    p = cfg["params"]
+    now = now_ts()
+    if state is None:
+        en["ts"] = None
+        return
+    w = energy_sources(state, p)
+    if en["ts"] is not None and 0 < now - en["ts"] <= p.get("energy_max_gap_seconds", 900):
+        hours = (now - en["ts"]) / 3600.0
+        wh = [(en["w"][i] + w[i]) / 2.0 * hours for i in range(3)]
+        if wh[0] or wh[1] or wh[2]:
+            en["wh"] = [en["wh"][i] + wh[i] for i in range(3)]
+            # L'intervallo va tutto nel giorno del tick che lo chiude
+            day = time.strftime("%Y-%m-%d", time.localtime(now))
+            cost = energy_cost(wh, p)
+            en["days"] = energy_bucket(en["days"], day, wh, cost, p.get("energy_days", 35))
+            en["months"] = energy_bucket(en["months"], day[:7], wh, cost, p.get("energy_months", 24))
+    en["ts"] = now
+    en["w"] = w
+    # Prima pubblicazione dopo energy_publish_seconds: i sensori nascono con energia già integrata
+    if not en["pub_ts"]:
+        en["pub_ts"] = now
+    if (now - en["pub_ts"]) < p.get("energy_publish_seconds", 300):
+        return
+    en["pub_ts"] = now
+    energy_publish(en, cfg, now)
+
+def energy_publish(en, cfg, now):
+    """Un sensore per fonte compatibile con il pannello Energia (kWh, total_increasing) con oggi, mese e costi."""
+    p = cfg["params"]
+    day = time.strftime("%Y-%m-%d", time.localtime(now))
+    today = en["days"][-1] if en["days"] and en["days"][-1][0] == day else [day, 0.0, 0.0, 0.0, 0.0]
+    month = en["months"][-1] if en["months"] and en["months"][-1][0] == day[:7] else [day[:7], 0.0, 0.0, 0.0, 0.0]
+    today_total = today[1] + today[2] + today[3]
+    for i, (key, name, icon) in enumerate(ENERGY_SOURCES):
+        attrs = {
+            "Oggi kWh": round(today[i + 1] / 1000.0, 3),
+            "Mese kWh": round(month[i + 1] / 1000.0, 3),
+            "Quota Oggi %": round(today[i + 1] / today_total * 100.0, 1) if today_total else 0.0,
+            "unit_of_measurement": "kWh",
+            "device_class": "energy",
+            "state_class": "total_increasing",
+            "friendly_name": name,
+            "icon": icon,
+        }
+        if key == "energy_grid_sensor":
+            price = p.get("energy_grid_price", 0.0)
+            attrs["Costo Oggi €"] = round(today[4], 2)
+            attrs["Costo Mese €"] = round(month[4], 2)
+            attrs["Risparmio Mese €"] = round((month[1] + month[2] + month[3]) * price / 1000.0 - month[4], 2)
+        try:
+            hass.states.set(cfg["entities"][key], round(en["wh"][i] / 1000.0, 3), attrs)
+        except Exception as exc:
+            log_warn(f"Errore nell'aggiornamento del sensore energia: {exc}")
+
+def finish_tick(final_amps, pause_mode, pause_reason, state, cfg, start_ts, end_ts, last_update):
+    # state None: tick chiuso dai controlli preliminari, prima della lettura dello stato (niente riga di history)
+    # I comandi partono per primi; nel runtime residente la pubblicazione avviene mentre si attende la conferma
+    dispatch_begin(cfg)
+    notifications_sync(cfg)
+    store_record(final_amps, pause_mode, state, cfg)
+    started = stage_start()
+    update_status_sensor(final_amps, pause_mode, pause_reason, STATE_DEFAULTS if state is None else state, cfg)
+    energy_account(state, cfg)
+    stage_end("publish", started)
+    # Con più wallbox gli esiti vengono attesi una volta per tutte a fine run_site_tick
+    if TICK["charger"] is None:
+        dispatch_finish()
+    TICK["timing"]["total"] = PERF_CLOCK() - start_ts
+    timing_record(cfg)
+    duration = round(end_ts - start_ts, 3) if start_ts and end_ts else None
+    publish_diagnostics(cfg, last_update, duration)
+    store_save(cfg)
+    if TICK["trace"] is not None:
+        trace_flush(final_amps, pause_mode, pause_reason, duration)
+    else:
+        log_debug("Script TERMINATO - %s %sA - motivo: %s - durata %ss", "PAUSA" if pause_mode else "CARICA", final_amps,
+                  pause_reason or "Nessuno", duration)
+    return 0 if pause_mode else final_amps
 
 # === 9. RUNNER PRINCIPALE ===
 def main():
-    global state_local
-    start_ts = get_float(CONFIG["entities"]["current_timestamp"], 0)
-    dt_iso_start = get_str(CONFIG["entities"]["date_time_iso"], "")
+    # Durate misurate con PERF_CLOCK: il sensore template current_timestamp non si aggiorna durante il tick
+    start_ts = PERF_CLOCK()
+    if CONFIG.get("chargers"):
+        run_site_tick(start_ts)
+    else:
+        run_tick(read_snapshot(CONFIG), start_ts)
+
+def run_tick(snap, start_ts, cfg=None, share=None):
+    """
+    Un tick completo a partire da uno snapshot già letto (da hass o dal simulatore offline); start_ts è in PERF_CLOCK.
+    Con più wallbox cfg è la configurazione della wallbox e share la sua quota di surplus e corrente (run_site_tick).
+    Restituisce gli ampere comandati (0 = pausa).
+    """
+    if cfg is None:
+        cfg = CONFIG
+    # Il tempo trascorso da start_ts fin qui è la lettura dello snapshot
+    TICK["timing"] = {"snapshot": PERF_CLOCK() - start_ts}
+    TICK["debug"] = snap["debug"]
+    trace_begin(snap, cfg)
+    store = store_load(snap)
+    TICK["device"] = device_state(snap, store)
+    TICK["deferred"] = None
+    TICK["notify"] = {}
+    TICK["queue"] = []
+    TICK["track"] = None
+    store_absorb_protection_cycles(snap, cfg)
+    # Contatori cumulativi dei comandi: vivono nello store
+    TICK["commands"] = store["commands"]
+    dt_iso_start = snap["date_time_iso"]
     try:
         start_time_hms = dt_iso_start.split("T")[1][:8] if "T" in dt_iso_start else dt_iso_start[-8:]
     except Exception:
         start_time_hms = dt_iso_start
-    log_debug(f"Script AVVIATO - inizio {start_time_hms}")
+    log_debug("Script AVVIATO - inizio %s", start_time_hms)
 
     # Controlli preliminari
-    pre = controlli_preliminari(CONFIG)
+    started = stage_start()
+    pre = controlli_preliminari(snap, cfg)
+    stage_end("preliminari", started)
     if pre:
         human_reason = pre
-        end_ts = get_float(CONFIG["entities"]["current_timestamp"], 0)
-        call_service("select", "select_option", {"entity_id": CONFIG["entities"]["wallbox_set_mode"], "option": "paused"})
-        state_min = {"grid_present": True}
-        update_status_sensor(0, True, human_reason, state_min, CONFIG, start_ts, end_ts)
-        return
-
-    # Lettura stato completo
-    state = get_system_state(CONFIG)
-    state_local = state  # salvo globalmente per apply_wallbox_state controllo min_amp
+        command_wallbox_mode("paused", cfg)
+        return finish_tick(0, True, human_reason, None, cfg, start_ts, PERF_CLOCK(), dt_iso_start)
+
+    # Lettura stato completo (dallo snapshot, nessuna nuova lettura) e filtri su finestra mobile
+    state = get_system_state(snap, cfg)
+    if state[S_STALE] or STORE["data"].get("stale"):
+        stale_note(state[S_STALE])
+    if share is not None:
+        apply_share(state, share)
+
+    # SCENARIO 3 (fast-path): protezione interruttore generale prima di qualsiasi logica PV/batteria (filtri,
+    # previsione e piano compresi); usa letture non filtrate
+    guard = overcurrent_guard(state[S_HOME_CURRENT], state[S_HOME_MAX_CURRENT], state[S_WALLBOX_POWER], state[S_VOLTAGE],
+                              state[S_MIN_AMP], TICK["device"]["current"], cfg)
+    if guard is not None:
+        final_amps, pause_mode, pause_reason = apply_overcurrent_guard(guard, cfg)
+        return finish_tick(final_amps, pause_mode, pause_reason, state, cfg, start_ts, PERF_CLOCK(), dt_iso_start)
+
+    apply_filters(state, cfg)
+    started = stage_start()
+    if share is not None and "forecast" in share:
+        state[S_FORECAST] = share["forecast"]
+    else:
+        state[S_FORECAST] = pv_forecast(state, snap, cfg)
+        if share is not None:
+            share["forecast"] = state[S_FORECAST]
+    stage_end("forecast", started)
+    started = stage_start()
+    state[S_PLAN] = plan_update(state, snap, cfg)
+    stage_end("planner", started)
 
     # Controllo voltaggio
-    if state.get("voltage", 0) <= 0:
-        call_service("select", "select_option", {"entity_id": CONFIG["entities"]["wallbox_set_mode"], "option": "paused"})
-        log_warn(f"ERRORE CRITICO: Voltaggio non valido ({state.get('voltage')}V).")
-        update_status_sensor(0, True, f"Voltaggio non valido ({state.get('voltage')}V)", state, CONFIG, start_ts, get_float(CONFIG["entities"]["current_timestamp"], 0))
-        return
+    if state[S_VOLTAGE] <= 0:
+        command_wallbox_mode("paused", cfg)
+        log_warn("ERRORE CRITICO: Voltaggio non valido (%sV).", state[S_VOLTAGE])
+        return finish_tick(0, True, f"Voltaggio non valido ({state[S_VOLTAGE]}V)", state, cfg, start_ts, PERF_CLOCK(), dt_iso_start)
 
     # Controllo critico: grid assente e batteria bassa
-    if (not state.get("grid_present", True)) and state.get("soc_attuale", 100) < state.get("soc_min", 0):
-        call_service("select", "select_option", {"entity_id": CONFIG["entities"]["wallbox_set_mode"], "option": "paused"})
+    if (not state[S_GRID_PRESENT]) and state[S_SOC_ATTUALE] < state[S_SOC_MIN]:
+        command_wallbox_mode("paused", cfg)
         log_warn("GRID ASSENTE e SOC batteria sotto minimo -> metto in pausa")
-        send_persistent_notification(
-            "grid_absent_battery_low",
-            "⚠️ Grid Assente - Carica Bloccata",
-            f"La rete elettrica è assente e la batteria di casa è bassa ({state.get('soc_attuale')}%). La ricarica della Wallbox è stata sospesa.",
-            "warning"
-        )
-        update_status_sensor(0, True, "GRID assente e batt. bassa", state, CONFIG, start_ts, get_float(CONFIG["entities"]["current_timestamp"], 0))
-        return
+        notify_condition("grid_absent_battery_low", True,
+                         f"La rete elettrica è assente e la batteria di casa è bassa ({state[S_SOC_ATTUALE]}%). La ricarica della Wallbox è stata sospesa.")
+        return finish_tick(0, True, "GRID assente e batt. bassa", state, cfg, start_ts, PERF_CLOCK(), dt_iso_start)
 
     # Logiche principali: pause e calcolo ampere
-    pause_from_rules = determine_pause_reason(state, CONFIG)
+    use_table = bool(DECISION) and cfg["params"].get("decision_table", True)
+    started = stage_start()
+    if use_table:
+        record = DECISION["decision_record"](state, cfg)
+        pause_from_rules, actions = DECISION["decide_pause"](record, debug_enabled())
+        apply_decision_actions(actions)
+    else:
+        pause_from_rules = determine_pause_reason(state, cfg)
+    stage_end("pause_rules", started)
     if pause_from_rules:
-        final_amps, pause_mode, pause_reason = apply_wallbox_state(0, pause_from_rules, CONFIG)
+        final_amps, pause_mode, pause_reason = apply_wallbox_state(0, pause_from_rules, state, cfg)
     else:
-        target_amps, calc_pause_reason = calculate_target_amps(state, CONFIG)
-        final_amps, pause_mode, pause_reason = apply_wallbox_state(target_amps, calc_pause_reason, CONFIG)
-
-    # Aggiorna sensore di stato
-    end_ts = get_float(CONFIG["entities"]["current_timestamp"], 0)
-    update_status_sensor(final_amps, pause_mode, pause_reason, state, CONFIG, start_ts, end_ts)
+        started = stage_start()
+        if use_table:
+            target_amps, calc_pause_reason, actions = DECISION["decide_amps"](record, debug_enabled())
+            apply_decision_actions(actions)
+        else:
+            target_amps, calc_pause_reason = calculate_target_amps(state, cfg)
+        if cfg["params"].get("regulator_mode") == "pi" and target_amps > 0 and not calc_pause_reason:
+            target_amps = regulator_amps(target_amps, state, cfg)
+        stage_end("target_amps", started)
+        final_amps, pause_mode, pause_reason = apply_wallbox_state(target_amps, calc_pause_reason, state, cfg, deferrable=True)
 
-    # --- Pulizia notifiche condizionata ---
+    # --- Condizioni di notifica risolte (il dismiss parte solo sul fronte, in notifications_sync a fine tick) ---
     # Evitiamo di rimuovere notifiche che devono rimanere visibili finché la condizione è ancora vera.
 
     # EV EMERGENCY: rimuovi solo se emergenza non è più attiva
-    ev_soc = state.get("ev_soc")              # None se sensore assente (fallback prudente)
-    ev_emerg_threshold = state.get("ev_soc_emergenza", 0.0)
-    ev_emergency_active = False
-    if ev_soc is not None and ev_emerg_threshold and ev_soc < ev_emerg_threshold and ev_soc < 99.0:
-        ev_emergency_active = True
-
-    if ev_emergency_active:
-        log_debug(f"[Wallbox DEBUG V 2025.11.0] Mantengo notifica EV_EMERGENCY: EV SOC {ev_soc} < soglia {ev_emerg_threshold}")
+    if state[S_EMERGENCY]:
+        log_debug("Mantengo notifica EV_EMERGENCY: EV SOC %s < soglia %s", state[S_EV_SOC], state[S_EV_SOC_EMERGENZA])
     else:
-        # dismiss_persistent_notification controlla già l'esistenza della notifica prima di rimuovere
-        dismiss_persistent_notification("ev_emergency")
+        notify_condition("ev_emergency", False)
 
     # GRID ABSENT + BATTERY LOW: rimuovi solo se la condizione critica è risolta
-    grid_present = state.get("grid_present", True)
-    soc_attuale = state.get("soc_attuale", 100)
-    soc_min = state.get("soc_min", 0)
+    grid_present = state[S_GRID_PRESENT]
+    soc_attuale = state[S_SOC_ATTUALE]
+    soc_min = state[S_SOC_MIN]
 
     grid_critical_active = (not grid_present) and (soc_attuale < soc_min)
 
     if grid_critical_active:
-        log_debug(f"[Wallbox DEBUG V 2025.11.0] Mantengo notifica GRID_ABSENT_BATTERY_LOW: grid_present={grid_present}, SOC={soc_attuale}% < min {soc_min}%")
+        log_debug("Mantengo notifica GRID_ABSENT_BATTERY_LOW: grid_present=%s, SOC=%s%% < min %s%%", grid_present, soc_attuale, soc_min)
     else:
-        dismiss_persistent_notification("grid_absent_battery_low")
+        notify_condition("grid_absent_battery_low", False)
 
-    duration = round(end_ts - start_ts, 3) if start_ts and end_ts else None
-    readable_pause = "PAUSA" if pause_mode else "CARICA"
+    # Aggiorna sensore di stato
+    end_ts = PERF_CLOCK()
+    return finish_tick(final_amps, pause_mode, pause_reason, state, cfg, start_ts, end_ts, dt_iso_start)
+
+# === 9b. PIÙ WALLBOX: SNAPSHOT CONDIVISO E RIPARTIZIONE DEL BUDGET ===
+# Con CONFIG["chargers"] ogni wallbox è un'istanza della stessa pipeline di run_tick, con entità, store, stato
+# pubblicato e notifiche propri. Le entità comuni (PV, batteria, casa, sole, orari...) vengono lette una volta
+# sola per tutte; per ogni wallbox si leggono solo le sue. Il surplus FTV (PV - consumi domestici senza nessuna
+# wallbox) e la corrente disponibile (home_max_current - corrente domestica) vengono ripartiti in ordine di
+# priorità: con "priority" ogni wallbox vede quanto lasciato da quelle prima di lei, con "fair" la sua parte tra
+# le wallbox attive rimaste (mai meno della potenza minima, altrimenti caricano in meno). La previsione FTV viene
+# calcolata una volta e condivisa.
+CHARGER_KEYS = (
+    "wallbox_state", "wallbox_set_mode", "wallbox_set_current", "last_tag_time", "last_wbox_tag", "min_charge_amps",
+    "max_charge_amps", "force_charge", "wallbox_power", "ev_soc", "ev_target_soc", "ev_soc_emergenza",
+    "ev_departure_time", "last_wallbox_current", "status_sensor", "controller_state", "diagnostics_sensor",
+    "energy_solar_sensor", "energy_battery_sensor", "energy_grid_sensor",
+)
+# Entità scritte dallo script: se una wallbox non le indica prendono il suffisso del suo nome
+CHARGER_OUTPUT_KEYS = ("status_sensor", "controller_state", "diagnostics_sensor",
+                       "energy_solar_sensor", "energy_battery_sensor", "energy_grid_sensor")
+SHARED_FIELDS = tuple([f for f in SNAPSHOT_FIELDS if f[1] not in CHARGER_KEYS])
+CHARGER_FIELDS = tuple([f for f in SNAPSHOT_FIELDS if f[1] in CHARGER_KEYS])
+SHARED_OVERCURRENT_FIELDS = tuple([f for f in OVERCURRENT_FIELDS if f[1] not in CHARGER_KEYS])
+CHARGER_OVERCURRENT_FIELDS = tuple([f for f in OVERCURRENT_FIELDS if f[1] in CHARGER_KEYS])
+# Configurazioni delle wallbox (calcolate una volta) e store di ognuna, per nome
+CHARGERS = {"list": None}
+CHARGER_STORES = {}
+
+def charger_configs(cfg):
+    """Configurazione di ogni wallbox (entità e params comuni + le sue), ordinate per priorità."""
+    if CHARGERS["list"] is not None:
+        return CHARGERS["list"]
+    chargers = []
+    for index, charger in enumerate(cfg["chargers"]):
+        name = charger.get("name") or f"wallbox{index + 1}"
+        entities = {k: v for k, v in cfg["entities"].items()}
+        for key in CHARGER_OUTPUT_KEYS:
+            entities[key] = f"{entities[key]}_{name}"
+        for key, entity_id in charger.get("entities", {}).items():
+            entities[key] = entity_id
+        params = {k: v for k, v in cfg["params"].items()}
+        for key, value in charger.get("params", {}).items():
+            params[key] = value
+        chargers.append({"name": name, "priority": charger.get("priority", index + 1), "entities": entities, "params": params})
+    CHARGERS["list"] = sorted(chargers, key=lambda c: c["priority"])
+    return CHARGERS["list"]
+
+def store_swap(saved):
+    # Scambia lo store globale con quello di una wallbox: le funzioni decisionali usano sempre STORE
+    for k in ("loaded", "saved_ts", "data"):
+        current = STORE[k]
+        STORE[k] = saved[k]
+        saved[k] = current
+
+def charger_store(name):
+    return CHARGER_STORES.setdefault(name, {"loaded": False, "saved_ts": 0, "data": {}})
+
+def charger_snapshots(shared, chargers, fields, objs):
+    # Snapshot di ogni wallbox: valori comuni + le sue entità (quelle in comune tra più wallbox lette una volta)
+    snaps = []
+    for charger in chargers:
+        snap = {k: shared[k] for k in shared}
+        own = read_snapshot(charger, fields, objs)
+        for k in own:
+            snap[k] = own[k]
+        # Letture comuni non aggiornate: valgono per ogni wallbox, insieme a quelle delle sue entità
+        stale = {k: v for k, v in shared["stale"].items()}
+        for k in own["stale"]:
+            stale[k] = own["stale"][k]
+        snap["stale"] = stale
+        snaps.append(snap)
+    return snaps
+
+def site_budget(snaps, cfg):
+    """Surplus, corrente disponibile e consumi domestici del contatore, al netto di tutte le wallbox."""
+    site = get_system_state(snaps[0], cfg)
+    voltage = site[S_VOLTAGE] if site[S_VOLTAGE] > 0 else 230.0
+    wallbox_power = sum([snap["wallbox_power"] for snap in snaps])
+    domestic_power = max(0.0, site[S_HOME_POWER] - wallbox_power)
+    domestic_current = max(0.0, site[S_HOME_CURRENT] - wallbox_power / voltage)
+    return {
+        "voltage": voltage,
+        "domestic_power": domestic_power,
+        "domestic_current": domestic_current,
+        "surplus": site[S_PV_POWER] - domestic_power,
+        "current": site[S_HOME_MAX_CURRENT] - domestic_current,
+        # Attive: collegate e sotto il target (le altre vanno comunque in pausa e non prendono quote)
+        "active": [snap["wallbox_state"] != "idle" and (snap["ev_soc"] is None or snap["ev_soc"] < snap["ev_target"]) for snap in snaps],
+        "min_amp": [effective_min_amp(snap["min_charge_amps"], cfg) for snap in snaps],
+        "forecast": None,
+    }
 
-    if duration is not None:
-        log_debug(f"Script TERMINATO - {readable_pause} {final_amps}A - motivo: {pause_reason or 'Nessuno'} - durata {duration}s")
+def fair_parts(amount, unit, left):
+    # In quante parti dividere amount tra left wallbox senza scendere sotto unit per ognuna
+    if left <= 1 or amount <= 0 or unit <= 0:
+        return 1
+    return max(1, min(left, int(amount // unit)))
+
+def allocate_share(budget, index, cfg):
+    """Quota di surplus (W) e di corrente (A) della wallbox index, su quanto lasciato dalle precedenti."""
+    share = {"surplus": budget["surplus"], "current": max(0.0, budget["current"]),
+             "domestic_power": budget["domestic_power"], "domestic_current": budget["domestic_current"]}
+    if cfg["params"].get("charger_allocation", "priority") == "fair" and budget["active"][index]:
+        left = len([a for a in budget["active"][index:] if a])
+        min_amp = budget["min_amp"][index]
+        share["surplus"] = budget["surplus"] / fair_parts(budget["surplus"], min_amp * budget["voltage"], left)
+        share["current"] = share["current"] / fair_parts(share["current"], min_amp, left)
+    if budget["forecast"] is not None:
+        share["forecast"] = budget["forecast"]
+    return share
+
+def apply_share(state, share):
+    # La pipeline della wallbox vede solo la sua quota: surplus, consumi domestici e corrente (guardia SCENARIO 3)
+    voltage = state[S_VOLTAGE] if state[S_VOLTAGE] > 0 else 230.0
+    state[S_HOME_DOMESTIC_POWER] = share["domestic_power"]
+    state[S_PV_EXCESS] = share["surplus"]
+    state[S_HOME_CURRENT] = share["domestic_current"] + state[S_WALLBOX_POWER] / voltage
+    state[S_HOME_MAX_CURRENT] = share["domestic_current"] + share["current"]
+    state[S_ALLOCATION] = share
+
+def run_site_tick(start_ts):
+    """
+    Tick con più wallbox: lettura delle entità comuni una sola volta, poi la pipeline di ogni wallbox in ordine
+    di priorità con la sua quota; quello che una wallbox comanda viene tolto dal budget delle successive.
+    """
+    chargers = charger_configs(CONFIG)
+    objs = {}
+    shared = read_snapshot(CONFIG, SHARED_FIELDS, objs)
+    TICK["debug"] = shared["debug"]
+    snaps = charger_snapshots(shared, chargers, CHARGER_FIELDS, objs)
+    budget = site_budget(snaps, CONFIG)
+    for index in range(len(chargers)):
+        charger = chargers[index]
+        share = allocate_share(budget, index, charger)
+        TICK["charger"] = charger["name"]
+        saved = charger_store(charger["name"])
+        store_swap(saved)
+        try:
+            # La lettura dello snapshot (comune e di tutte le wallbox) viene attribuita alla prima
+            amps = run_tick(snaps[index], start_ts if index == 0 else PERF_CLOCK(), charger, share)
+        finally:
+            store_swap(saved)
+            TICK["charger"] = None
+        budget["surplus"] = budget["surplus"] - amps * budget["voltage"]
+        budget["current"] = budget["current"] - amps
+        budget["forecast"] = share.get("forecast")
+    # Comandi di tutte le wallbox in parallelo (catene diverse); gli esiti vanno nello store di ognuna
+    dispatch_finish()
+
+def site_overcurrent_tick():
+    """
+    Fast-path sovracorrente con più wallbox: stesse letture comuni una volta sola, poi riduzione o pausa
+    partendo dalla wallbox con priorità più bassa finché l'eccesso misurato non è coperto.
+    """
+    chargers = charger_configs(CONFIG)
+    objs = {}
+    shared = read_snapshot(CONFIG, SHARED_OVERCURRENT_FIELDS, objs)
+    excess = shared["home_current"] - shared["home_max_current"]
+    if excess <= 0:
+        return None
+    voltage = shared["voltage"]
+    snaps = charger_snapshots(shared, chargers, CHARGER_OVERCURRENT_FIELDS, objs)
+    result = None
+    for index in range(len(chargers) - 1, -1, -1):
+        if excess <= 0:
+            break
+        charger = chargers[index]
+        snap = snaps[index]
+        if snap["wallbox_power"] <= 0 or voltage <= 0:
+            continue
+        TICK["charger"] = charger["name"]
+        saved = charger_store(charger["name"])
+        store_swap(saved)
+        try:
+            store = store_load(snap)
+            # Comandi contati nello store di questa wallbox (send_command usa TICK["commands"])
+            TICK["commands"] = store["commands"]
+            TICK["debug"] = snap["debug"]
+            TICK["device"] = device_state(snap, store)
+            drawn = snap["wallbox_power"] / voltage
+            # Questa wallbox vede come limite quello che resta togliendo l'eccesso ancora da coprire
+            guard = overcurrent_guard(drawn + excess, drawn, snap["wallbox_power"], voltage,
+                                      effective_min_amp(snap["min_charge_amps"], charger), TICK["device"]["current"], charger)
+            TICK["device"] = {"mode": None, "current": None}
+            result = apply_overcurrent_guard(guard, charger)
+            store_record(result[0], result[1], None, charger)
+            excess = excess - (drawn - result[0])
+            dispatch_begin(charger)
+        finally:
+            store_swap(saved)
+            TICK["charger"] = None
+    dispatch_finish()
+    return result
+
+# === 10. VALIDAZIONE DELLA CONFIGURAZIONE ===
+# Il runtime residente valida CONFIG una volta al caricamento (engine.load_script) e non parte se qualcosa non va;
+# come python_script il controllo costerebbe a ogni esecuzione e non viene fatto.
+PARAM_CHOICES = {
+    "smoothing_mode": ("raw", "ema", "pessimistic", "worst"),
+    "charger_allocation": ("priority", "fair"),
+    "energy_attribution": ("home_first", "proportional"),
+    "regulator_mode": ("open_loop", "pi"),
+}
+# Rapporti e coefficienti: valori tra 0 e 1
+PARAM_RATIOS = (
+    "min_power_ratio_for_min_amps", "batt_discharge_margin", "pv_safety_margin_ratio", "smoothing_ema_alpha",
+    "forecast_start_ratio", "ev_charge_efficiency", "planner_solar_confidence", "regulator_follow_ratio",
+)
+
+def params_errors(params, where):
+    errors = []
+    for key, value in params.items():
+        if key in PARAM_CHOICES:
+            if value not in PARAM_CHOICES[key]:
+                errors.append(f"{where}{key}: {value!r} non è tra {', '.join(PARAM_CHOICES[key])}")
+        elif isinstance(value, bool) or isinstance(value, str):
+            continue
+        elif not isinstance(value, (int, float)) or value < 0:
+            errors.append(f"{where}{key}: {value!r} non è un numero >= 0")
+        elif key in PARAM_RATIOS and value > 1:
+            errors.append(f"{where}{key}: {value} non è tra 0 e 1")
+    return errors
+
+def config_errors(cfg):
+    """Errori di CONFIG (lista vuota = configurazione valida): entità mancanti, parametri e wallbox."""
+    errors = []
+    needed = [f[1] for f in SNAPSHOT_FIELDS] + list(CHARGER_OUTPUT_KEYS) + ["batt_protection_cycles"]
+    for key in needed:
+        entity_id = cfg["entities"].get(key)
+        if not isinstance(entity_id, str) or "." not in entity_id:
+            errors.append(f"entities.{key}: entity_id mancante o non valido ({entity_id!r})")
+    errors.extend(params_errors(cfg["params"], "params."))
+    names = []
+    for index, charger in enumerate(cfg.get("chargers", [])):
+        name = charger.get("name") or f"wallbox{index + 1}"
+        if name in names:
+            errors.append(f"chargers: nome {name} ripetuto")
+        names.append(name)
+        for key in charger.get("entities", {}):
+            if key not in CHARGER_KEYS:
+                errors.append(f"chargers.{name}.entities.{key}: entità comune, non della singola wallbox")
+        errors.extend(params_errors(charger.get("params", {}), f"chargers.{name}.params."))
+    return errors
+
+# Esegui (il runtime residente in custom_components/wallbox_control carica lo script con load_only e chiama main() sugli eventi).
+# Con l'integrazione attiva lo script fa solo da tramite: chiede un tick al runtime residente invece di eseguire
+# la logica una seconda volta con uno store diverso.
+if not data.get("load_only", False):
+    if hass.services.has_service("wallbox_control", "tick"):
+        hass.services.call("wallbox_control", "tick", {})
     else:
-        log_debug(f"Script TERMINATO - {readable_pause} {final_amps}A - motivo: {pause_reason or 'Nessuno'}")
-
-# Esegui
-main()
\ No newline at end of file
+        main()
\ No newline at end of file
@@ -0,0 +1,11 @@
+"""
+Wallbox Dynamic Controller - tramite python_script per il runtime residente
+Da usare nell'automazione al posto di wallbox_charging_control.py quando l'integrazione wallbox_control è attiva:
+HA compila ed esegue questo file a ogni chiamata, quindi resta di poche righe; la logica gira nel runtime residente,
+già caricato e con CONFIG validato. Senza l'integrazione non fa nulla (usare wallbox_charging_control.py).
+Dati opzionali: script (percorso dello script dell'impianto, se più di uno).
+"""
+if hass.services.has_service("wallbox_control", "tick"):
+    hass.services.call("wallbox_control", "tick", {"script": data["script"]} if data.get("script") else {})
+else:
+    logger.warning("wallbox_control_tick: integrazione wallbox_control non attiva, nessun tick eseguito")